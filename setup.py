@@ -22,14 +22,14 @@ try:
     import tensorflow
 except ImportError:
     kw.pop()
-    kw.append('tensorflow==1.2.0')
+    kw.append('tensorflow==1.4.0')
 else:
     if is_gpu():
         kw.pop()
-        kw.append('tensorflow-gpu==1.2.0')
+        kw.append('tensorflow-gpu==1.4.0')
     else:
         kw.pop()
-        kw.append('tensorflow==1.2.0')
+        kw.append('tensorflow==1.4.0')
 
 setup(name='yaset',
       version='0.1',
@@ -0,0 +1,870 @@
+import argparse
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+
+import numpy as np
+
+from yaset.data.index import CorpusIndex
+from yaset.data.normalize import TokenNormalizer
+
+
+def generate_corpus(target_file, nb_sequences, seed=42):
+    """
+    Generate a synthetic tabulated corpus
+    :param target_file: target file path
+    :param nb_sequences: number of sequences to generate
+    :param seed: random seed
+    :return: nothing
+    """
+
+    rng = random.Random(seed)
+
+    vocabulary = ["tok{}".format(i) for i in range(5000)] + ["12.5mg", "Aspirin", "2017", "mg", "."]
+    labels = ["O", "B-DRUG", "I-DRUG", "B-DOSE", "I-DOSE"]
+
+    with open(os.path.abspath(target_file), "w", encoding="UTF-8") as output_file:
+        for _ in range(nb_sequences):
+            for _ in range(rng.randint(5, 40)):
+                output_file.write("{}\t{}\n".format(rng.choice(vocabulary), rng.choice(labels)))
+            output_file.write("\n")
+
+
+def bench_reader(sizes, dev_ratio=0.2):
+    """
+    Time train-file preprocessing (indexing, random dev split, counts and sequence iteration) for
+    increasing corpus sizes. Time per sequence should stay roughly constant.
+    :param sizes: list of corpus sizes (number of sequences)
+    :param dev_ratio: dev ratio used for the random split
+    :return: nothing
+    """
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for nb_sequences in sizes:
+
+            data_file = os.path.join(temp_dir, "train-{}.tab".format(nb_sequences))
+            generate_corpus(data_file, nb_sequences)
+
+            start = time.time()
+
+            index = CorpusIndex(data_file).build()
+
+            rng = np.random.RandomState(42)
+            dev_selection = np.zeros(len(index), dtype=bool)
+            dev_selection[rng.permutation(len(index))[:int(np.ceil(dev_ratio * len(index)))]] = True
+            train_selection = ~dev_selection
+
+            dev_counts = index.get_counts(dev_selection)
+            train_counts = index.counts - dev_counts
+
+            normalizer = TokenNormalizer(lower_input=True, replace_digits=True)
+            _ = train_counts.get_normalized_token_counts(normalizer)
+            _ = train_counts.get_char_set(normalizer)
+
+            for _ in index.iter_sequences(train_selection):
+                pass
+
+            for _ in index.iter_sequences(dev_selection):
+                pass
+
+            end = time.time()
+
+            logging.info("* nb. sequences={:>9,} | time={:8.3f}s | time/sequence={:.2f}us".format(
+                nb_sequences,
+                end - start,
+                ((end - start) / nb_sequences) * 1e6
+            ))
+
+
+def _legacy_normalize(tokens, char_mapping):
+    """
+    Token normalization as done before TokenNormalizer: re.sub on every token and on every character, twice
+    :param tokens: list of raw tokens
+    :param char_mapping: character mapping
+    :return: normalized tokens and character IDs
+    """
+
+    normalized_tokens = list()
+    char_ids = list()
+
+    for token in tokens:
+        token_str = token.lower()
+        token_str = re.sub("\\d", "0", token_str)
+        normalized_tokens.append(token_str)
+
+        token_size = 0
+        for char in token:
+            char_str = re.sub("\\d", "0", char)
+            if char_str in char_mapping:
+                token_size += 1
+
+    for token in tokens:
+        token_char_ids = list()
+        for char in token:
+            char_str = re.sub("\\d", "0", char)
+            if char_str in char_mapping:
+                token_char_ids.append(char_mapping[char_str])
+        char_ids.append(token_char_ids)
+
+    return normalized_tokens, char_ids
+
+
+def bench_normalize(nb_tokens, seed=42):
+    """
+    Compare the legacy per-character re.sub normalization with TokenNormalizer
+    :param nb_tokens: number of tokens to normalize
+    :param seed: random seed
+    :return: nothing
+    """
+
+    rng = random.Random(seed)
+
+    # Zipf-like token distribution
+    vocabulary = ["Tok{}".format(i) for i in range(20000)] + ["12.5mg", "Aspirin", "2017", "mg", "."]
+    weights = [1.0 / rank for rank in range(1, len(vocabulary) + 1)]
+    tokens = rng.choices(vocabulary, weights=weights, k=nb_tokens)
+
+    char_mapping = dict()
+    for i, char in enumerate(sorted(set("".join(vocabulary).replace("1", "0"))), start=1):
+        char_mapping[char] = i
+
+    start = time.time()
+    legacy_tokens, legacy_char_ids = _legacy_normalize(tokens, char_mapping)
+    legacy_time = time.time() - start
+
+    normalizer = TokenNormalizer(lower_input=True, replace_digits=True, char_mapping=char_mapping)
+
+    start = time.time()
+    new_tokens = [normalizer.normalize(token) for token in tokens]
+    new_char_ids = [normalizer.get_char_ids(token) for token in tokens]
+    new_time = time.time() - start
+
+    if legacy_tokens != new_tokens or [tuple(item) for item in legacy_char_ids] != new_char_ids:
+        raise Exception("Normalization outputs differ")
+
+    logging.info("* nb. tokens={:,} | legacy={:.3f}s | normalizer={:.3f}s | speedup={:.1f}x".format(
+        nb_tokens,
+        legacy_time,
+        new_time,
+        legacy_time / new_time
+    ))
+
+
+def _legacy_loss_crf_scan(transition_params, _, current_input):
+    """
+    Per-sequence CRF log likelihood as computed before batching (tf.scan over the mini-batch)
+    :param transition_params: transition matrix
+    :param _: previous output
+    :param current_input: unary scores, sequence length and labels of one sequence
+    :return: sequence log likelihood
+    """
+
+    import tensorflow as tf
+
+    tile = tf.tile(tf.constant(-1000.0, shape=[1, 2], dtype=tf.float32), [tf.shape(current_input[0])[0], 1])
+    tiled_tensor = tf.concat([current_input[0], tile], 1)
+
+    cur_nb_class = current_input[0].get_shape().as_list()[1]
+
+    start_unary_scores = [[-1000.0] * cur_nb_class + [0.0, -1000.0]]
+    end_unary_tensor = [[-1000.0] * cur_nb_class + [-1000.0, 0.0]]
+
+    tensor_start = tf.concat([start_unary_scores, tiled_tensor], 0)
+
+    mask = tf.sequence_mask(
+        (tf.cast(tf.reshape(current_input[1], [-1]), dtype=tf.int32) + 1) * tf.shape(tensor_start)[1],
+        tf.shape(tensor_start)[1] * tf.shape(tensor_start)[0],
+        dtype=tf.int32)
+
+    unary_scores_reshaped = tf.reshape(tensor_start, [1, -1])
+    slices = tf.dynamic_partition(unary_scores_reshaped, mask, 2)
+    slice_1 = tf.reshape(slices[1], [-1, tf.shape(tensor_start)[1]])
+
+    tensor_start_end = tf.concat([slice_1, end_unary_tensor], 0)
+    tensor_start_end_reshaped = tf.reshape(tensor_start_end,
+                                           [1, tf.shape(tensor_start_end)[0], tf.shape(tensor_start_end)[1]])
+    tensor_start_end_reshaped.set_shape([1, None, cur_nb_class + 2])
+
+    mask_y = tf.sequence_mask(
+        (tf.cast(tf.reshape(current_input[1], [-1]), dtype=tf.int32)),
+        tf.shape(current_input[0])[0],
+        dtype=tf.int32
+    )
+
+    y_reshaped = tf.reshape(current_input[2], [1, -1])
+    slices_y = tf.dynamic_partition(y_reshaped, mask_y, 2)
+
+    new_y = tf.concat([[cur_nb_class], slices_y[1], [cur_nb_class+1]], axis=0)
+    new_y_reshaped = tf.reshape(new_y, [1, -1])
+
+    log_likelihood, _ = tf.contrib.crf.crf_log_likelihood(tensor_start_end_reshaped, new_y_reshaped,
+                                                          current_input[1],
+                                                          transition_params=transition_params)
+
+    return tf.reduce_sum(log_likelihood)
+
+
+def bench_crf(batch_size, max_len, nb_classes, nb_steps, seed=42):
+    """
+    Check that the batched CRF loss gives the same value and gradients as the former per-sequence loss, then
+    compare their speed (forward and backward passes) on CPU
+    :param batch_size: mini-batch size
+    :param max_len: maximum sequence length
+    :param nb_classes: number of labels
+    :param nb_steps: number of timed steps
+    :param seed: random seed
+    :return: nothing
+    """
+
+    import tensorflow as tf
+    from functools import partial
+
+    from yaset.nn.models.lstm import add_start_end_states
+
+    rng = np.random.RandomState(seed)
+
+    lengths = rng.randint(1, max_len + 1, size=batch_size).astype(np.int32)
+    lengths[0] = max_len
+    labels = rng.randint(0, nb_classes, size=(batch_size, max_len)).astype(np.int32)
+
+    tf.reset_default_graph()
+
+    unary_scores = tf.Variable(rng.randn(batch_size, max_len, nb_classes).astype(np.float32))
+    transition_params = tf.Variable(rng.uniform(-1.0, 1.0, size=(nb_classes + 2, nb_classes + 2)).astype(np.float32))
+
+    x_len = tf.constant(lengths)
+    y = tf.constant(labels)
+
+    # Former implementation
+    legacy_out = tf.scan(partial(_legacy_loss_crf_scan, transition_params),
+                         [unary_scores, tf.reshape(x_len, [batch_size, -1]), y],
+                         back_prop=True, infer_shape=True, initializer=0.0)
+    legacy_loss = tf.reduce_sum(legacy_out) / batch_size
+    legacy_grads = tf.gradients(-legacy_loss, [unary_scores, transition_params])
+
+    # Batched implementation
+    padded_scores, padded_labels = add_start_end_states(unary_scores, y, x_len, nb_classes)
+    log_likelihood, _ = tf.contrib.crf.crf_log_likelihood(padded_scores, padded_labels, x_len,
+                                                          transition_params=transition_params)
+    batched_loss = tf.reduce_sum(log_likelihood) / batch_size
+    batched_grads = tf.gradients(-batched_loss, [unary_scores, transition_params])
+
+    config_tf = tf.ConfigProto(device_count={"GPU": 0})
+
+    with tf.Session(config=config_tf) as sess:
+        sess.run(tf.global_variables_initializer())
+
+        legacy_values = sess.run([legacy_loss] + legacy_grads)
+        batched_values = sess.run([batched_loss] + batched_grads)
+
+        for name, legacy_value, batched_value in zip(["loss", "d_unary", "d_transitions"],
+                                                     legacy_values, batched_values):
+            max_diff = np.max(np.abs(np.asarray(legacy_value) - np.asarray(batched_value)))
+            logging.info("* {}: max. abs. difference={:.2e}".format(name, max_diff))
+
+            if not np.allclose(legacy_value, batched_value, rtol=1e-4, atol=1e-4):
+                raise Exception("Batched CRF loss differs from the per-sequence loss ({})".format(name))
+
+        for name, fetches in [("per-sequence", legacy_grads), ("batched", batched_grads)]:
+            start = time.time()
+            for _ in range(nb_steps):
+                sess.run(fetches)
+            end = time.time()
+
+            logging.info("* {}: {:.2f} steps/sec".format(name, nb_steps / (end - start)))
+
+
+def bench_viterbi(batch_size, max_len, nb_classes, nb_batches, seed=42):
+    """
+    Check that the batched Viterbi decoder gives the same label sequences as the per-sequence TensorFlow
+    decoder, then compare the per-sentence decoding cost with and without a session call per sequence
+    :param batch_size: mini-batch size
+    :param max_len: maximum sequence length
+    :param nb_classes: number of labels
+    :param nb_batches: number of decoded mini-batches
+    :param seed: random seed
+    :return: nothing
+    """
+
+    import tensorflow as tf
+
+    from yaset.nn.crf import ViterbiDecoder
+
+    rng = np.random.RandomState(seed)
+
+    batches = list()
+    for _ in range(nb_batches):
+        batches.append((
+            rng.randn(batch_size, max_len, nb_classes).astype(np.float32),
+            rng.randint(1, max_len + 1, size=batch_size).astype(np.int32)
+        ))
+
+    nb_sequences = batch_size * nb_batches
+
+    tf.reset_default_graph()
+
+    transition_params = tf.Variable(rng.uniform(-1.0, 1.0, size=(nb_classes + 2, nb_classes + 2)).astype(np.float32))
+
+    config_tf = tf.ConfigProto(device_count={"GPU": 0})
+
+    with tf.Session(config=config_tf) as sess:
+        sess.run(tf.global_variables_initializer())
+
+        results = dict()
+
+        # Former decoding: one session call and one TensorFlow Viterbi call per sequence, or only one
+        # Viterbi call per sequence once the transition matrix is fetched
+        for name, fetch_per_sequence in [("per-sequence (session call per sequence)", True),
+                                         ("per-sequence (transitions fetched once)", False)]:
+            start = time.time()
+
+            transitions = sess.run(transition_params)
+
+            sequences = list()
+            for unary_scores, sequence_lengths in batches:
+                for unary_scores_, seq_len_ in zip(unary_scores, sequence_lengths):
+                    unary_scores_ = unary_scores_[:seq_len_]
+
+                    start_unary_scores = [[-1000.0] * unary_scores_.shape[1] + [0.0, -1000.0]]
+                    end_unary_tensor = [[-1000.0] * unary_scores_.shape[1] + [-1000.0, 0.0]]
+
+                    tile = np.tile(np.array([-1000.0, -1000.0], dtype=np.float32), [unary_scores_.shape[0], 1])
+
+                    tiled_tensor = np.concatenate([unary_scores_, tile], 1)
+
+                    tensor_start_end = np.concatenate([start_unary_scores, tiled_tensor, end_unary_tensor], 0)
+
+                    if fetch_per_sequence:
+                        transitions = sess.run(transition_params)
+
+                    viterbi_sequence, _ = tf.contrib.crf.viterbi_decode(tensor_start_end, transitions)
+                    sequences.append(list(viterbi_sequence[1:-1]))
+
+            results[name] = (time.time() - start, sequences)
+
+        # Decoder object: transitions fetched once, whole mini-batches decoded at once
+        start = time.time()
+
+        decoder = ViterbiDecoder(sess.run(transition_params))
+
+        sequences = list()
+        for unary_scores, sequence_lengths in batches:
+            sequences.extend([list(item) for item in decoder.decode(unary_scores, sequence_lengths)])
+
+        results["batched decoder"] = (time.time() - start, sequences)
+
+    reference_time, reference_sequences = results["per-sequence (session call per sequence)"]
+
+    for name, (elapsed, sequences) in results.items():
+        if sequences != reference_sequences:
+            raise Exception("Decoding differs from the per-sequence decoding: {}".format(name))
+
+        logging.info("* {}: {:.2f}s ({:.3f} ms/sequence, speedup={:.1f}x)".format(
+            name,
+            elapsed,
+            (elapsed / nb_sequences) * 1000,
+            reference_time / elapsed
+        ))
+
+
+def bench_export(model_path, input_file, batch_size, top_k=None):
+    """
+    Export a model, check that the exported graph gives the same labels as the model restored from its
+    checkpoint, then compare loading and tagging times. A vocabulary-pruned export can be compared as well (its
+    labels may differ for the words that are not kept).
+    :param model_path: yaset model path
+    :param input_file: tabulated test file
+    :param batch_size: mini-batch size
+    :param top_k: also export the model with the K first words of its vocabulary
+    :return: nothing
+    """
+
+    from yaset.apply import load_tagger
+    from yaset.data.reader import StatsCorpus, TestData
+    from yaset.export import export_model
+    from yaset.nn.frozen import FrozenTagger
+
+    with open(input_file, "r", encoding="UTF-8") as input_stream:
+        sequences = [item for item in TestData.iter_input_lines(input_stream) if item is not None]
+
+    results = dict()
+
+    # Model restored from the checkpoint
+    start = time.time()
+    data, tagger = load_tagger(model_path, intra_op_threads=1, inter_op_threads=1)
+    load_time = time.time() - start
+
+    start = time.time()
+    encoded_sequences = [data.encode_sequence(item, StatsCorpus(name="BENCH")) for item in sequences]
+    predictions = tagger.tag(encoded_sequences, batch_size=batch_size)
+    labels = [[data.inv_label_mapping[label] for label in item] for item in predictions]
+    results["checkpoint"] = (load_time, time.time() - start, labels)
+
+    tagger.close()
+
+    # Exported models
+    exports = [("exported", None)]
+
+    if top_k is not None:
+        exports.append(("exported (top-{})".format(top_k), top_k))
+
+    for name, export_top_k in exports:
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_model(model_path, export_dir, top_k=export_top_k)
+
+            start = time.time()
+            tagger = FrozenTagger(export_dir)
+            load_time = time.time() - start
+
+            start = time.time()
+            labels = tagger.tag([[parts[0] for parts in item] for item in sequences], batch_size=batch_size)
+            results[name] = (load_time, time.time() - start, labels)
+
+            tagger.close()
+
+    reference_labels = results["checkpoint"][2]
+    nb_tokens = sum([len(item) for item in sequences])
+
+    for name, (load_time, tag_time, labels) in results.items():
+        diffs = sum([a != b for ref, item in zip(reference_labels, labels) for a, b in zip(ref, item)])
+
+        logging.info("* {}: loading={:.2f}s tagging={:.2f}s ({:,.0f} tokens/s), label differences={:,}".format(
+            name, load_time, tag_time, nb_tokens / tag_time, diffs))
+
+        if name == "exported":
+            nb_diffs = diffs
+
+    if nb_diffs > 0:
+        raise Exception("The exported model does not give the same labels as the checkpoint")
+
+
+def bench_stream(model_path, input_file, batch_size):
+    """
+    Check the streaming mode and the Python iterator API against the checkpoint tagger: empty sequences must get
+    empty label lists and leading or trailing blank lines (blank-only windows) must be written back unchanged
+    :param model_path: yaset model path
+    :param input_file: tabulated test file
+    :param batch_size: mini-batch size
+    :return: nothing
+    """
+
+    import io
+
+    from yaset.apply import apply_stream, load_tagger, tag_sequences
+    from yaset.data.reader import StatsCorpus, TestData
+
+    with open(input_file, "r", encoding="UTF-8") as input_stream:
+        lines = input_stream.read().split("\n")
+
+    sequences = [item for item in TestData.iter_input_lines(lines) if item is not None]
+
+    data, tagger = load_tagger(model_path, intra_op_threads=1, inter_op_threads=1)
+    encoded_sequences = [data.encode_sequence(item, StatsCorpus(name="BENCH")) for item in sequences]
+    reference_labels = [[data.inv_label_mapping[label] for label in item]
+                        for item in tagger.tag(encoded_sequences, batch_size=batch_size)]
+    tagger.close()
+
+    # Python API, an empty sequence before each sequence
+    mixed_sequences = [item for sequence in sequences for item in [list(), sequence]]
+
+    start = time.time()
+    labels = list(tag_sequences(model_path, mixed_sequences, batch_size=batch_size))
+    logging.info("* tag_sequences: {:,} sequences in {:.2f}s".format(len(mixed_sequences), time.time() - start))
+
+    if labels[0::2] != [list()] * len(sequences):
+        raise Exception("Empty sequences did not get empty label lists")
+
+    if labels[1::2] != reference_labels:
+        raise Exception("tag_sequences does not give the same labels as the checkpoint tagger")
+
+    # Streaming mode, blank lines around the input
+    input_stream = io.StringIO("\n\n{}\n\n\n".format("\n".join(lines).strip("\n")))
+    output_stream = io.StringIO()
+
+    start = time.time()
+    apply_stream(model_path, input_stream, output_stream, batch_size=batch_size)
+    logging.info("* apply_stream: {:,} sequences in {:.2f}s".format(len(sequences), time.time() - start))
+
+    output_lines = output_stream.getvalue().split("\n")
+
+    # Two blank lines before and after the sequences, the output ending with a line break
+    if output_lines[:3].count("") != 2 or output_lines[-4:].count("") != 3:
+        raise Exception("Blank lines around the input were not written back")
+
+    labels = [[parts[-1] for parts in item] for item in TestData.iter_input_lines(output_lines) if item is not None]
+
+    if labels != reference_labels:
+        raise Exception("apply_stream does not give the same labels as the checkpoint tagger")
+
+
+def bench_vocabulary(embedding_file_path, corpus_file, top_k=None):
+    """
+    Check that a word2vec model loaded with a restricted vocabulary (words of a corpus file and K first words of the
+    embedding file) gives the same vectors as a full load for the kept words, in embedding file order, with the
+    padding vector first and the unknown token vector last. The restricted load is also checked through the
+    embedding cache.
+    :param embedding_file_path: word2vec file path
+    :param corpus_file: tabulated file whose words are kept
+    :param top_k: also keep the K first words of the embedding file
+    :return: nothing
+    """
+
+    from yaset.embed.word2vec import Word2VecEmbeddings, Word2VecReader
+
+    words = set(CorpusIndex(corpus_file, labelled=False).build().counts.get_normalized_token_counts(
+        TokenNormalizer()))
+
+    start = time.time()
+    full_object = Word2VecEmbeddings(embedding_file_path, "replace", None)
+    full_object.load_embedding()
+    logging.info("* full load: {:.3f}s, matrix={}".format(time.time() - start, full_object.embedding_matrix.shape))
+
+    start = time.time()
+    restricted_object = Word2VecEmbeddings(embedding_file_path, "replace", None)
+    restricted_object.restrict_vocabulary(words=words, top_k=top_k)
+    restricted_object.load_embedding()
+    restricted_object.build_unknown_token()
+    logging.info("* restricted load: {:.3f}s, matrix={}".format(time.time() - start,
+                                                                restricted_object.embedding_matrix.shape))
+
+    # Expected words: corpus words found in the embedding file and K first words (first occurrences)
+    expected_words = set([item for item in words if item in full_object.word_mapping and item != "pad_token"])
+
+    if top_k is not None:
+        for rank, word, _ in Word2VecReader(embedding_file_path).iter_vectors(keep=lambda word, rank: False):
+            if rank > top_k:
+                break
+
+            if word != "pad_token":
+                expected_words.add(word)
+
+    unknown_token_id = restricted_object.embedding_oov_map_token_id
+    matrix = restricted_object.embedding_matrix
+
+    kept_words = [item for item in restricted_object.word_mapping if item not in ["pad_token", unknown_token_id]]
+    kept_words.sort(key=lambda item: restricted_object.word_mapping[item])
+
+    logging.info("* kept words: {:,} (corpus words: {:,})".format(len(kept_words), len(words)))
+
+    if set(kept_words) != expected_words:
+        raise Exception("The restricted vocabulary does not hold the expected words")
+
+    if [restricted_object.word_mapping[item] for item in kept_words] != list(range(1, len(kept_words) + 1)):
+        raise Exception("The kept word rows are not contiguous")
+
+    if [full_object.word_mapping[item] for item in kept_words] != sorted([full_object.word_mapping[item]
+                                                                         for item in kept_words]):
+        raise Exception("The kept words are not in embedding file order")
+
+    if restricted_object.word_mapping["pad_token"] != 0 or \
+            restricted_object.word_mapping[unknown_token_id] != matrix.shape[0] - 1:
+        raise Exception("The padding or unknown token rows are misplaced")
+
+    for item in kept_words:
+        if not np.array_equal(matrix[restricted_object.word_mapping[item]],
+                              full_object.embedding_matrix[full_object.word_mapping[item]]):
+            raise Exception("The vectors differ for word: {}".format(item))
+
+    # Same restricted load through the embedding cache (cache miss, then cache hit)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for mode in ["cache miss", "cache hit"]:
+            cached_object = Word2VecEmbeddings(embedding_file_path, "replace", None)
+            cached_object.restrict_vocabulary(words=words, top_k=top_k)
+            cached_object.load_cached_embedding(os.path.join(cache_dir, "entry"))
+            cached_object.build_unknown_token()
+
+            if cached_object.word_mapping != restricted_object.word_mapping:
+                raise Exception("The word mappings differ ({})".format(mode))
+
+            if not np.array_equal(cached_object.embedding_matrix[1:-1], matrix[1:-1]):
+                raise Exception("The embedding matrices differ ({})".format(mode))
+
+
+def _legacy_load_embedding(embedding_object):
+    """
+    Former embedding loading: padding vector inserted with np.insert and unknown token vector appended with
+    np.append (float64 vectors, which promote the matrix to float64)
+    :param embedding_object: embedding object
+    :return: nothing
+    """
+
+    import gensim
+
+    if embedding_object.__class__.__name__ == "GensimEmbeddings":
+        gensim_obj = gensim.models.Word2Vec.load(embedding_object.embedding_file_path)
+    else:
+        try:
+            gensim_obj = gensim.models.KeyedVectors.load_word2vec_format(embedding_object.embedding_file_path)
+        except UnicodeDecodeError:
+            gensim_obj = gensim.models.KeyedVectors.load_word2vec_format(embedding_object.embedding_file_path,
+                                                                         binary=True)
+
+    embedding_object.embedding_matrix = gensim_obj.wv.syn0
+
+    for i, item in enumerate(gensim_obj.wv.index2word, start=1):
+        embedding_object.word_mapping[item] = i
+
+    pad_vector = np.random.rand(1, embedding_object.embedding_matrix.shape[1])
+    embedding_object.embedding_matrix = np.insert(embedding_object.embedding_matrix, 0, pad_vector, axis=0)
+    embedding_object.word_mapping["pad_token"] = 0
+
+    del gensim_obj
+
+    unknown_vector = np.random.rand(1, embedding_object.embedding_matrix.shape[1])
+    embedding_object.embedding_matrix = np.append(embedding_object.embedding_matrix, unknown_vector, axis=0)
+    embedding_object.word_mapping["##UNK##"] = embedding_object.embedding_matrix.shape[0] - 1
+
+
+def _get_current_rss():
+    """
+    Get the current resident set size of the process (Linux)
+    :return: RSS in bytes
+    """
+
+    with open("/proc/self/statm", "r") as input_file:
+        return int(input_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _load_embedding_child(args):
+    """
+    Load embeddings in a child process ('replace' OOV strategy) and measure loading time, peak RSS and the RSS
+    released once the matrix is not needed anymore (as done after the model initialization)
+    :param args: embedding class, embedding file path, loading mode, cache directory, number of first words kept
+    (restricted vocabulary mode)
+    :return: loading time, peak RSS increase (bytes), released RSS (bytes), matrix shape, matrix dtype, mapping
+    digest, matrix digest
+    """
+
+    import hashlib
+    import json
+    import resource
+
+    embedding_class, embedding_file_path, mode, cache_dir, top_k = args
+
+    embedding_object = embedding_class(embedding_file_path, "replace", None)
+
+    if mode == "restricted vocabulary":
+        embedding_object.restrict_vocabulary(top_k=top_k)
+
+    # ru_maxrss is in kilobytes on Linux
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+
+    if mode == "legacy":
+        _legacy_load_embedding(embedding_object)
+    else:
+        if mode in ["embedding file", "gzip file", "restricted vocabulary"]:
+            embedding_object.load_embedding()
+        else:
+            embedding_object.load_cached_embedding(cache_dir)
+
+        embedding_object.build_unknown_token()
+
+    load_time = time.time() - start
+    peak_rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) * 1024
+
+    matrix = embedding_object.embedding_matrix
+
+    # Padding and unknown token vectors are drawn at random on each load
+    mapping_digest = hashlib.sha1(json.dumps({k: v for k, v in embedding_object.word_mapping.items()
+                                              if v < matrix.shape[0] - 1}, sort_keys=True).encode("UTF-8"))
+    matrix_digest = hashlib.sha1(np.ascontiguousarray(matrix[1:-1], dtype=np.float32).tobytes())
+
+    shape, dtype = matrix.shape, str(matrix.dtype)
+    del matrix
+
+    rss = _get_current_rss()
+
+    # The former training code kept the matrix until the end of the run
+    if mode == "legacy":
+        embedding_object.embedding_matrix = None
+    else:
+        embedding_object.release_matrix()
+
+    released_rss = rss - _get_current_rss()
+
+    return load_time, peak_rss, released_rss, shape, dtype, mapping_digest.hexdigest(), matrix_digest.hexdigest()
+
+
+def bench_embeddings(embedding_file_path, embedding_model_type, top_k=None):
+    """
+    Compare loading time and peak RSS of the former embedding loading, of the preallocated loading and of the
+    memory-mapped embedding cache, then check that all give the same word mapping and matrix (padding and unknown
+    token vectors excepted). Word2vec files are also loaded from a gzip-compressed copy. Each loading is done in its
+    own process.
+    :param embedding_file_path: embedding model file path
+    :param embedding_model_type: embedding model type (e.g. 'gensim', 'word2vec')
+    :param top_k: also load the K first words only (restricted vocabulary, word2vec models)
+    :return: nothing
+    """
+
+    import gzip
+    import importlib
+    import multiprocessing
+    import shutil
+
+    from yaset.embed.store import compute_embedding_key
+
+    embedding_module = importlib.import_module("yaset.embed.{}".format(embedding_model_type))
+    embedding_class = getattr(embedding_module, "{}Embeddings".format(embedding_model_type.title()))
+
+    key = compute_embedding_key(embedding_file_path, embedding_model_type)
+
+    results = dict()
+
+    modes = ["legacy", "embedding file", "cache miss", "cache hit"]
+
+    if embedding_model_type == "word2vec" and not embedding_file_path.endswith(".gz"):
+        modes.append("gzip file")
+
+    if top_k is not None:
+        modes.append("restricted vocabulary")
+
+    with tempfile.TemporaryDirectory() as cache_root:
+        cache_dir = os.path.join(cache_root, key)
+        gzip_file_path = os.path.join(cache_root, "{}.gz".format(os.path.basename(embedding_file_path)))
+
+        if "gzip file" in modes:
+            with open(embedding_file_path, "rb") as input_file, gzip.open(gzip_file_path, "wb") as output_file:
+                shutil.copyfileobj(input_file, output_file)
+
+        # Sequential, the cache miss writes the entry read by the cache hit
+        for mode in modes:
+            file_path = gzip_file_path if mode == "gzip file" else embedding_file_path
+
+            with multiprocessing.get_context("fork").Pool(1) as pool:
+                results[mode] = pool.apply(_load_embedding_child, [(embedding_class, file_path, mode, cache_dir,
+                                                                    top_k)])
+
+    reference = results["legacy"]
+
+    for mode, (load_time, peak_rss, released_rss, shape, dtype, mapping_digest, matrix_digest) in results.items():
+        logging.info("* {}: {:.3f}s, peak RSS increase={:,.1f}MB, RSS released with the matrix={:,.1f}MB, "
+                     "matrix={} {}".format(mode, load_time, peak_rss / (1024 * 1024), released_rss / (1024 * 1024),
+                                           shape, dtype))
+
+        # The restricted vocabulary only holds a subset of the words
+        if mode == "restricted vocabulary":
+            continue
+
+        if mapping_digest != reference[5]:
+            raise Exception("The word mappings differ ({})".format(mode))
+
+        if matrix_digest != reference[6]:
+            raise Exception("The embedding matrices differ ({})".format(mode))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    subparsers = parser.add_subparsers(title="Sub-commands", description="Valid sub-commands",
+                                       help="Valid sub-commands", dest="subparser_name")
+
+    # Train file preprocessing benchmark
+    parser_reader = subparsers.add_parser('READER', help="Benchmark train file preprocessing")
+    parser_reader.add_argument("--sizes", help="Comma-separated corpus sizes (nb. sequences)", dest="sizes",
+                               type=str, default="25000,50000,100000,200000")
+
+    # Token normalization micro-benchmark
+    parser_normalize = subparsers.add_parser('NORMALIZE', help="Benchmark token normalization")
+    parser_normalize.add_argument("--nb-tokens", help="Number of tokens to normalize", dest="nb_tokens",
+                                  type=int, default=1000000)
+
+    # CRF loss equivalence check and benchmark
+    parser_crf = subparsers.add_parser('CRF', help="Check and benchmark the batched CRF loss")
+    parser_crf.add_argument("--batch-size", help="Mini-batch size", dest="batch_size", type=int, default=64)
+    parser_crf.add_argument("--max-len", help="Maximum sequence length", dest="max_len", type=int, default=50)
+    parser_crf.add_argument("--nb-classes", help="Number of labels", dest="nb_classes", type=int, default=17)
+    parser_crf.add_argument("--nb-steps", help="Number of timed steps", dest="nb_steps", type=int, default=50)
+
+    # Viterbi decoding equivalence check and benchmark
+    parser_viterbi = subparsers.add_parser('VITERBI', help="Check and benchmark the batched Viterbi decoder")
+    parser_viterbi.add_argument("--batch-size", help="Mini-batch size", dest="batch_size", type=int, default=64)
+    parser_viterbi.add_argument("--max-len", help="Maximum sequence length", dest="max_len", type=int, default=50)
+    parser_viterbi.add_argument("--nb-classes", help="Number of labels", dest="nb_classes", type=int, default=17)
+    parser_viterbi.add_argument("--nb-batches", help="Number of mini-batches", dest="nb_batches", type=int,
+                                default=100)
+
+    # Exported model equivalence check and benchmark
+    parser_export = subparsers.add_parser('EXPORT', help="Check and benchmark an exported model")
+    parser_export.add_argument("--model-path", help="Path to the model", dest="model_path", type=str, required=True)
+    parser_export.add_argument("--input-file", help="Tabulated test file", dest="input_file", type=str,
+                               required=True)
+    parser_export.add_argument("--batch-size", help="Mini-batch size", dest="batch_size", type=int, default=64)
+    parser_export.add_argument("--keep-top-k", help="Also benchmark an export keeping the K first words",
+                               dest="top_k", type=int, default=None)
+
+    # Streaming mode and Python iterator API check
+    parser_stream = subparsers.add_parser('STREAM', help="Check the streaming mode and the Python iterator API")
+    parser_stream.add_argument("--model-path", help="Path to the model", dest="model_path", type=str, required=True)
+    parser_stream.add_argument("--input-file", help="Tabulated test file", dest="input_file", type=str,
+                               required=True)
+    parser_stream.add_argument("--batch-size", help="Mini-batch size", dest="batch_size", type=int, default=64)
+
+    # Embedding cache benchmark
+    parser_embed = subparsers.add_parser('EMBED', help="Check and benchmark the embedding cache")
+    parser_embed.add_argument("--embedding-file", help="Embedding model file", dest="embedding_file", type=str,
+                              required=True)
+    parser_embed.add_argument("--embedding-type", help="Embedding model type", dest="embedding_type", type=str,
+                              choices=["gensim", "word2vec"], default="word2vec")
+    parser_embed.add_argument("--keep-top-k", help="Also benchmark loading the K first words only (word2vec)",
+                              dest="top_k", type=int, default=None)
+
+    # Restricted embedding vocabulary check
+    parser_vocab = subparsers.add_parser('VOCAB', help="Check loading a word2vec model with a restricted vocabulary")
+    parser_vocab.add_argument("--embedding-file", help="Word2vec file", dest="embedding_file", type=str,
+                              required=True)
+    parser_vocab.add_argument("--corpus-file", help="Tabulated file whose words are kept", dest="corpus_file",
+                              type=str, required=True)
+    parser_vocab.add_argument("--keep-top-k", help="Also keep the K first words of the embedding file",
+                              dest="top_k", type=int, default=None)
+
+    args = parser.parse_args()
+
+    # Logging to stdout
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.subparser_name == "READER":
+
+        logging.info("Starting train file preprocessing benchmark")
+        bench_reader([int(item) for item in args.sizes.split(",")])
+
+    elif args.subparser_name == "NORMALIZE":
+
+        logging.info("Starting token normalization benchmark")
+        bench_normalize(args.nb_tokens)
+
+    elif args.subparser_name == "CRF":
+
+        logging.info("Starting CRF loss benchmark")
+        bench_crf(args.batch_size, args.max_len, args.nb_classes, args.nb_steps)
+
+    elif args.subparser_name == "VITERBI":
+
+        logging.info("Starting Viterbi decoding benchmark")
+        bench_viterbi(args.batch_size, args.max_len, args.nb_classes, args.nb_batches)
+
+    elif args.subparser_name == "EXPORT":
+
+        logging.info("Starting exported model benchmark")
+        bench_export(os.path.abspath(args.model_path), os.path.abspath(args.input_file), args.batch_size,
+                     top_k=args.top_k)
+
+    elif args.subparser_name == "STREAM":
+
+        logging.info("Starting streaming mode check")
+        bench_stream(os.path.abspath(args.model_path), os.path.abspath(args.input_file), args.batch_size)
+
+    elif args.subparser_name == "EMBED":
+
+        logging.info("Starting embedding cache benchmark")
+        bench_embeddings(os.path.abspath(args.embedding_file), args.embedding_type, top_k=args.top_k)
+
+    elif args.subparser_name == "VOCAB":
+
+        logging.info("Starting restricted vocabulary check")
+        bench_vocabulary(os.path.abspath(args.embedding_file), os.path.abspath(args.corpus_file), top_k=args.top_k)
@@ -1,16 +1,340 @@
+import collections
 import configparser
+import glob
 import logging
+import multiprocessing
 import os
 
+import numpy as np
 import pkg_resources
 
-from .data.reader import TestData
+from .data.reader import StatsCorpus, TestData, log_batch_padding
 from .helpers.config import extract_params
 from .tools import ensure_dir, log_message
-from .nn.test import test_model
+from .nn.tagger import Tagger
+from .nn.test import iter_tagged_windows, test_model, write_tagged_window
 
 
-def apply_model(model_path, input_file, working_dir, timestamp):
+def get_auto_thread_counts(nb_cores=None):
+    """
+    Compute APPLY thread counts from the number of CPU cores: TensorFlow operations use all cores, the two
+    directions of the BiLSTM run in parallel and one core out of four decodes input examples
+    :param nb_cores: number of CPU cores (detected if None)
+    :return: intra-op threads, inter-op threads, input pipeline threads
+    """
+
+    if nb_cores is None:
+        nb_cores = multiprocessing.cpu_count()
+
+    return nb_cores, min(2, nb_cores), max(1, nb_cores // 4)
+
+
+def resolve_thread_counts(thread_values, default_value, nb_cores=None):
+    """
+    Resolve thread counts: 'auto' values depend on the number of cores, missing values fall back to a default
+    :param thread_values: intra-op, inter-op and input pipeline thread counts (int, 'auto' or None)
+    :param default_value: default thread count (usually 'cpu_cores' from the model configuration)
+    :param nb_cores: number of CPU cores used for 'auto' values (detected if None)
+    :return: list of thread counts
+    """
+
+    thread_counts = list()
+
+    for value, auto_value in zip(thread_values, get_auto_thread_counts(nb_cores=nb_cores)):
+        if value == "auto":
+            thread_counts.append(auto_value)
+        elif value is None:
+            thread_counts.append(default_value)
+        else:
+            thread_counts.append(int(value))
+
+    return thread_counts
+
+
+def load_model_params(model_path):
+    """
+    Extract data, training and model parameters from the configuration file stored with a model
+    :param model_path: yaset model path
+    :return: data parameters, training parameters, model parameters
+    """
+
+    # Load config file used during training
+    parsed_configuration = configparser.ConfigParser()
+    parsed_configuration.read(os.path.join(model_path, "config.ini"))
+
+    # Computing parameter description file paths
+    training_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/TRAINING_PARAMS_DESC.json')
+    data_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/DATA_PARAMS_DESC.json')
+    bilstmcharcrf_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/BILSTMCHARCRF_PARAMS_DESC.json')
+
+    # Extracting parameters from configuration file according to parameter description files
+    data_params = extract_params(parsed_configuration["data"], data_param_desc_file)
+    training_params = extract_params(parsed_configuration["training"], training_param_desc_file)
+    if training_params["model_type"] == "bilstm-char-crf":
+        model_params = extract_params(parsed_configuration["bilstm-char-crf"], bilstmcharcrf_param_desc_file)
+    else:
+        raise Exception("The model type you specified does not exist: {}".format(training_params["model_type"]))
+
+    return data_params, training_params, model_params
+
+
+def apply_model(model_path, input_file, working_dir, timestamp, sort_by_length=True, batch_size=64,
+                intra_op_threads=None, inter_op_threads=None, pipeline_threads=None, in_memory=False, nb_workers=1):
+    """
+    Apply a model on a test file
+    :param model_path: yaset model path
+    :param input_file: test file path
+    :param working_dir: directory where the timestamped working directory will be created
+    :param timestamp: run timestamp
+    :param sort_by_length: batch sequences by increasing length
+    :param batch_size: inference mini-batch size
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :param pipeline_threads: parallel example decoding calls (int, 'auto' or None for cpu_cores)
+    :param in_memory: read the input file once and feed padded NumPy batches, without TFRecords files
+    :param nb_workers: number of worker processes tagging shards of the input file in memory mode (thread counts
+    are per worker, the available cores being shared between workers by default)
+    :return: nothing
+    """
+
+    current_working_directory = _create_working_dir(working_dir, timestamp)
+
+    log_message("BEGIN - LOADING AND CHECKING DATA FILES")
+
+    data = TestData(input_file, working_dir=current_working_directory, train_model_path=model_path)
+
+    # In memory mode, the input file is checked while it is processed (workers need the file index to split it)
+    if not in_memory or nb_workers > 1:
+        data.check_input_file()
+
+    log_message("END - LOADING AND CHECKING DATA FILES")
+
+    if not in_memory and nb_workers == 1:
+        log_message("BEGIN - CREATING TFRECORDS FILES")
+
+        target_tfrecords_dir_path = os.path.join(os.path.abspath(current_working_directory), "tfrecords")
+        ensure_dir(target_tfrecords_dir_path)
+
+        data.convert_to_tfrecords(input_file, target_tfrecords_dir_path, sort_by_length=sort_by_length)
+
+        log_message("END - CREATING TFRECORDS FILES")
+
+    logging.info("{} BEGIN - APPLYING MODEL {}".format("=" * 10, "=" * 36))
+
+    data_params, training_params, model_params = load_model_params(model_path)
+
+    if nb_workers > 1:
+        # Cores are shared between workers
+        thread_counts = resolve_thread_counts([intra_op_threads, inter_op_threads, pipeline_threads],
+                                              max(1, training_params["cpu_cores"] // nb_workers),
+                                              nb_cores=max(1, multiprocessing.cpu_count() // nb_workers))
+
+        logging.info("* workers: {}".format(nb_workers))
+    else:
+        thread_counts = resolve_thread_counts([intra_op_threads, inter_op_threads, pipeline_threads],
+                                              training_params["cpu_cores"])
+
+    logging.info("* batch size: {}".format(batch_size))
+    logging.info("* threads: intra-op={} inter-op={} input pipeline={}".format(*thread_counts))
+
+    test_model(current_working_directory, model_path, data, data_params, training_params, model_params,
+               batch_size=batch_size, intra_op_threads=thread_counts[0], inter_op_threads=thread_counts[1],
+               pipeline_threads=thread_counts[2], in_memory=in_memory, sort_by_length=sort_by_length,
+               nb_workers=nb_workers)
+
+    log_message("END - APPLYING MODEL")
+
+
+def collect_input_files(input_dir=None, input_glob=None, manifest=None):
+    """
+    List the input files of a batch APPLY run, from a directory (all files, recursively), a glob pattern or a
+    manifest file (one path per line, relative paths being relative to the manifest directory)
+    :param input_dir: input directory
+    :param input_glob: glob pattern (** matches sub-directories)
+    :param manifest: manifest file path
+    :return: list of absolute file paths (sorted, duplicates removed), root directory used to mirror paths
+    """
+
+    if input_dir is not None:
+        root = os.path.abspath(input_dir)
+
+        input_files = list()
+
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                input_files.append(os.path.join(dir_path, file_name))
+
+        input_files.sort()
+
+    else:
+        if input_glob is not None:
+            input_files = sorted([os.path.abspath(item) for item in glob.glob(input_glob, recursive=True)
+                                  if os.path.isfile(item)])
+        else:
+            manifest_dir = os.path.dirname(os.path.abspath(manifest))
+
+            input_files = list()
+
+            with open(os.path.abspath(manifest), "r", encoding="UTF-8") as input_file:
+                for line in input_file:
+                    line = line.strip()
+
+                    if line == "" or line.startswith("#"):
+                        continue
+
+                    input_files.append(os.path.abspath(os.path.join(manifest_dir, line)))
+
+            for item in input_files:
+                if not os.path.isfile(item):
+                    raise FileNotFoundError("A file listed in the manifest does not exist: {}".format(item))
+
+        # Removing duplicates, keeping the first occurrence
+        input_files = list(collections.OrderedDict.fromkeys(input_files))
+
+        if len(input_files) > 0:
+            root = os.path.commonpath([os.path.dirname(item) for item in input_files])
+        else:
+            root = None
+
+    return input_files, root
+
+
+def apply_model_batch(model_path, input_files, input_root, working_dir, timestamp, sort_by_length=True,
+                      batch_size=64, intra_op_threads=None, inter_op_threads=None, window_batches=16):
+    """
+    Apply a model on many test files, loading the model once. Sequences from consecutive files are packed into
+    shared mini-batches and predictions are written to paths mirroring the input paths.
+    :param model_path: yaset model path
+    :param input_files: list of test file paths
+    :param input_root: directory of input files, mirrored in the output directory
+    :param working_dir: directory where the timestamped working directory will be created
+    :param timestamp: run timestamp
+    :param sort_by_length: batch sequences by increasing length (within windows of 'window_batches' mini-batches)
+    :param batch_size: inference mini-batch size
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :param window_batches: number of mini-batches per window
+    :return: nothing
+    """
+
+    current_working_directory = _create_working_dir(working_dir, timestamp)
+
+    target_output_dir = os.path.join(current_working_directory, "output")
+    ensure_dir(target_output_dir)
+
+    logging.info("* nb. input files: {:,}".format(len(input_files)))
+    logging.info("* input root: {}".format(input_root))
+    logging.info("* output directory: {}".format(target_output_dir))
+
+    log_message("BEGIN - LOADING MODEL")
+
+    data, tagger = load_tagger(model_path, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    log_message("END - LOADING MODEL")
+
+    logging.info("{} BEGIN - APPLYING MODEL {}".format("=" * 10, "=" * 36))
+
+    logging.info("* batch size: {}".format(batch_size))
+
+    # Index of the file each item (sequence or blank line) comes from, consumed in the same order as predictions
+    item_file_ids = collections.deque()
+
+    items = _iter_file_items(input_files, item_file_ids)
+
+    padding = np.zeros(4, dtype=np.int64)
+
+    counter = 0
+
+    current_file_id = -1
+    output_file = None
+
+    try:
+        for tagged_window in iter_tagged_windows(tagger, data, items, data.test_stats, padding=padding,
+                                                 batch_size=batch_size, sort_by_length=sort_by_length,
+                                                 window_batches=window_batches):
+            for tokens, predictions in tagged_window:
+                file_id = item_file_ids.popleft()
+
+                # Opening the output files of the next input file (and of empty input files in between)
+                while current_file_id < file_id:
+                    if output_file is not None:
+                        output_file.close()
+
+                    current_file_id += 1
+                    output_file = _open_mirrored_file(input_files[current_file_id], input_root, target_output_dir)
+
+                    if current_file_id > 0 and current_file_id % 1000 == 0:
+                        logging.info("* processed files={:,}".format(current_file_id))
+
+                counter += write_tagged_window(data, output_file, [(tokens, predictions)])
+
+        # Creating the output files of trailing empty input files
+        while current_file_id < len(input_files) - 1:
+            if output_file is not None:
+                output_file.close()
+
+            current_file_id += 1
+            output_file = _open_mirrored_file(input_files[current_file_id], input_root, target_output_dir)
+
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+        tagger.close()
+
+    logging.info("* processed files={:,}, sequences={:,}".format(len(input_files), counter))
+
+    data.test_stats.nb_instances = counter
+
+    # Input files may all be empty
+    if data.test_stats.nb_words > 0:
+        data.test_stats.log_stats()
+
+        if sort_by_length:
+            log_batch_padding(int(padding[2]), int(padding[3]), int(padding[0]), int(padding[1]))
+        else:
+            log_batch_padding(int(padding[2]), int(padding[3]))
+
+    log_message("END - APPLYING MODEL")
+
+
+def _iter_file_items(input_files, item_file_ids):
+    """
+    Read input files one after the other
+    :param input_files: list of test file paths
+    :param item_file_ids: deque where the file index of each yielded item is appended
+    :return: generator of sequences (token part lists) and blank lines (None)
+    """
+
+    for file_id, file_path in enumerate(input_files):
+        with open(file_path, "r", encoding="UTF-8") as input_file:
+            for item in TestData.iter_input_lines(input_file, source=file_path):
+                item_file_ids.append(file_id)
+                yield item
+
+
+def _open_mirrored_file(input_file, input_root, target_output_dir):
+    """
+    Open the output file mirroring an input file
+    :param input_file: input file path
+    :param input_root: input root directory
+    :param target_output_dir: output root directory
+    :return: opened file
+    """
+
+    target_file = os.path.join(target_output_dir, os.path.relpath(input_file, input_root))
+    ensure_dir(os.path.dirname(target_file))
+
+    return open(target_file, "w", encoding="UTF-8")
+
+
+def _create_working_dir(working_dir, timestamp):
+    """
+    Create the timestamped working directory of an APPLY run and log to a file in it
+    :param working_dir: directory where the timestamped working directory will be created
+    :param timestamp: run timestamp
+    :return: working directory path
+    """
 
     # Creating working directory
     current_working_directory = os.path.join(working_dir, "yaset-apply-{}".format(timestamp))
@@ -29,41 +353,124 @@ def apply_model(model_path, input_file, working_dir, timestamp):
     fh.setFormatter(log_format)
     log.addHandler(fh)
 
-    log_message("BEGIN - LOADING AND CHECKING DATA FILES")
+    return current_working_directory
 
-    data = TestData(input_file, working_dir=current_working_directory, train_model_path=model_path)
 
-    data.check_input_file()
+def load_tagger(model_path, intra_op_threads=None, inter_op_threads=None):
+    """
+    Load a model and keep it in memory
+    :param model_path: yaset model path
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :return: TestData object, Tagger object
+    """
 
-    log_message("END - LOADING AND CHECKING DATA FILES")
+    data = TestData(None, train_model_path=model_path)
+
+    data_params, training_params, model_params = load_model_params(model_path)
+
+    thread_counts = resolve_thread_counts([intra_op_threads, inter_op_threads, None], training_params["cpu_cores"])
+
+    logging.info("* threads: intra-op={} inter-op={}".format(thread_counts[0], thread_counts[1]))
 
-    log_message("BEGIN - CREATING TFRECORDS FILES")
+    tagger = Tagger(model_path, data, training_params, model_params, intra_op_threads=thread_counts[0],
+                    inter_op_threads=thread_counts[1])
 
-    target_tfrecords_file_path = os.path.join(os.path.abspath(current_working_directory), "data.tfrecords")
+    return data, tagger
 
-    data.convert_to_tfrecords(input_file, target_tfrecords_file_path)
 
-    log_message("END - CREATING TFRECORDS FILES")
+def apply_stream(model_path, input_stream, output_stream, batch_size=64, intra_op_threads=None,
+                 inter_op_threads=None):
+    """
+    Tag tabulated sequences read from a stream (e.g. stdin) and write them to another stream (e.g. stdout). Each
+    mini-batch is written and flushed as soon as it is tagged, only one mini-batch is kept in memory.
+    :param model_path: yaset model path
+    :param input_stream: iterable of tabulated lines
+    :param output_stream: writable text stream
+    :param batch_size: inference mini-batch size
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :return: nothing
+    """
+
+    log_message("BEGIN - LOADING MODEL")
+
+    data, tagger = load_tagger(model_path, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    log_message("END - LOADING MODEL")
 
     logging.info("{} BEGIN - APPLYING MODEL {}".format("=" * 10, "=" * 36))
 
-    # Load config file used during training
-    parsed_configuration = configparser.ConfigParser()
-    parsed_configuration.read(os.path.join(model_path, "config.ini"))
+    logging.info("* batch size: {}".format(batch_size))
 
-    # Computing parameter description file paths
-    training_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/TRAINING_PARAMS_DESC.json')
-    data_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/DATA_PARAMS_DESC.json')
-    bilstmcharcrf_param_desc_file = pkg_resources.resource_filename('yaset', 'desc/BILSTMCHARCRF_PARAMS_DESC.json')
+    items = TestData.iter_input_lines(input_stream, source="stdin")
+    stats = StatsCorpus(name="STREAM")
 
-    # Extracting parameters from configuration file according to parameter description files
-    data_params = extract_params(parsed_configuration["data"], data_param_desc_file)
-    training_params = extract_params(parsed_configuration["training"], training_param_desc_file)
-    if training_params["model_type"] == "bilstm-char-crf":
-        model_params = extract_params(parsed_configuration["bilstm-char-crf"], bilstmcharcrf_param_desc_file)
-    else:
-        raise Exception("The model type you specified does not exist: {}".format(training_params["model_type"]))
+    nb_sequences = 0
+    nb_unknown_words = 0
+
+    try:
+        for tagged_window in iter_tagged_windows(tagger, data, items, stats, batch_size=batch_size):
+            nb_sequences += write_tagged_window(data, output_stream, tagged_window)
+            output_stream.flush()
 
-    test_model(current_working_directory, model_path, data, data_params, training_params, model_params)
+            # Only counts are kept to bound memory usage
+            nb_unknown_words += len(stats.unknown_words)
+            stats.unknown_words.clear()
+            stats.sequence_lengths.clear()
+    finally:
+        tagger.close()
+
+    logging.info("* nb. sequences: {:,}".format(nb_sequences))
+    logging.info("* nb. tokens: {:,}".format(stats.nb_words))
+    logging.info("* nb. true unknown tokens: {:,}".format(nb_unknown_words))
 
     log_message("END - APPLYING MODEL")
+
+
+def tag_sequences(model_path, sequences, batch_size=64, intra_op_threads=None, inter_op_threads=None):
+    """
+    Tag sequences from any iterable. The model is loaded when iteration starts and released when it ends. Labels
+    are yielded in input order, one mini-batch at a time, so that arbitrarily long iterables can be processed.
+    :param model_path: yaset model path
+    :param sequences: iterable of sequences, a sequence being a list of tokens and a token being a string or a list
+    of column values (empty sequences get empty label lists)
+    :param batch_size: inference mini-batch size
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :return: generator of label lists
+    """
+
+    data, tagger = load_tagger(model_path, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    min_columns = max(data.feature_columns) + 1 if data.feature_columns else 1
+
+    items = (_to_token_parts(sequence, min_columns) for sequence in sequences)
+    stats = StatsCorpus(name="STREAM")
+
+    try:
+        for tagged_window in iter_tagged_windows(tagger, data, items, stats, batch_size=batch_size):
+            for _, predictions in tagged_window:
+                yield [data.inv_label_mapping[label] for label in predictions]
+
+            stats.unknown_words.clear()
+            stats.sequence_lengths.clear()
+    finally:
+        tagger.close()
+
+
+def _to_token_parts(sequence, min_columns):
+    """
+    Convert a sequence given to tag_sequences to token part lists, checking the number of columns
+    :param sequence: list of tokens, a token being a string or a list of column values
+    :param min_columns: minimum number of columns (token column and feature columns)
+    :return: list of token part lists
+    """
+
+    tokens = [[item] if isinstance(item, str) else list(item) for item in sequence]
+
+    for token in tokens:
+        if len(token) < min_columns:
+            raise Exception("Each token must have at least {} column(s)".format(min_columns))
+
+    return tokens
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from ..embed.store import get_embedding_file_stats
+
+# Increment when the content of the preprocessing cache changes
+PREPROC_CACHE_VERSION = 2
+
+PREPROC_CACHE_DIRNAME = "yaset-preproc-cache"
+PREPROC_CACHE_FILENAME = "preprocessing.json"
+
+# Data parameters which do not change the preprocessing output (file contents or stats are hashed instead)
+_IGNORED_DATA_PARAMS = {"working_dir", "train_file_path", "dev_file_path", "embedding_model_path",
+                        "embedding_vocabulary_files"}
+
+
+def file_fingerprint(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-1 digest of a file content
+    :param file_path: file path
+    :param chunk_size: read size
+    :return: hexadecimal digest
+    """
+
+    sha1 = hashlib.sha1()
+
+    with open(os.path.abspath(file_path), "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def compute_preprocessing_key(data_params, nb_processes):
+    """
+    Compute the preprocessing cache key from the train/dev file contents, the embedding file stats (as for the
+    embedding cache, multi-GB models are not read, see get_embedding_file_stats), the files used to restrict the
+    embedding vocabulary and the preprocessing parameters
+    :param data_params: 'data' section parameters
+    :param nb_processes: number of TFRecords writer processes (changes sharding and singleton replacement)
+    :return: cache key
+    """
+
+    payload = {
+        "version": PREPROC_CACHE_VERSION,
+        "params": {k: v for k, v in data_params.items() if k not in _IGNORED_DATA_PARAMS},
+        "train_file": file_fingerprint(data_params.get("train_file_path")),
+        "dev_file": None,
+        "embedding_files": get_embedding_file_stats(data_params.get("embedding_model_path")),
+        "vocabulary_files": [file_fingerprint(item) for item in get_vocabulary_files(data_params)],
+        "nb_processes": nb_processes
+    }
+
+    if data_params.get("dev_file_use"):
+        payload["dev_file"] = file_fingerprint(data_params.get("dev_file_path"))
+
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def is_preprocessing_reproducible(data_params):
+    """
+    Check if the preprocessing output only depends on the cache key. The random train/dev split and the singleton
+    replacement ('replace' OOV strategy) use the random seed, which is only set for random splits with
+    'dev_random_seed_use' enabled. Without a seed, each run draws a different split or replacements.
+    :param data_params: 'data' section parameters
+    :return: boolean
+    """
+
+    if not data_params.get("dev_file_use") and data_params.get("dev_random_seed_use"):
+        return True
+
+    return data_params.get("dev_file_use") and data_params.get("embedding_oov_strategy") != "replace"
+
+
+def get_vocabulary_files(data_params):
+    """
+    Get the additional files whose tokens are kept when the embedding vocabulary is restricted to the corpus
+    :param data_params: 'data' section parameters
+    :return: list of absolute file paths
+    """
+
+    if not data_params.get("embedding_corpus_vocabulary"):
+        return list()
+
+    return [os.path.abspath(item.strip()) for item in data_params.get("embedding_vocabulary_files").split(",")
+            if item.strip() != ""]
+
+
+def get_preprocessing_cache_dir(working_dir, key):
+    """
+    Compute the cache directory path for a given key
+    :param working_dir: top working directory
+    :param key: cache key
+    :return: directory path
+    """
+
+    return os.path.join(os.path.abspath(working_dir), PREPROC_CACHE_DIRNAME, key)
+
+
+def is_preprocessing_cached(cache_dir):
+    """
+    Check if a complete preprocessing cache entry exists
+    :param cache_dir: cache directory
+    :return: boolean
+    """
+
+    return os.path.isfile(os.path.join(cache_dir, PREPROC_CACHE_FILENAME))
+
+
+def commit_preprocessing_cache(temp_dir, cache_dir):
+    """
+    Move a freshly written cache entry to its final location. If a concurrent run already created the
+    entry, the temporary one is discarded.
+    :param temp_dir: temporary cache directory
+    :param cache_dir: final cache directory
+    :return: nothing
+    """
+
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        if not is_preprocessing_cached(cache_dir):
+            raise
+
+        logging.info("Preprocessing cache entry created by another run, discarding this one")
+        shutil.rmtree(temp_dir, ignore_errors=True)
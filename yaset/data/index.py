@@ -0,0 +1,254 @@
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+
+
+class CorpusCounts:
+    """
+    Token, label and feature value counts gathered over a group of sequences
+    """
+
+    def __init__(self, feature_columns):
+
+        self.feature_columns = list(feature_columns)
+
+        self.tokens = Counter()
+        self.labels = Counter()
+        self.features = dict()
+
+        for col in self.feature_columns:
+            self.features[col] = Counter()
+
+    def update(self, sequence, labelled=True):
+        """
+        Add the tokens of one sequence to the counts
+        :param sequence: list of token parts (one list of columns per token)
+        :param labelled: True if the last column contains the label
+        :return: nothing
+        """
+
+        for parts in sequence:
+            self.tokens[parts[0]] += 1
+
+            if labelled:
+                self.labels[parts[-1]] += 1
+
+            for col in self.feature_columns:
+                self.features[col][parts[col]] += 1
+
+    def __sub__(self, other):
+        """
+        Remove the counts of a subset of sequences. Keys whose count drops to zero are discarded.
+        :param other: counts computed on a subset of the sequences
+        :return: new CorpusCounts object
+        """
+
+        counts = CorpusCounts(self.feature_columns)
+
+        counts.tokens = self.tokens - other.tokens
+        counts.labels = self.labels - other.labels
+
+        for col in self.feature_columns:
+            counts.features[col] = self.features[col] - other.features[col]
+
+        return counts
+
+    def get_normalized_token_counts(self, normalizer):
+        """
+        Aggregate raw token counts on their normalized form
+        :param normalizer: TokenNormalizer object
+        :return: Counter of normalized tokens
+        """
+
+        normalized_counts = Counter()
+
+        for token, count in self.tokens.items():
+            normalized_counts[normalizer.normalize(token)] += count
+
+        return normalized_counts
+
+    def get_char_set(self, normalizer):
+        """
+        Compute the set of characters appearing in the tokens
+        :param normalizer: TokenNormalizer object
+        :return: set of characters
+        """
+
+        char_set = set()
+
+        for token in self.tokens:
+            char_set.update(token)
+
+        return set(normalizer.normalize_chars("".join(char_set)))
+
+
+class CorpusIndex:
+    """
+    Index of a tabulated data file built in one pass: byte offset and length of every sequence plus
+    token, label and feature value counts. Sequences can then be read back individually without
+    rescanning the file.
+    """
+
+    def __init__(self, data_file, feature_columns=None, labelled=True):
+
+        self.data_file = os.path.abspath(data_file)
+        self.feature_columns = list(feature_columns) if feature_columns else list()
+
+        # Test files do not need a label column
+        self.labelled = labelled
+
+        # Byte offset, number of tokens and longest token size (in characters) of each sequence
+        self.offsets = list()
+        self.lengths = list()
+        self.char_lengths = list()
+
+        self.column_nb = None
+
+        self.counts = CorpusCounts(self.feature_columns)
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    def build(self):
+        """
+        Parse the data file, check its format and gather sequence offsets and counts
+        :return: self
+        """
+
+        min_columns = 2 if self.labelled else 1
+
+        current_sequence = list()
+        current_offset = 0
+        position = 0
+
+        with open(self.data_file, "rb") as input_file:
+
+            for i, line in enumerate(input_file, start=1):
+
+                line_offset = position
+                position += len(line)
+
+                # Line endings are stripped as in text mode (universal newlines, CRLF files are accepted)
+                line = line.rstrip(b"\r\n")
+
+                if line == b"":
+                    if len(current_sequence) > 0:
+                        self._add_sequence(current_offset, current_sequence)
+                        current_sequence.clear()
+
+                    continue
+
+                if len(current_sequence) == 0:
+                    current_offset = line_offset
+
+                parts = line.decode("UTF-8").split("\t")
+
+                # Raising exception if all lines do not have the same number of columns or
+                # if the number of columns is below the minimum
+                if self.column_nb is None:
+                    self.column_nb = len(parts)
+
+                if len(parts) != self.column_nb or len(parts) < min_columns:
+                    raise Exception("Error reading the input file at line {}: {}".format(i, self.data_file))
+
+                current_sequence.append(parts)
+
+            # End of file, adding information about the last sequence if necessary
+            if len(current_sequence) > 0:
+                self._add_sequence(current_offset, current_sequence)
+
+        # Compacting offsets and lengths
+        self.offsets = np.array(self.offsets, dtype=np.int64)
+        self.lengths = np.array(self.lengths, dtype=np.int64)
+        self.char_lengths = np.array(self.char_lengths, dtype=np.int64)
+
+        return self
+
+    def _add_sequence(self, offset, sequence):
+
+        self.offsets.append(offset)
+        self.lengths.append(len(sequence))
+        self.char_lengths.append(max([len(parts[0]) for parts in sequence]))
+        self.counts.update(sequence, labelled=self.labelled)
+
+    def iter_sequences(self, selection=None):
+        """
+        Iterate over the sequences of the data file, in file order for boolean masks or in the given order for
+        arrays of sequence indexes
+        :param selection: boolean mask over the sequences or array of sequence indexes (all sequences if None)
+        :return: generator of (sequence index, list of token parts)
+        """
+
+        if selection is None:
+            indexes = range(len(self.offsets))
+        elif np.asarray(selection).dtype == bool:
+            indexes = np.flatnonzero(selection)
+        else:
+            indexes = selection
+
+        with open(self.data_file, "rb") as input_file:
+            for sequence_id in indexes:
+
+                input_file.seek(self.offsets[sequence_id])
+
+                sequence = list()
+                for _ in range(self.lengths[sequence_id]):
+                    sequence.append(input_file.readline().rstrip(b"\r\n").decode("UTF-8").split("\t"))
+
+                yield int(sequence_id), sequence
+
+    def get_length_order(self):
+        """
+        Compute the sequence order by increasing number of tokens, then by increasing longest token size
+        (ties are kept in file order)
+        :return: array of sequence indexes
+        """
+
+        return np.lexsort((np.arange(len(self.lengths)), self.char_lengths, self.lengths))
+
+    def get_counts(self, selection):
+        """
+        Compute counts over a subset of the sequences
+        :param selection: boolean mask over the sequences
+        :return: CorpusCounts object
+        """
+
+        counts = CorpusCounts(self.feature_columns)
+
+        for _, sequence in self.iter_sequences(selection):
+            counts.update(sequence, labelled=self.labelled)
+
+        return counts
+
+    def log_stats(self):
+
+        logging.info("* format: OK")
+        logging.info("* nb. sequences: {:,}".format(len(self.lengths)))
+        logging.info("* average sequence length: {:,.3f} (min={:,} max={:,} std={:,.3f})".format(
+            np.mean(self.lengths),
+            np.min(self.lengths),
+            np.max(self.lengths),
+            np.std(self.lengths)
+        ))
+        logging.info("* nb. tokens (col. #0): {:,} (unique={:,})".format(
+            sum(self.counts.tokens.values()),
+            len(self.counts.tokens)
+        ))
+        for i, (col, val_dict) in enumerate(self.counts.features.items(), start=1):
+            nb_attributes = sum(val_dict.values())
+            logging.info("* nb. att. {} (col. #{}): {:,}".format(
+                i,
+                col,
+                len(val_dict)
+            ))
+            for k, v in val_dict.items():
+                logging.debug("-> {}: {:,} ({:.3f}%)".format(k, v, (v / nb_attributes) * 100))
+
+        if self.labelled:
+            logging.info("* nb. labels (col. #{}): {:,}".format(self.column_nb - 1, len(self.counts.labels)))
+            nb_labels = sum(self.counts.labels.values())
+            for k, v in self.counts.labels.items():
+                logging.debug("-> {}: {:,} ({:.3f}%)".format(k, v, (v / nb_labels) * 100))
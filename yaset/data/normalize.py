@@ -0,0 +1,74 @@
+import re
+from functools import lru_cache
+
+# Compiled once, matches the same characters as the "\d" pattern applied so far
+DIGIT_PATTERN = re.compile("\\d")
+
+
+class TokenNormalizer:
+    """
+    Token normalization shared by train and test data. Normalized forms and character IDs are cached
+    (LRU keyed by raw token) as the same tokens occur over and over in a corpus.
+    """
+
+    def __init__(self, lower_input=False, replace_digits=False, char_mapping=None, cache_size=500000):
+
+        self.lower_input = lower_input
+        self.replace_digits = replace_digits
+
+        self.char_mapping = dict()
+        self.cache_size = cache_size
+
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+        self.get_char_ids = lru_cache(maxsize=cache_size)(self._get_char_ids)
+
+        if char_mapping:
+            self.set_char_mapping(char_mapping)
+
+    def set_char_mapping(self, char_mapping):
+        """
+        Set the character mapping used to compute character IDs and clear the character ID cache
+        :param char_mapping: character mapping
+        :return: nothing
+        """
+
+        self.char_mapping = char_mapping
+        self.get_char_ids.cache_clear()
+
+    def _normalize(self, token):
+        """
+        Normalize a token before word embedding lookup (lowercasing and digit replacement)
+        :param token: raw token
+        :return: normalized token
+        """
+
+        if self.lower_input:
+            token = token.lower()
+
+        if self.replace_digits:
+            token = DIGIT_PATTERN.sub("0", token)
+
+        return token
+
+    def normalize_chars(self, token):
+        """
+        Normalize a token before character lookup (digit replacement only)
+        :param token: raw token
+        :return: normalized token
+        """
+
+        if self.replace_digits:
+            return DIGIT_PATTERN.sub("0", token)
+
+        return token
+
+    def _get_char_ids(self, token):
+        """
+        Compute the IDs of the token characters. Characters absent from the mapping are skipped.
+        :param token: raw token
+        :return: tuple of character IDs
+        """
+
+        char_mapping = self.char_mapping
+
+        return tuple([char_mapping[c] for c in self.normalize_chars(token) if c in char_mapping])
@@ -1,14 +1,17 @@
 import json
 import logging
+import multiprocessing
 import os
 import random
 import re
-from collections import defaultdict
+from functools import partial
 
 import numpy as np
 import tensorflow as tf
 from sklearn.model_selection import train_test_split
 
+from .index import CorpusIndex
+from .normalize import TokenNormalizer
 from ..error import FeatureDoesNotExist
 from ..tools import ensure_dir
 
@@ -36,6 +39,43 @@ class StatsCorpus:
         logging.info("* nb. true unique unknown tokens: {:,}".format(len(list(set(self.unknown_words)))))
         logging.info("* nb. replaced singletons: {:,}".format(self.replaced_singletons))
 
+    def merge(self, other):
+        """
+        Add the statistics gathered by another object (e.g. on one TFRecords shard)
+        :param other: StatsCorpus object
+        :return: nothing
+        """
+
+        self.sequence_lengths.extend(other.sequence_lengths)
+        self.nb_words += other.nb_words
+        self.replaced_singletons += other.replaced_singletons
+        self.unknown_words.extend(other.unknown_words)
+
+    def get_payload(self):
+        """
+        Return the statistics needed to resume training from existing TFRecords files
+        :return: dictionary
+        """
+
+        return {
+            "nb_instances": self.nb_instances,
+            "sequence_lengths": [int(item) for item in self.sequence_lengths],
+            "nb_words": self.nb_words,
+            "replaced_singletons": self.replaced_singletons
+        }
+
+    def load_payload(self, payload):
+        """
+        Load statistics dumped with get_payload
+        :param payload: dictionary
+        :return: nothing
+        """
+
+        self.nb_instances = payload["nb_instances"]
+        self.sequence_lengths = payload["sequence_lengths"]
+        self.nb_words = payload["nb_words"]
+        self.replaced_singletons = payload["replaced_singletons"]
+
     def dump_unknown_tokens(self, target_file):
 
         with open(target_file, "w", encoding="UTF-8") as output_file:
@@ -43,12 +83,218 @@ class StatsCorpus:
                 output_file.write("{}\n".format(item))
 
 
+# Objects shared with TFRecords writer processes. They are inherited by the workers when the pool is forked,
+# which avoids pickling the word mapping once per worker.
+_SHARD_WRITER_CONTEXT = dict()
+
+
+def get_shard_file_paths(target_dir, prefix, nb_shards):
+    """
+    Compute TFRecords shard file paths
+    :param target_dir: directory where shards are stored
+    :param prefix: shard filename prefix (e.g. 'train')
+    :param nb_shards: number of shards
+    :return: list of file paths
+    """
+
+    return [os.path.join(target_dir, "{}-{:05d}-of-{:05d}.tfrecords".format(prefix, i, nb_shards))
+            for i in range(nb_shards)]
+
+
+def write_sharded_tfrecords(data_index, selection, target_dir, prefix, part, write_fn, nb_processes=1, seed=None):
+    """
+    Write sequences to TFRecords shards using a pool of processes. Selected sequences are divided into
+    contiguous shards, one per process.
+    :param data_index: CorpusIndex object of the source data file
+    :param selection: boolean mask of the sequences to write, or array of sequence indexes giving the writing
+    order (all sequences in file order if None)
+    :param target_dir: directory where shards will be written
+    :param prefix: shard filename prefix
+    :param part: part name used for example IDs and statistics (e.g. 'TRAIN')
+    :param write_fn: function writing one example, called as write_fn(writer, tokens, example_id, stats, rng)
+    :param nb_processes: number of processes (and shards)
+    :param seed: random seed, each shard uses its own generator derived from this seed
+    :return: shard file paths and StatsCorpus object merged in shard order
+    """
+
+    if selection is None:
+        sequence_ids = np.arange(len(data_index))
+    elif np.asarray(selection).dtype == bool:
+        sequence_ids = np.flatnonzero(selection)
+    else:
+        sequence_ids = np.asarray(selection)
+
+    nb_shards = max(1, min(nb_processes, len(sequence_ids)))
+
+    _SHARD_WRITER_CONTEXT.clear()
+    _SHARD_WRITER_CONTEXT.update({
+        "data_index": data_index,
+        "shards": np.array_split(sequence_ids, nb_shards),
+        "file_paths": get_shard_file_paths(target_dir, prefix, nb_shards),
+        "part": part,
+        "write_fn": write_fn,
+        "seed": seed
+    })
+
+    try:
+        if nb_shards == 1:
+            shard_stats = [_write_shard(0)]
+        else:
+            with multiprocessing.get_context("fork").Pool(nb_shards) as pool:
+                shard_stats = pool.map(_write_shard, range(nb_shards))
+    finally:
+        file_paths = _SHARD_WRITER_CONTEXT["file_paths"]
+        _SHARD_WRITER_CONTEXT.clear()
+
+    stats = StatsCorpus(name=part)
+    for item in shard_stats:
+        stats.merge(item)
+
+    return file_paths, stats
+
+
+def _write_shard(shard_id):
+    """
+    Write one TFRecords shard
+    :param shard_id: shard number
+    :return: StatsCorpus object for this shard
+    """
+
+    context = _SHARD_WRITER_CONTEXT
+
+    stats = StatsCorpus(name=context["part"])
+
+    if context["seed"] is not None:
+        rng = random.Random("{}-{}".format(context["seed"], shard_id))
+    else:
+        rng = random.Random()
+
+    writer = tf.python_io.TFRecordWriter(context["file_paths"][shard_id])
+
+    for sequence_id, tokens in context["data_index"].iter_sequences(context["shards"][shard_id]):
+        context["write_fn"](writer, tokens, "{}-{}".format(context["part"], sequence_id), stats, rng)
+
+    writer.close()
+
+    return stats
+
+
+def compute_batch_padding(lengths, char_lengths, batch_size):
+    """
+    Compute the number of padding cells in the token and character tensors when sequences are batched in the
+    given order
+    :param lengths: number of tokens of each sequence (batching order)
+    :param char_lengths: longest token size of each sequence (batching order)
+    :param batch_size: mini-batch size
+    :return: padding cells in token tensors, padding cells in character tensors
+    """
+
+    token_padding = 0
+    char_padding = 0
+
+    for start in range(0, len(lengths), batch_size):
+        batch_lengths = lengths[start:start + batch_size]
+        batch_char_lengths = char_lengths[start:start + batch_size]
+
+        token_cells = len(batch_lengths) * np.max(batch_lengths)
+        token_padding += token_cells - np.sum(batch_lengths)
+
+        # Upper bound of the real characters: every token is counted with the longest token size
+        char_padding += token_cells * np.max(batch_char_lengths) - np.sum(batch_lengths * batch_char_lengths)
+
+    return int(token_padding), int(char_padding)
+
+
+def log_batch_padding(file_token_padding, file_char_padding, token_padding=None, char_padding=None):
+    """
+    Log the padding cells of the token and character tensors
+    :param file_token_padding: token padding cells when batching in file order
+    :param file_char_padding: character padding cells when batching in file order
+    :param token_padding: token padding cells when batching in length-sorted order (None if not sorted)
+    :param char_padding: character padding cells when batching in length-sorted order (None if not sorted)
+    :return: nothing
+    """
+
+    if token_padding is None:
+        logging.info("* padding (file order): tokens={:,} chars={:,}".format(file_token_padding, file_char_padding))
+        return
+
+    logging.info("* padding (length-sorted): tokens={:,} chars={:,} (file order: tokens={:,} chars={:,})".format(
+        token_padding, char_padding, file_token_padding, file_char_padding
+    ))
+    logging.info("* padding saved: tokens={:.2f}% chars={:.2f}%".format(
+        ((file_token_padding - token_padding) / file_token_padding) * 100 if file_token_padding else 0.0,
+        ((file_char_padding - char_padding) / file_char_padding) * 100 if file_char_padding else 0.0
+    ))
+
+
+def pad_sequences(encoded_sequences, feature_columns):
+    """
+    Build padded mini-batch arrays from encoded sequences, with the layout of the TFRecords pipelines
+    (padding value: 0)
+    :param encoded_sequences: list of (token IDs, character ID tuples, feature value IDs) tuples
+    :param feature_columns: list of feature columns
+    :return: list of arrays [x_len, x_tokens, x_chars, x_chars_len, x_att_*]
+    """
+
+    batch_size = len(encoded_sequences)
+
+    x_len = np.array([len(token_ids) for token_ids, _, _ in encoded_sequences], dtype=np.int32)
+    max_len = np.max(x_len)
+    max_chars = max([len(item) for _, char_ids, _ in encoded_sequences for item in char_ids])
+
+    x_tokens = np.zeros((batch_size, max_len), dtype=np.int32)
+    x_chars = np.zeros((batch_size, max_len, max_chars), dtype=np.int32)
+    x_chars_len = np.zeros((batch_size, max_len), dtype=np.int32)
+
+    x_atts = dict()
+    for col in feature_columns:
+        x_atts[col] = np.zeros((batch_size, max_len), dtype=np.int32)
+
+    for i, (token_ids, char_ids, feature_ids) in enumerate(encoded_sequences):
+        x_tokens[i, :len(token_ids)] = token_ids
+
+        for j, token_char_ids in enumerate(char_ids):
+            x_chars[i, j, :len(token_char_ids)] = token_char_ids
+            x_chars_len[i, j] = len(token_char_ids)
+
+        for col in feature_columns:
+            x_atts[col][i, :len(token_ids)] = feature_ids[col]
+
+    return [x_len, x_tokens, x_chars, x_chars_len] + [x_atts[col] for col in feature_columns]
+
+
+def write_chars(x_chars, x_chars_len, char_ids, token_max_size):
+    """
+    Write padded character IDs and token lengths (in characters) to SequenceExample feature lists. Tokens
+    without any known character get one padding character.
+    :param x_chars: character ID feature list
+    :param x_chars_len: token length feature list
+    :param char_ids: list of character ID tuples (one per token)
+    :param token_max_size: padding size
+    :return: nothing
+    """
+
+    for token_char_ids in char_ids:
+
+        if len(token_char_ids) == 0:
+            token_char_ids = (0,)
+
+        for char_id in token_char_ids:
+            x_chars.feature.add().int64_list.value.append(char_id)
+
+        x_chars_len.feature.add().int64_list.value.append(len(token_char_ids))
+
+        for _ in range(token_max_size - len(token_char_ids)):
+            x_chars.feature.add().int64_list.value.append(0)
+
+
 class TrainData:
     """
     Main class for training data
     """
 
-    def __init__(self, working_dir=None, data_params=None):
+    def __init__(self, working_dir=None, data_params=None, tfrecords_dir_path=None):
 
         # Path to tabulated train files
         self.train_file_path = os.path.abspath(data_params.get("train_file_path"))
@@ -88,8 +334,15 @@ class TrainData:
         self.lower_input = data_params.get("preproc_lower_input")
         self.replace_digits = data_params.get("preproc_replace_digits")
 
+        # Token normalization (character mapping is set once computed)
+        self.normalizer = TokenNormalizer(lower_input=self.lower_input, replace_digits=self.replace_digits)
+
         self.singletons = None
 
+        # Train and dev file indexes (built when checking input files)
+        self.train_index = None
+        self.dev_index = None
+
         self.feature_use = data_params.get("feature_use")
         self.feature_columns = list()
 
@@ -97,11 +350,14 @@ class TrainData:
         # SETTING UP PATHS
 
         # Path where TFRecords files will be stored
-        self.tfrecords_dir_path = os.path.join(os.path.abspath(working_dir), "tfrecords")
+        if tfrecords_dir_path:
+            self.tfrecords_dir_path = os.path.abspath(tfrecords_dir_path)
+        else:
+            self.tfrecords_dir_path = os.path.join(os.path.abspath(working_dir), "tfrecords")
 
-        # Train and dev TFRecords file paths
-        self.tfrecords_train_file = os.path.join(self.tfrecords_dir_path, "train.tfrecords")
-        self.tfrecords_dev_file = os.path.join(self.tfrecords_dir_path, "dev.tfrecords")
+        # Train and dev TFRecords shard paths (set when shards are written)
+        self.tfrecords_train_files = list()
+        self.tfrecords_dev_files = list()
 
         # Train and dev unknown token lists
         self.unknown_tokens_train_file = os.path.join(self.working_dir, "unknown_tokens_train.lst")
@@ -126,26 +382,51 @@ class TrainData:
 
     def check_input_files(self):
         """
-        Check input file formats (train and dev if available)
+        Check input file formats (train and dev if available) and index their sequences
         :return: nothing
         """
 
-        if self.train_file_path:
-            logging.info("Checking train file: {}".format(os.path.basename(self.train_file_path)))
-            logging.debug("Full file path: {}".format(os.path.abspath(self.train_file_path)))
-            self._check_file(self.train_file_path, self.feature_columns)
+        logging.info("Checking train file: {}".format(os.path.basename(self.train_file_path)))
+        logging.debug("Full file path: {}".format(os.path.abspath(self.train_file_path)))
+        self.train_index = CorpusIndex(self.train_file_path, self.feature_columns).build()
+        self.train_index.log_stats()
 
         if self.dev_file_use:
             logging.info("Checking dev file: {}".format(os.path.basename(self.dev_file_path)))
             logging.debug("Full file path: {}".format(os.path.abspath(self.dev_file_path)))
-            self._check_file(self.dev_file_path, self.feature_columns)
+            self.dev_index = CorpusIndex(self.dev_file_path, self.feature_columns).build()
+            self.dev_index.log_stats()
+
+    def get_corpus_vocabulary(self, extra_files=None):
+        """
+        Compute the set of normalized tokens of the train and dev files, and of additional unlabelled files (e.g.
+        test files). Indexes built by 'check_input_files' are reused.
+        :param extra_files: additional tabulated files
+        :return: set of normalized tokens
+        """
 
-    def create_tfrecords_files(self, embedding_object, oov_strategy=None, unk_token_rate=None):
+        indexes = [self.train_index or CorpusIndex(self.train_file_path, self.feature_columns).build()]
+
+        if self.dev_file_use:
+            indexes.append(self.dev_index or CorpusIndex(self.dev_file_path, self.feature_columns).build())
+
+        for extra_file in extra_files or list():
+            indexes.append(CorpusIndex(extra_file, labelled=False).build())
+
+        vocabulary = set()
+
+        for data_index in indexes:
+            vocabulary.update(data_index.counts.get_normalized_token_counts(self.normalizer))
+
+        return vocabulary
+
+    def create_tfrecords_files(self, embedding_object, oov_strategy=None, unk_token_rate=None, nb_processes=1):
         """
         Create 'train' and 'dev' TFRecords files
         :param oov_strategy: Out-Of-Vocabulary strategy applied during training
         :param unk_token_rate: singleton replacement rate if applicable
         :param embedding_object: yaset embedding object to use for token IDs fetching
+        :param nb_processes: number of processes used to write TFRecords shards
         :return: nothing
         """
 
@@ -160,227 +441,137 @@ class TrainData:
         elif oov_strategy == "map":
             logging.debug("OOV strategy: map")
 
+        if self.train_index is None:
+            self.check_input_files()
+
         # Case where there is no dev data file
         if not self.dev_file_use:
 
-            # Fetching number of sequences in the 'train' file
-            sequence_nb_train = self._get_number_sequences(self.train_file_path)
-
-            # Creating a list of sequence indexes based on the total number of sequences
-            sequence_indexes = list(range(sequence_nb_train))
+            # Dividing the sequences into train and dev parts
+            train_selection, dev_selection = self._split_sequences(len(self.train_index))
 
-            # Dividing the index list into train and dev parts
-            if self.dev_random_seed_use:
-                train_indexes, dev_indexes = train_test_split(sequence_indexes, test_size=self.dev_ratio,
-                                                              random_state=self.dev_random_seed_value)
-            else:
-                train_indexes, dev_indexes = train_test_split(sequence_indexes, test_size=self.dev_ratio)
+            # Dev instances are extracted from the train file, only the dev part is read again and train
+            # counts are obtained by difference
+            dev_index = self.train_index
+            dev_counts = self.train_index.get_counts(dev_selection)
+            train_counts = self.train_index.counts - dev_counts
 
-            self._check_split(train_indexes, dev_indexes, self.train_file_path, self.train_file_path,
-                              self.feature_columns)
+            self.train_stats.nb_instances = int(np.count_nonzero(train_selection))
+            self.dev_stats.nb_instances = int(np.count_nonzero(dev_selection))
 
-            self.train_stats.nb_instances = len(train_indexes)
-            self.dev_stats.nb_instances = len(dev_indexes)
+        else:
 
-            if oov_strategy == "replace":
-                logging.info("Fetching singleton list")
-                self.singletons = self._get_singletons(self.train_file_path, indexes=train_indexes,
-                                                       lower_input=self.lower_input, replace_digits=self.replace_digits)
-                logging.info("* Nb. singletons in train instances: {}".format(len(self.singletons)))
-
-            logging.info("Building character mapping")
-            self.char_mapping = self._get_char_mapping(self.train_file_path, train_indexes,
-                                                       replace_digits=self.replace_digits)
-            logging.info("* nb. unique characters: {:,}".format(len(self.char_mapping) - 1))
-
-            if self.feature_use:
-                logging.info("Building attribute mapping")
-                self.feature_value_mapping = self._get_feature_value_mapping(self.train_file_path, self.feature_columns,
-                                                                             indexes=train_indexes)
-                for i, col in enumerate(self.feature_columns, start=1):
-                    logging.info("* nb. unique values for feat. {} (col. #{}): {}".format(
-                        i, col, len(self.feature_value_mapping[col])
-                    ))
-                    self.feature_nb += len(self.feature_value_mapping[col])
-
-            logging.info("Building label mapping")
-            self.label_mapping, self.inv_label_mapping = self._get_label_mapping(self.train_file_path, train_indexes)
-            logging.info("* nb. unique labels: {:,}".format(len(self.label_mapping)))
-
-            # Creating 'train' and 'dev' tfrecords files
-            logging.info("Creating TFRecords file for train instances...")
-
-            self._convert_to_tfrecords(self.train_file_path, self.tfrecords_train_file,
-                                       embedding_object, indexes=train_indexes, part="TRAIN",
-                                       oov_strategy=oov_strategy, unk_token_rate=unk_token_rate)
-
-            self.train_stats.log_stats()
-
-            # Dumping unknown word set to working dir
-            logging.info("Dumping unknown word list to file: {}".format(
-                os.path.basename(self.unknown_tokens_train_file)
-            ))
-            self.train_stats.dump_unknown_tokens(self.unknown_tokens_train_file)
+            # All sequences from both files are used
+            train_selection = None
+            dev_selection = None
 
-            logging.info("Creating TFRecords file for dev instances...")
-            self._convert_to_tfrecords(self.train_file_path, self.tfrecords_dev_file,
-                                       embedding_object, indexes=dev_indexes, part="DEV",
-                                       oov_strategy=oov_strategy, unk_token_rate=unk_token_rate)
+            dev_index = self.dev_index
+            dev_counts = self.dev_index.counts
+            train_counts = self.train_index.counts
 
-            self.dev_stats.log_stats()
+            self.train_stats.nb_instances = len(self.train_index)
+            self.dev_stats.nb_instances = len(self.dev_index)
 
-            # Dumping unknown word set to working dir
-            logging.info("Dumping unknown word list to file: {}".format(
-                os.path.basename(self.unknown_tokens_dev_file)
-            ))
-            self.dev_stats.dump_unknown_tokens(self.unknown_tokens_dev_file)
+        self._check_split(train_counts, dev_counts)
 
-        else:
+        if oov_strategy == "replace":
+            logging.info("Fetching singleton list")
+            self.singletons = self._get_singletons(train_counts, self.normalizer)
+            logging.info("* Nb. singletons in train instances: {}".format(len(self.singletons)))
+
+        logging.info("Building character mapping")
+        self.char_mapping = self._get_char_mapping(train_counts, self.normalizer)
+        self.normalizer.set_char_mapping(self.char_mapping)
+        logging.info("* nb. unique characters: {:,}".format(len(self.char_mapping) - 1))
+
+        if self.feature_use:
+            logging.info("Building attribute mapping")
+            self.feature_value_mapping = self._get_feature_value_mapping(train_counts, self.feature_columns)
+            for i, col in enumerate(self.feature_columns, start=1):
+                logging.info("* nb. unique values for feat. {} (col. #{}): {}".format(
+                    i, col, len(self.feature_value_mapping[col])
+                ))
+                self.feature_nb += len(self.feature_value_mapping[col])
 
-            sequence_nb_train = self._get_number_sequences(self.train_file_path)
-            sequence_nb_dev = self._get_number_sequences(self.dev_file_path)
+        logging.info("Building label mapping")
+        self.label_mapping, self.inv_label_mapping = self._get_label_mapping(train_counts)
+        logging.info("* nb. unique labels: {:,}".format(len(self.label_mapping)))
 
-            train_indexes = list(range(sequence_nb_train))
-            dev_indexes = list(range(sequence_nb_dev))
+        # Creating 'train' and 'dev' tfrecords files
+        logging.info("Creating TFRecords file for train instances...")
 
-            self._check_split(train_indexes, dev_indexes, self.train_file_path, self.dev_file_path,
-                              self.feature_columns)
+        self.tfrecords_train_files = self._convert_to_tfrecords(self.train_index, "train", embedding_object,
+                                                                selection=train_selection, part="TRAIN",
+                                                                oov_strategy=oov_strategy,
+                                                                unk_token_rate=unk_token_rate,
+                                                                nb_processes=nb_processes)
 
-            self.train_stats.nb_instances = len(train_indexes)
-            self.dev_stats.nb_instances = len(dev_indexes)
+        self.train_stats.log_stats()
 
-            if oov_strategy == "replace":
-                logging.info("Fetching singleton list")
-                self.singletons = self._get_singletons(self.train_file_path, indexes=train_indexes,
-                                                       lower_input=self.lower_input, replace_digits=self.replace_digits)
-                logging.info("* nb. singletons in train instances: {}".format(len(self.singletons)))
-
-            logging.info("Building character mapping")
-            self.char_mapping = self._get_char_mapping(self.train_file_path, train_indexes,
-                                                       replace_digits=self.replace_digits)
-            logging.info("* nb. unique characters: {:,}".format(len(self.char_mapping) - 1))
-
-            if self.feature_use:
-                logging.info("Building attribute mapping")
-                self.feature_value_mapping = self._get_feature_value_mapping(self.train_file_path, self.feature_columns,
-                                                                             indexes=train_indexes)
-                for i, col in enumerate(self.feature_columns, start=1):
-                    logging.info("* nb. unique values for feat. {} (col. #{}): {}".format(
-                        i, col, len(self.feature_value_mapping[col])
-                    ))
-                    self.feature_nb += len(self.feature_value_mapping[col])
-
-            logging.info("Building label mapping")
-            self.label_mapping, self.inv_label_mapping = self._get_label_mapping(self.train_file_path, train_indexes)
-            logging.info("* nb. unique labels: {:,}".format(len(self.label_mapping)))
-
-            # Creating 'train' and 'dev' tfrecords files
-            logging.info("Creating TFRecords file for train instances...")
-
-            self._convert_to_tfrecords(self.train_file_path, self.tfrecords_train_file,
-                                       embedding_object, indexes=train_indexes, part="TRAIN",
-                                       oov_strategy=oov_strategy, unk_token_rate=unk_token_rate)
-
-            self.train_stats.log_stats()
-
-            # Dumping unknown word set to working dir
-            logging.info("Dumping unknown word list to file: {}".format(
-                os.path.basename(self.unknown_tokens_train_file)
-            ))
-            self.train_stats.dump_unknown_tokens(self.unknown_tokens_train_file)
+        # Dumping unknown word set to working dir
+        logging.info("Dumping unknown word list to file: {}".format(
+            os.path.basename(self.unknown_tokens_train_file)
+        ))
+        self.train_stats.dump_unknown_tokens(self.unknown_tokens_train_file)
 
-            logging.info("Creating TFRecords file for dev instances...")
-            self._convert_to_tfrecords(self.dev_file_path, self.tfrecords_dev_file,
-                                       embedding_object, indexes=dev_indexes, part="DEV",
-                                       oov_strategy=oov_strategy, unk_token_rate=unk_token_rate)
+        logging.info("Creating TFRecords file for dev instances...")
+        self.tfrecords_dev_files = self._convert_to_tfrecords(dev_index, "dev", embedding_object,
+                                                              selection=dev_selection, part="DEV",
+                                                              oov_strategy=oov_strategy,
+                                                              unk_token_rate=unk_token_rate,
+                                                              nb_processes=nb_processes)
 
-            self.dev_stats.log_stats()
+        self.dev_stats.log_stats()
 
-            # Dumping unknown word set to working dir
-            logging.info("Dumping unknown word list to file: {}".format(
-                os.path.basename(self.unknown_tokens_dev_file)
-            ))
-            self.dev_stats.dump_unknown_tokens(self.unknown_tokens_dev_file)
+        # Dumping unknown word set to working dir
+        logging.info("Dumping unknown word list to file: {}".format(
+            os.path.basename(self.unknown_tokens_dev_file)
+        ))
+        self.dev_stats.dump_unknown_tokens(self.unknown_tokens_dev_file)
 
-    def _convert_to_tfrecords(self, data_file, target_tfrecords_file_path, embedding_object, indexes=None, part=None,
-                              oov_strategy=None, unk_token_rate=None):
+    def _convert_to_tfrecords(self, data_index, prefix, embedding_object, selection=None, part=None,
+                              oov_strategy=None, unk_token_rate=None, nb_processes=1):
         """
-        Create a TFRecords file
-        :param data_file: source data files containing the sequences to write to the TFRecords file
-        :param target_tfrecords_file_path: target TFRecords file path
+        Create TFRecords shards
+        :param data_index: index of the data file containing the sequences to write to the TFRecords files
+        :param prefix: shard filename prefix
         :param embedding_object: yaset embedding object used to fetch token IDs
-        :param indexes: indexes of the sequences to write to the TFRecords file
-        :return: nothing
+        :param selection: boolean mask of the sequences to write to the TFRecords files (all sequences if None)
+        :param nb_processes: number of processes (and shards)
+        :return: shard file paths
         """
 
-        # Will contains labels and tokens
-        tokens = list()
-
-        sequence_id = 0
+        write_fn = partial(self._write_example_to_file, embedding_object=embedding_object, part=part,
+                           oov_strategy=oov_strategy, unk_token_rate=unk_token_rate)
 
-        writer = tf.python_io.TFRecordWriter(target_tfrecords_file_path)
+        file_paths, stats = write_sharded_tfrecords(data_index, selection, self.tfrecords_dir_path, prefix, part,
+                                                    write_fn, nb_processes=nb_processes,
+                                                    seed=self.dev_random_seed_value)
 
-        with open(data_file, "r", encoding="UTF-8") as input_file:
+        logging.debug("* nb. shards: {}".format(len(file_paths)))
 
-            current_sequence = 0
-
-            for line in input_file:
-
-                if re.match("^$", line):
-                    if current_sequence > 0:
-                        current_sequence = 0
-
-                        if indexes:
-                            if sequence_id in indexes:
-                                self._write_example_to_file(writer, tokens, embedding_object,
-                                                            "{}-{}".format(part, sequence_id), part,
-                                                            oov_strategy=oov_strategy,
-                                                            unk_token_rate=unk_token_rate)
-                        else:
-                            self._write_example_to_file(writer, tokens, embedding_object,
-                                                        "{}-{}".format(part, sequence_id), part,
-                                                        oov_strategy=oov_strategy,
-                                                        unk_token_rate=unk_token_rate)
-
-                        tokens.clear()
-                        sequence_id += 1
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-                current_sequence += 1
-
-                tokens.append(parts)
-
-            if current_sequence > 0:
-                if indexes:
-                    if sequence_id in indexes:
-                        self._write_example_to_file(writer, tokens, embedding_object,
-                                                    "{}-{}".format(part, sequence_id), part,
-                                                    oov_strategy=oov_strategy,
-                                                    unk_token_rate=unk_token_rate)
-                else:
-                    self._write_example_to_file(writer, tokens, embedding_object,
-                                                "{}-{}".format(part, sequence_id), part,
-                                                oov_strategy=oov_strategy,
-                                                unk_token_rate=unk_token_rate)
+        # Merging shard statistics
+        if part == "TRAIN":
+            self.train_stats.merge(stats)
+        else:
+            self.dev_stats.merge(stats)
 
-        writer.close()
+        return file_paths
 
-    def _write_example_to_file(self, writer, tokens, embedding_object, example_id, part, oov_strategy=None,
-                               unk_token_rate=None):
+    def _write_example_to_file(self, writer, tokens, example_id, stats, rng, embedding_object=None, part=None,
+                               oov_strategy=None, unk_token_rate=None):
         """
         Write an example to a TFRecords file
         :param writer: opened TFRecordWriter
         :param tokens: list of tokens
+        :param example_id: example ID
+        :param stats: StatsCorpus object to update
+        :param rng: random generator used for singleton replacement
         :param embedding_object: yaset embedding object
         :return: nothing
         """
 
-        if part == "TRAIN":
-            self.train_stats.sequence_lengths.append(len(tokens))
-        else:
-            self.dev_stats.sequence_lengths.append(len(tokens))
+        stats.sequence_lengths.append(len(tokens))
 
         example = tf.train.SequenceExample()
 
@@ -398,50 +589,27 @@ class TrainData:
         for col in self.feature_columns:
             x_atts["x_att_{}".format(col)] = example.feature_lists.feature_list["x_att_{}".format(col)]
 
-        token_max_size = 0
+        # Character IDs are fetched once per token, the longest token gives the padding size
+        char_ids = [self.normalizer.get_char_ids(token[0]) for token in tokens]
+        token_max_size = max([len(item) for item in char_ids] + [1])
 
         for token in tokens:
 
-            token_str = token[0]
-
-            if self.lower_input:
-                token_str = token_str.lower()
-
-            if self.replace_digits:
-                token_str = re.sub("\d", "0", token_str)
+            token_str = self.normalizer.normalize(token[0])
 
             token_id = embedding_object.word_mapping.get(token_str)
 
             if oov_strategy == "replace":
                 if token_str in self.singletons and part == "TRAIN":
-                    if random.random() < unk_token_rate:
+                    if rng.random() < unk_token_rate:
                         token_id = embedding_object.word_mapping.get(embedding_object.embedding_oov_map_token_id)
-                        self.train_stats.replaced_singletons += 1
-
-            token_size = 0
-            for char in token[0]:
-                char_str = char
-
-                if self.replace_digits:
-                    char_str = re.sub("\d", "0", char_str)
-
-                if char_str in self.char_mapping:
-                    token_size += 1
-
-            if token_size > token_max_size:
-                token_max_size = token_size
+                        stats.replaced_singletons += 1
 
-            if part == "TRAIN":
-                self.train_stats.nb_words += 1
-            else:
-                self.dev_stats.nb_words += 1
+            stats.nb_words += 1
 
             if not token_id:
                 token_id = embedding_object.word_mapping.get(embedding_object.embedding_oov_map_token_id)
-                if part == "TRAIN":
-                    self.train_stats.unknown_words.append(token[0])
-                else:
-                    self.dev_stats.unknown_words.append(token[0])
+                stats.unknown_words.append(token[0])
 
             label_id = self.label_mapping.get(token[-1])
 
@@ -452,27 +620,7 @@ class TrainData:
                 feat_id = self.feature_value_mapping[col].get(token[col])
                 x_atts["x_att_{}".format(col)].feature.add().int64_list.value.append(feat_id)
 
-        for token in tokens:
-            token_size = 0
-
-            for char in token[0]:
-                char_str = char
-                if self.replace_digits:
-                    char_str = re.sub("\d", "0", char_str)
-
-                if char_str in self.char_mapping:
-                    x_chars.feature.add().int64_list.value.append(self.char_mapping[char_str])
-                    token_size += 1
-
-            if token_size == 0:
-                x_chars.feature.add().int64_list.value.append(0)
-                token_size += 1
-
-            x_chars_len.feature.add().int64_list.value.append(token_size)
-
-            while token_size < token_max_size:
-                x_chars.feature.add().int64_list.value.append(0)
-                token_size += 1
+        write_chars(x_chars, x_chars_len, char_ids, token_max_size)
 
         writer.write(example.SerializeToString())
 
@@ -480,7 +628,7 @@ class TrainData:
 
         payload = {
             "label_mapping": self.label_mapping,
-            "embedding_matrix_shape": embedding_object.embedding_matrix.shape,
+            "embedding_matrix_shape": embedding_object.get_matrix_shape(),
             "word_mapping": embedding_object.word_mapping,
             "char_mapping": self.char_mapping,
             "feature_value_mapping": self.feature_value_mapping,
@@ -494,95 +642,115 @@ class TrainData:
 
         json.dump(payload, open(os.path.abspath(target_file), "w", encoding="UTF-8"))
 
-    def _check_split(self, train_indexes, dev_indexes, train_data_file, dev_data_file, features_columns):
+    def dump_preprocessing(self, target_file):
         """
-        Check if all attributes values from dev instances will be seen in the train part
-        :param train_indexes: train instance indexes
-        :param dev_indexes: dev instance indexes
-        :param train_data_file: file from which train instances are extracted
-        :param dev_data_file: file from which dev instances are extracted
-        :param features_columns: feature column indexes
+        Dump mappings, statistics and TFRecords shard paths (relative to the target file directory) so that
+        TFRecords files can be reused by another run
+        :param target_file: target JSON file
         :return: nothing
         """
 
-        # Fetching labels and attribute values from train instances
-        labels_train, attributes_train = self._get_attributes_and_labels(train_data_file, train_indexes,
-                                                                         features_columns)
-
-        # Fetching labels and attribute values from dev instances
-        labels_dev, attributes_dev = self._get_attributes_and_labels(dev_data_file, dev_indexes, features_columns)
+        target_dir = os.path.dirname(os.path.abspath(target_file))
 
-        # Checking if attributes values from dev instances are present in train instances
-        for col, att_dict in attributes_dev.items():
-            for k, v in att_dict.items():
-                if k not in attributes_train[col]:
-                    logging.info("One feature value from col. #{} in dev corpus is not present in train "
-                                 "corpus: {}".format(col, k))
-                    if self.dev_file_path:
-                        logging.info("Check your input files and relaunch yaset")
-                    else:
-                        logging.info("Try to relaunch yaset after changing the random seed")
+        payload = {
+            "label_mapping": self.label_mapping,
+            "char_mapping": self.char_mapping,
+            "feature_value_mapping": self.feature_value_mapping,
+            "feature_nb": self.feature_nb,
+            "feature_columns": self.feature_columns,
+            "tfrecords_train_files": [os.path.relpath(item, target_dir) for item in self.tfrecords_train_files],
+            "tfrecords_dev_files": [os.path.relpath(item, target_dir) for item in self.tfrecords_dev_files],
+            "train_stats": self.train_stats.get_payload(),
+            "dev_stats": self.dev_stats.get_payload()
+        }
 
-                    raise FeatureDoesNotExist("A feature value at col. #{} from dev instances is not present in train"
-                                              " instances: {}".format(col, k))
+        json.dump(payload, open(os.path.abspath(target_file), "w", encoding="UTF-8"))
 
-    @staticmethod
-    def _get_singletons(data_file, indexes=None, lower_input=None, replace_digits=None):
+    def load_preprocessing(self, source_file):
         """
-        Compute the character-mapping file
-        :param data_file: source data files containing the sequences to write to the TFRecords file
-        :param indexes: indexes of the sequences to write to the TFRecords file
+        Load mappings, statistics and TFRecords shard paths dumped with dump_preprocessing
+        :param source_file: source JSON file
         :return: nothing
         """
 
-        # Will contains labels and tokens
-        tokens_count = defaultdict(int)
-        singletons = set()
-        tokens = list()
+        source_dir = os.path.dirname(os.path.abspath(source_file))
+        payload = json.load(open(os.path.abspath(source_file), "r", encoding="UTF-8"))
+
+        self.label_mapping = payload["label_mapping"]
+        self.inv_label_mapping = dict()
+        for k, v in self.label_mapping.items():
+            self.inv_label_mapping[v] = k
 
-        sequence_id = 0
+        self.char_mapping = payload["char_mapping"]
+        self.normalizer.set_char_mapping(self.char_mapping)
 
-        with open(data_file, "r", encoding="UTF-8") as input_file:
+        self.feature_value_mapping = dict()
+        for k, v in payload["feature_value_mapping"].items():
+            self.feature_value_mapping[int(k)] = v
 
-            current_tokens = list()
+        self.feature_nb = payload["feature_nb"]
+        self.feature_columns = payload["feature_columns"]
 
-            for line in input_file:
+        self.tfrecords_train_files = [os.path.join(source_dir, item) for item in payload["tfrecords_train_files"]]
+        self.tfrecords_dev_files = [os.path.join(source_dir, item) for item in payload["tfrecords_dev_files"]]
 
-                if re.match("^$", line):
-                    if len(current_tokens) > 0:
-                        if indexes:
-                            if sequence_id in indexes:
-                                tokens = tokens + current_tokens
-                        else:
-                            tokens = tokens + current_tokens
+        self.train_stats.load_payload(payload["train_stats"])
+        self.dev_stats.load_payload(payload["dev_stats"])
 
-                        current_tokens.clear()
-                        sequence_id += 1
+    def _split_sequences(self, nb_sequences):
+        """
+        Randomly divide the sequences of the train file into train and dev parts
+        :param nb_sequences: total number of sequences
+        :return: train and dev boolean masks
+        """
 
-                    continue
+        sequence_indexes = np.arange(nb_sequences)
 
-                parts = line.rstrip("\n").split("\t")
+        if self.dev_random_seed_use:
+            _, dev_indexes = train_test_split(sequence_indexes, test_size=self.dev_ratio,
+                                              random_state=self.dev_random_seed_value)
+        else:
+            _, dev_indexes = train_test_split(sequence_indexes, test_size=self.dev_ratio)
 
-                tokens.append(parts[0])
+        dev_selection = np.zeros(nb_sequences, dtype=bool)
+        dev_selection[dev_indexes] = True
 
-            if len(current_tokens) > 0:
-                if indexes:
-                    if sequence_id in indexes:
-                        tokens = tokens + current_tokens
-                else:
-                    tokens = tokens + current_tokens
+        return ~dev_selection, dev_selection
 
-        for token in tokens:
+    def _check_split(self, train_counts, dev_counts):
+        """
+        Check if all attributes values from dev instances will be seen in the train part
+        :param train_counts: counts computed on train instances
+        :param dev_counts: counts computed on dev instances
+        :return: nothing
+        """
+
+        # Checking if attributes values from dev instances are present in train instances
+        for col, att_dict in dev_counts.features.items():
+            for k, v in att_dict.items():
+                if k not in train_counts.features[col]:
+                    logging.info("One feature value from col. #{} in dev corpus is not present in train "
+                                 "corpus: {}".format(col, k))
+                    if self.dev_file_use:
+                        logging.info("Check your input files and relaunch yaset")
+                    else:
+                        logging.info("Try to relaunch yaset after changing the random seed")
 
-            token_str = token
+                    raise FeatureDoesNotExist("A feature value at col. #{} from dev instances is not present in train"
+                                              " instances: {}".format(col, k))
 
-            if replace_digits:
-                token_str = re.sub("\d", "0", token_str)
+    @staticmethod
+    def _get_singletons(counts, normalizer):
+        """
+        Compute the singleton set
+        :param counts: counts computed on train instances
+        :param normalizer: TokenNormalizer object
+        :return: singleton set
+        """
 
-            if lower_input:
-                token_str = token_str.lower()
+        tokens_count = counts.get_normalized_token_counts(normalizer)
 
-            tokens_count[token_str] += 1
+        singletons = set()
 
         for k, v in tokens_count.items():
             if v == 1:
@@ -591,61 +759,17 @@ class TrainData:
         return singletons
 
     @staticmethod
-    def _get_char_mapping(data_file, indexes=None, replace_digits=None):
+    def _get_char_mapping(counts, normalizer):
         """
-        Compute the character-mapping file
-        :param data_file: source data files containing the sequences to write to the TFRecords file
-        :param indexes: indexes of the sequences to write to the TFRecords file
-        :return: nothing
+        Compute the character-mapping
+        :param counts: counts computed on train instances
+        :param normalizer: TokenNormalizer object
+        :return: character mapping
         """
 
-        # Will contains labels and tokens
-        tokens = list()
         char_mapping = dict()
 
-        sequence_id = 0
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-
-            current_tokens = list()
-
-            for line in input_file:
-
-                if re.match("^$", line):
-                    if len(current_tokens) > 0:
-                        if indexes:
-                            if sequence_id in indexes:
-                                tokens = tokens + current_tokens
-                        else:
-                            tokens = tokens + current_tokens
-
-                        current_tokens.clear()
-                        sequence_id += 1
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-
-                tokens.append(parts[0])
-
-            if len(current_tokens) > 0:
-                if indexes:
-                    if sequence_id in indexes:
-                        tokens = tokens + current_tokens
-                else:
-                    tokens = tokens + current_tokens
-
-        char_set = set()
-        for token in tokens:
-            for char in token:
-                char_str = char
-
-                if replace_digits:
-                    char_str = re.sub("\d", "0", char_str)
-
-                char_set.add(char_str)
-
-        for i, char in enumerate(sorted(char_set), start=1):
+        for i, char in enumerate(sorted(counts.get_char_set(normalizer)), start=1):
             char_mapping[char] = i
 
         char_mapping["pad_character"] = 0
@@ -653,272 +777,43 @@ class TrainData:
         return char_mapping
 
     @staticmethod
-    def _check_file(data_file, features_columns):
+    def _get_feature_value_mapping(counts, feature_columns):
         """
-        Check input data file format
-        :param data_file: data file to check
-        :return: nothing
+        Compute the feature value mapping
+        :param counts: counts computed on train instances
+        :param feature_columns: feature column indexes
+        :return: feature value mapping
         """
 
-        labels = defaultdict(int)
-        tokens = defaultdict(int)
-
-        attributes = dict()
-        for col in features_columns:
-            attributes[col] = defaultdict(int)
-
-        sequence_lengths = list()
-        column_nb = set()
-
-        sequence_count = 0
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-
-            current_sequence = 0
-
-            for i, line in enumerate(input_file, start=1):
-                if re.match("^$", line):
-                    if current_sequence > 0:
-                        sequence_lengths.append(current_sequence)  # Appending current sequence length to list
-                        current_sequence = 0  # Resetting length counter
-                        sequence_count += 1  # Incrementing sequence length
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")  # Splitting line
-
-                column_nb.add(len(parts))  # Keeping track of the number of columns
-                current_sequence += 1
-
-                # Raising exception if all lines do not have the same number of columns or
-                # if the number of columns is < 2
-                if len(column_nb) > 1 or len(parts) < 2:
-                    raise Exception("Error reading the input file at line {}: {}".format(i, data_file))
-
-                # Counting tokens and labels
-                tokens[parts[0]] += 1
-                labels[parts[-1]] += 1
-
-                for col, val_dict in attributes.items():
-                    val_dict[parts[col]] += 1
-
-            # End of file, adding information about the last sequence if necessary
-            if current_sequence > 0:
-                sequence_count += 1
-                sequence_lengths.append(current_sequence)
-
-        logging.info("* format: OK")
-        logging.info("* nb. sequences: {:,}".format(sequence_count))
-        logging.info("* average sequence length: {:,.3f} (min={:,} max={:,} std={:,.3f})".format(
-            np.mean(sequence_lengths),
-            np.min(sequence_lengths),
-            np.max(sequence_lengths),
-            np.std(sequence_lengths)
-        ))
-        logging.info("* nb. tokens (col. #0): {:,} (unique={:,})".format(
-            sum([v for k, v in tokens.items()]),
-            len(tokens)
-        ))
-        for i, (col, val_dict) in enumerate(attributes.items(), start=1):
-            nb_attributes = sum([v for k, v in val_dict.items()])
-            logging.info("* nb. att. {} (col. #{}): {:,}".format(
-                i,
-                col,
-                len(val_dict)
-            ))
-            for k, v in val_dict.items():
-                logging.debug("-> {}: {:,} ({:.3f}%)".format(k, v, (v / nb_attributes) * 100))
-
-        logging.info("* nb. labels (col. #{}): {:,}".format(list(column_nb)[0] - 1, len(labels)))
-        nb_labels = sum([v for k, v in labels.items()])
-        for k, v in labels.items():
-            logging.debug("-> {}: {:,} ({:.3f}%)".format(k, v, (v/nb_labels) * 100))
-
-    @staticmethod
-    def _get_feature_value_mapping(data_file, feature_columns, indexes=None):
-
-        # Will contains labels and tokens
-        tokens = list()
         feature_value_mapping = dict()
-        for col in feature_columns:
-            feature_value_mapping[col] = dict()
-
-        sequence_id = 0
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-
-            current_tokens = list()
-
-            for line in input_file:
-
-                if re.match("^$", line):
-                    if len(current_tokens) > 0:
-                        if indexes:
-                            if sequence_id in indexes:
-                                tokens = tokens + current_tokens
-                        else:
-                            tokens = tokens + current_tokens
-
-                        current_tokens.clear()
-                        sequence_id += 1
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-
-                tokens.append(parts)
-
-            if len(current_tokens) > 0:
-                if indexes:
-                    if sequence_id in indexes:
-                        tokens = tokens + current_tokens
-                else:
-                    tokens = tokens + current_tokens
 
         feature_index = 0
 
-        for token in tokens:
-            for col in feature_columns:
-                if token[col] not in feature_value_mapping[col]:
-                    feature_value_mapping[col][token[col]] = feature_index
-                    feature_index += 1
+        for col in feature_columns:
+            feature_value_mapping[col] = dict()
+            for value in counts.features[col]:
+                feature_value_mapping[col][value] = feature_index
+                feature_index += 1
 
         return feature_value_mapping
 
     @staticmethod
-    def _get_label_mapping(data_file, indexes=None):
+    def _get_label_mapping(counts):
         """
-        Compute the character-mapping file
-        :param data_file: source data files containing the sequences to write to the TFRecords file
-        :param indexes: indexes of the sequences to write to the TFRecords file
-        :return: nothing
+        Compute the label mapping
+        :param counts: counts computed on train instances
+        :return: label mapping and inverse label mapping
         """
 
-        # Will contains labels and tokens
-        labels = list()
         label_mapping = dict()
         inv_label_mapping = dict()
 
-        sequence_id = 0
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-
-            current_labels = list()
-
-            for line in input_file:
-
-                if re.match("^$", line):
-                    if len(current_labels) > 0:
-                        if indexes:
-                            if sequence_id in indexes:
-                                labels = labels + current_labels
-                        else:
-                            labels = labels + current_labels
-
-                        current_labels.clear()
-                        sequence_id += 1
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-
-                current_labels.append(parts[-1])
-
-            if len(current_labels) > 0:
-                if indexes:
-                    if sequence_id in indexes:
-                        labels = labels + current_labels
-                else:
-                    labels = labels + current_labels
-
-        label_set = set()
-        for label in labels:
-            label_set.add(label)
-
-        for i, label in enumerate(sorted(label_set)):
+        for i, label in enumerate(sorted(counts.labels)):
             label_mapping[label] = i
             inv_label_mapping[i] = label
 
         return label_mapping, inv_label_mapping
 
-    @staticmethod
-    def _get_number_sequences(data_file_path):
-        """
-        Get the total number of sequences in a data file
-        :param data_file_path: data file path
-        :return: number of sequences
-        """
-
-        sequence_count = 0
-
-        with open(data_file_path, "r", encoding="UTF-8") as input_file:
-
-            current_sequence = 0
-
-            for i, line in enumerate(input_file, start=1):
-
-                if re.match("^$", line):
-                    if current_sequence > 0:
-                        current_sequence = 0
-                        sequence_count += 1
-                    continue
-
-                current_sequence += 1
-
-            if current_sequence > 0:
-                sequence_count += 1
-
-        return sequence_count
-
-    @staticmethod
-    def _get_attributes_and_labels(data_file, indexes, features_columns):
-        """
-        Get attribute and labels values from a group of instances
-        :param data_file: file from which instances are extracted
-        :param indexes: instance indexes
-        :param features_columns: feature column indexes
-        :return: labels and attributes
-        """
-
-        # Initializing variables
-        labels = defaultdict(int)
-        attributes = dict()
-        for col in features_columns:
-            attributes[col] = defaultdict(int)
-
-        # Keeping track of sentence id
-        sequence_id = 0
-        current_sequence = list()
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-            for line in input_file:
-                if re.match("^$", line):
-                    if len(current_sequence) > 0:
-                        if sequence_id in indexes:
-                            for tok in current_sequence:
-                                labels[tok[-1]] += 1
-
-                                for col in features_columns:
-                                    attributes[col][tok[col]] += 1
-
-                        sequence_id += 1
-                        current_sequence.clear()
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-                current_sequence.append(parts)
-
-            if len(current_sequence) > 0:
-                if sequence_id in indexes:
-                    for tok in current_sequence:
-                        labels[tok[-1]] += 1
-
-                        for col in features_columns:
-                            attributes[col][tok[col]] += 1
-
-        return labels, attributes
-
 
 class TestData:
 
@@ -950,8 +845,24 @@ class TestData:
         self.lower_input = self.data_char["lower_input"]
         self.replace_digits = self.data_char["replace_digits"]
 
+        self.normalizer = TokenNormalizer(lower_input=self.lower_input, replace_digits=self.replace_digits,
+                                          char_mapping=self.char_mapping)
+
         self.test_stats = StatsCorpus(name="TEST")
 
+        # Test file index (built when checking the input file)
+        self.test_index = None
+
+        # TFRecords shard paths (set when shards are written)
+        self.tfrecords_files = list()
+
+        # Order in which sequences are written to the TFRecords shards (None: file order)
+        self.sequence_order = None
+
+        self.inv_label_mapping = dict()
+        for k, v in self.label_mapping.items():
+            self.inv_label_mapping[v] = k
+
     def check_input_file(self):
         """
         Check input file
@@ -961,142 +872,184 @@ class TestData:
         if self.test_data_file:
             logging.info("Checking file")
             logging.debug("Full file path: {}".format(os.path.abspath(self.test_data_file)))
-            self._check_file(self.test_data_file, self.feature_columns)
+            self.test_index = CorpusIndex(self.test_data_file, self.feature_columns, labelled=False).build()
+            self.test_index.log_stats()
 
-    @staticmethod
-    def _check_file(data_file, feature_columns):
+    def convert_to_tfrecords(self, data_file, target_tfrecords_dir_path, nb_processes=1, sort_by_length=False):
         """
-        Check input data file format
-        :param data_file: data file to check
+        Create TFRecords shards
+        :param data_file: source data files containing the sequences to write to the TFRecords files
+        :param target_tfrecords_dir_path: directory where TFRecords shards will be written
+        :param nb_processes: number of processes (and shards)
+        :param sort_by_length: write sequences by increasing token and character length to reduce padding
         :return: nothing
         """
 
-        tokens = defaultdict(int)
+        logging.info("Creating TFRecords file for test instances...")
 
-        attributes = dict()
-        for col in feature_columns:
-            attributes[col] = defaultdict(int)
+        logging.debug("Lowercase: {}".format(self.lower_input))
+        logging.debug("Replace digits: {}".format(self.replace_digits))
+
+        if self.test_index is None or self.test_index.data_file != os.path.abspath(data_file):
+            self.test_index = CorpusIndex(data_file, self.feature_columns, labelled=False).build()
+
+        self._check_data(self.test_index.counts)
+
+        self.test_stats.nb_instances = len(self.test_index)
+
+        if sort_by_length:
+            logging.debug("Sorting sequences by length")
+            self.sequence_order = self.test_index.get_length_order()
+        else:
+            self.sequence_order = None
+
+        self.tfrecords_files, stats = write_sharded_tfrecords(self.test_index, self.sequence_order,
+                                                              target_tfrecords_dir_path, "data", "TEST",
+                                                              self._write_example_to_file,
+                                                              nb_processes=nb_processes)
+        self.test_stats.merge(stats)
 
-        sequence_lengths = list()
-        column_nb = set()
+        self.test_stats.log_stats()
+
+    def iter_input_file(self, data_file):
+        """
+        Read the input file once, checking its format on the fly
+        :param data_file: tabulated data file
+        :return: generator of token part lists (one per sequence) and None (one per blank line)
+        """
 
-        sequence_count = 0
+        with open(os.path.abspath(data_file), "r", encoding="UTF-8") as input_file:
+            for item in self.iter_input_lines(input_file, source=data_file):
+                yield item
 
-        with open(data_file, "r", encoding="UTF-8") as input_file:
+    @staticmethod
+    def iter_input_lines(lines, source="input"):
+        """
+        Split tabulated lines into sequences, checking their format on the fly
+        :param lines: iterable of lines (with or without trailing newline)
+        :param source: source name used in error messages
+        :return: generator of token part lists (one per sequence) and None (one per blank line)
+        """
 
-            current_sequence = 0
+        column_nb = None
+        sequence = list()
 
-            for i, line in enumerate(input_file, start=1):
-                if re.match("^$", line):
-                    if current_sequence > 0:
-                        sequence_lengths.append(current_sequence)  # Appending current sequence length to list
-                        current_sequence = 0  # Resetting length counter
-                        sequence_count += 1  # Incrementing sequence length
+        for i, line in enumerate(lines, start=1):
 
-                    continue
+            line = line.rstrip("\n")
 
-                parts = line.rstrip("\n").split("\t")  # Splitting line
+            if line == "":
+                if len(sequence) > 0:
+                    yield sequence
+                    sequence = list()
 
-                column_nb.add(len(parts))  # Keeping track of the number of columns
-                current_sequence += 1
+                yield None
+                continue
 
-                # Raising exception if all lines do not have the same number of columns or
-                # if the number of columns is < 2
-                if len(column_nb) > 1 or len(parts) < 1:
-                    raise Exception("Error reading the input file at line {}: {}".format(i, data_file))
+            parts = line.split("\t")
 
-                # Counting tokens and labels
-                tokens[parts[0]] += 1
+            if column_nb is None:
+                column_nb = len(parts)
 
-                for col, val_dict in attributes.items():
-                    val_dict[parts[col]] += 1
+            if len(parts) != column_nb:
+                raise Exception("Error reading the input file at line {}: {}".format(i, source))
 
-            # End of file, adding information about the last sequence if necessary
-            if current_sequence > 0:
-                sequence_count += 1
-                sequence_lengths.append(current_sequence)
+            sequence.append(parts)
 
-        logging.info("* format: OK")
-        logging.info("* nb. sequences: {:,}".format(sequence_count))
-        logging.info("* average sequence length: {:,.3f} (min={:,} max={:,} std={:,.3f})".format(
-            np.mean(sequence_lengths),
-            np.min(sequence_lengths),
-            np.max(sequence_lengths),
-            np.std(sequence_lengths)
-        ))
-        logging.info("* nb. tokens (col. #0): {:,} (unique={:,})".format(
-            sum([v for k, v in tokens.items()]),
-            len(tokens)
-        ))
-        for i, (col, val_dict) in enumerate(attributes.items(), start=1):
-            nb_attributes = sum([v for k, v in val_dict.items()])
-            logging.info("* nb. att. {} (col. #{}): {:,}".format(
-                i,
-                col,
-                len(val_dict)
-            ))
-            for k, v in val_dict.items():
-                logging.debug("-> {}: {:,} ({:.3f}%)".format(k, v, (v / nb_attributes) * 100))
+        if len(sequence) > 0:
+            yield sequence
 
-    def convert_to_tfrecords(self, data_file, target_tfrecords_file_path):
+    def encode_sequence(self, tokens, stats):
         """
-        Create a TFRecords file
-        :param data_file: source data files containing the sequences to write to the TFRecords file
-        :param target_tfrecords_file_path: target TFRecords file path
-        :return: nothing
+        Convert a sequence to token, character and feature value IDs
+        :param tokens: list of token parts
+        :param stats: StatsCorpus object to update
+        :return: token IDs, character ID tuples (tokens without any known character get one padding
+        character), feature value IDs (dict col -> list)
         """
 
-        logging.info("Creating TFRecords file for test instances...")
+        stats.sequence_lengths.append(len(tokens))
 
-        logging.debug("Lowercase: {}".format(self.lower_input))
-        logging.debug("Replace digits: {}".format(self.replace_digits))
+        token_ids = list()
+        feature_ids = dict()
 
-        sequence_nb = self._get_number_sequences(data_file)
-        self._check_data(data_file, self.feature_columns, list(range(sequence_nb)))
+        for col in self.feature_columns:
+            feature_ids[col] = list()
 
-        self.test_stats.nb_instances = sequence_nb
+        for token in tokens:
 
-        tokens = list()
+            token_str = self.normalizer.normalize(token[0])
 
-        sequence_id = 0
+            token_id = self.word_mapping.get(token_str)
 
-        # TFRecord writer
-        writer = tf.python_io.TFRecordWriter(target_tfrecords_file_path)
+            stats.nb_words += 1
 
-        with open(data_file, "r", encoding="UTF-8") as input_file:
+            if not token_id:
+                token_id = self.word_mapping.get(self.embedding_unknown_token_id)
+                stats.unknown_words.append(token[0])
 
-            for line in input_file:
+            token_ids.append(token_id)
 
-                if re.match("^$", line):
-                    if len(tokens) > 0:
-                        self._write_example_to_file(writer, tokens, "{}-{}".format("TEST", sequence_id))
+            for col in self.feature_columns:
+                feat_id = self.feature_value_mapping[col].get(token[col])
 
-                        sequence_id += 1
-                        tokens.clear()
+                if feat_id is None:
+                    raise FeatureDoesNotExist("A feature value at col. #{} from test instances was not seen "
+                                              "during training: {}".format(col, token[col]))
 
-                    continue
+                feature_ids[col].append(feat_id)
 
-                parts = line.rstrip("\n").split("\t")
-                tokens.append(parts)
+        char_ids = [self.normalizer.get_char_ids(token[0]) or (0,) for token in tokens]
 
-            # End of file, dumping current sequence
-            if len(tokens) > 0:
-                self._write_example_to_file(writer, tokens, "{}-{}".format("TEST", sequence_id))
-                sequence_id += 1
+        return token_ids, char_ids, feature_ids
 
-        self.test_stats.log_stats()
+    def write_sequence_predictions(self, output_file, tokens, predictions):
+        """
+        Write one sequence and its predicted labels
+        :param output_file: opened output file
+        :param tokens: list of token parts
+        :param predictions: predicted label IDs
+        :return: nothing
+        """
+
+        for token, pred in zip(tokens, predictions):
+            output_file.write('{}\n'.format(
+                "\t".join(token + [self.inv_label_mapping[pred]])
+            ))
+
+    def log_padding_stats(self, batch_size):
+        """
+        Log the padding of the token and character tensors for the batching order, compared to file order
+        :param batch_size: mini-batch size
+        :return: nothing
+        """
+
+        lengths = self.test_index.lengths
+        char_lengths = self.test_index.char_lengths
+
+        file_token_padding, file_char_padding = compute_batch_padding(lengths, char_lengths, batch_size)
 
-        writer.close()
+        if self.sequence_order is None:
+            log_batch_padding(file_token_padding, file_char_padding)
+        else:
+            token_padding, char_padding = compute_batch_padding(lengths[self.sequence_order],
+                                                                char_lengths[self.sequence_order],
+                                                                batch_size)
+
+            log_batch_padding(file_token_padding, file_char_padding, token_padding, char_padding)
 
-    def _write_example_to_file(self, writer, tokens, example_id):
+    def _write_example_to_file(self, writer, tokens, example_id, stats, rng=None):
         """
         Write an example to a TFRecords file
         :param writer: opened TFRecordWriter
         :param tokens: list of tokens
+        :param example_id: example ID
+        :param stats: StatsCorpus object to update
+        :param rng: unused, kept for compatibility with the shard writer
         :return: nothing
         """
 
-        self.test_stats.sequence_lengths.append(len(tokens))
+        token_ids, char_ids, feature_ids = self.encode_sequence(tokens, stats)
 
         example = tf.train.SequenceExample()
 
@@ -1109,71 +1062,18 @@ class TestData:
         x_chars = example.feature_lists.feature_list["x_chars"]
         x_chars_len = example.feature_lists.feature_list["x_chars_len"]
 
-        x_atts = dict()
-        for col in self.feature_columns:
-            x_atts["x_att_{}".format(col)] = example.feature_lists.feature_list["x_att_{}".format(col)]
-
-        token_max_size = 0
-
-        for token in tokens:
-
-            token_str = token[0]
-
-            if self.replace_digits:
-                token_str = re.sub("\d", "0", token_str)
-
-            if self.lower_input:
-                token_str = token_str.lower()
-
-            token_id = self.word_mapping.get(token_str)
-
-            token_size = 0
-            for char in token[0]:
-                char_str = char
-
-                if self.replace_digits:
-                    char_str = re.sub("\d", "0", char_str)
-
-                if char_str in self.char_mapping:
-                    token_size += 1
-
-            if token_size > token_max_size:
-                token_max_size = token_size
-
-            self.test_stats.nb_words += 1
-
-            if not token_id:
-                token_id = self.word_mapping.get(self.embedding_unknown_token_id)
-                self.test_stats.unknown_words.append(token[0])
-
+        for token_id in token_ids:
             x_tokens.feature.add().int64_list.value.append(token_id)
 
-            for col in self.feature_columns:
-                feat_id = self.feature_value_mapping[col].get(token[col])
-                x_atts["x_att_{}".format(col)].feature.add().int64_list.value.append(feat_id)
-
-        for token in tokens:
-            token_size = 0
-
-            for char in token[0]:
-                char_str = char
-
-                if self.replace_digits:
-                    char_str = re.sub("\d", "0", char_str)
-
-                if char_str in self.char_mapping:
-                    x_chars.feature.add().int64_list.value.append(self.char_mapping[char_str])
-                    token_size += 1
-
-            if token_size == 0:
-                x_chars.feature.add().int64_list.value.append(0)
-                token_size += 1
+        for col in self.feature_columns:
+            x_att = example.feature_lists.feature_list["x_att_{}".format(col)]
+            for feat_id in feature_ids[col]:
+                x_att.feature.add().int64_list.value.append(feat_id)
 
-            x_chars_len.feature.add().int64_list.value.append(token_size)
+        # The longest token gives the padding size
+        token_max_size = max([len(item) for item in char_ids])
 
-            while token_size < token_max_size:
-                x_chars.feature.add().int64_list.value.append(0)
-                token_size += 1
+        write_chars(x_chars, x_chars_len, char_ids, token_max_size)
 
         writer.write(example.SerializeToString())
 
@@ -1225,13 +1125,15 @@ class TestData:
             for item in sorted(word_set):
                 output_file.write("{}\n".format(item))
 
-    def _check_data(self, data_file, features_columns, indexes):
-
-        # Fetching labels and attribute values from train instances
-        labels, attributes = self._get_attributes_and_labels(data_file, indexes, features_columns)
+    def _check_data(self, counts):
+        """
+        Check if all attribute values from test instances were seen during training
+        :param counts: counts computed on test instances
+        :return: nothing
+        """
 
-        # Checking if attributes values from dev instances are present in train instances
-        for col, att_dict in attributes.items():
+        # Checking if attributes values from test instances are present in train instances
+        for col, att_dict in counts.features.items():
             for k, v in att_dict.items():
                 if k not in self.feature_value_mapping[col]:
                     logging.info("One feature value from col. #{} in test instances was not present during "
@@ -1240,81 +1142,3 @@ class TestData:
 
                     raise FeatureDoesNotExist("A feature value at col. #{} from test instances was not seen during "
                                               "training: {}".format(col, k))
-
-    @staticmethod
-    def _get_attributes_and_labels(data_file, indexes, features_columns):
-        """
-        Get attribute and labels values from a group of instances
-        :param data_file: file from which instances are extracted
-        :param indexes: instance indexes
-        :param features_columns: feature column indexes
-        :return: labels and attributes
-        """
-
-        # Initializing variables
-        labels = defaultdict(int)
-        attributes = dict()
-        for col in features_columns:
-            attributes[col] = defaultdict(int)
-
-        # Keeping track of sentence id
-        sequence_id = 0
-        current_sequence = list()
-
-        with open(data_file, "r", encoding="UTF-8") as input_file:
-            for line in input_file:
-                if re.match("^$", line):
-                    if len(current_sequence) > 0:
-                        if sequence_id in indexes:
-                            for tok in current_sequence:
-                                labels[tok[-1]] += 1
-
-                                for col in features_columns:
-                                    attributes[col][tok[col]] += 1
-
-                        sequence_id += 1
-                        current_sequence.clear()
-
-                    continue
-
-                parts = line.rstrip("\n").split("\t")
-                current_sequence.append(parts)
-
-            if len(current_sequence) > 0:
-                if sequence_id in indexes:
-                    for tok in current_sequence:
-                        labels[tok[-1]] += 1
-
-                        for col in features_columns:
-                            attributes[col][tok[col]] += 1
-
-        return labels, attributes
-
-    @staticmethod
-    def _get_number_sequences(data_file_path):
-        """
-        Get the total number of sequences in a data file
-        :param data_file_path: data file path
-        :return: number of sequences
-        """
-
-        sequence_count = 0
-
-        with open(data_file_path, "r", encoding="UTF-8") as input_file:
-
-            current_sequence = 0
-
-            for i, line in enumerate(input_file, start=1):
-
-                if re.match("^$", line):
-                    if current_sequence > 0:
-                        current_sequence = 0
-                        sequence_count += 1
-                    continue
-
-                current_sequence += 1
-
-            if current_sequence > 0:
-                sequence_count += 1
-
-        return sequence_count
@@ -3,6 +3,7 @@ import os
 
 import numpy as np
 
+from .store import commit_embedding_cache, is_embedding_cached, load_embedding_cache, write_embedding_cache
 from ..error import UnknownTokenAlreadyExists
 
 
@@ -22,27 +23,177 @@ class Embeddings:
         # Embedding matrix
         self.embedding_matrix = None
 
+        # Embedding matrix shape, kept when the matrix is released (see 'release_matrix')
+        self.embedding_matrix_shape = None
+
+        # Preallocated matrix holding the padding vector, the word vectors and the unknown token vector (last row).
+        # 'embedding_matrix' is a view on it, the last row is only exposed by 'build_unknown_token'.
+        self.matrix_storage = None
+
+        # Vocabulary restriction (see 'restrict_vocabulary')
+        self.vocabulary_words = None
+        self.vocabulary_top_k = None
+
     def load_embedding(self):
 
         raise NotImplementedError
 
+    def get_matrix_shape(self):
+        """
+        Get the embedding matrix shape, also available once the matrix has been released
+        :return: matrix shape
+        """
+
+        if self.embedding_matrix is not None:
+            return self.embedding_matrix.shape
+
+        return self.embedding_matrix_shape
+
+    def release_matrix(self):
+        """
+        Release the embedding matrix once it has been loaded into the model (word mapping and matrix shape are kept)
+        :return: number of bytes released
+        """
+
+        if self.embedding_matrix is None:
+            return 0
+
+        self.embedding_matrix_shape = self.embedding_matrix.shape
+
+        storage = self.matrix_storage if self.matrix_storage is not None else self.embedding_matrix
+        nb_bytes = storage.nbytes
+
+        self.embedding_matrix = None
+        self.matrix_storage = None
+
+        return nb_bytes
+
+    def restrict_vocabulary(self, words=None, top_k=None):
+        """
+        Only load the vectors of some words. Must be called before loading the embeddings, only supported by
+        embedding classes which read the embedding file themselves (e.g. word2vec).
+        :param words: words to keep (e.g. normalized tokens of the train, dev and test files)
+        :param top_k: also keep the K first words of the embedding file
+        :return: nothing
+        """
+
+        self.vocabulary_words = set(words) if words is not None else None
+        self.vocabulary_top_k = top_k
+
+    def load_cached_embedding(self, cache_dir):
+        """
+        Load embedding matrix and word mapping from the embedding cache. The cache entry is written from the
+        embedding file the first time it is used, the matrix is then memory-mapped (read-only).
+        :param cache_dir: embedding cache entry directory
+        :return: nothing
+        """
+
+        if is_embedding_cached(cache_dir):
+            logging.debug("-> Embedding cache hit: {}".format(cache_dir))
+        else:
+            logging.debug("-> Embedding cache miss, loading embedding file")
+            self.load_embedding()
+
+            # Writing to a temporary directory first, concurrent runs may compute the same entry
+            temp_dir = "{}.tmp-{}".format(cache_dir, os.getpid())
+
+            if not self._is_unknown_row_reserved():
+                self._reserve_unknown_row()
+
+            logging.debug("-> Writing embedding cache: {}".format(cache_dir))
+            write_embedding_cache(temp_dir, self._get_words(), self.matrix_storage)
+            commit_embedding_cache(temp_dir, cache_dir)
+
+            # Releasing the in-memory matrix, the memory-mapped one is used instead
+            self.embedding_matrix = None
+            self.matrix_storage = None
+
+        words, self.matrix_storage = load_embedding_cache(cache_dir)
+        self.embedding_matrix = self.matrix_storage[:len(words)]
+
+        self.word_mapping = dict()
+        self._build_word_mapping(words[1:])
+
+        logging.debug("-> Matrix dimension: {}".format(self.embedding_matrix.shape))
+
+    def _build_word_mapping(self, words):
+        """
+        Create the word-id mapping, IDs start at 1 (0 is the padding token)
+        :param words: words in embedding file order
+        :return: nothing
+        """
+
+        for i, item in enumerate(words, start=1):
+            self.word_mapping[item] = i
+
+        self.word_mapping["pad_token"] = 0
+
+    def _get_words(self):
+        """
+        Get the word of each embedding matrix row
+        :return: list of words
+        """
+
+        words = [None] * self.embedding_matrix.shape[0]
+
+        for word, i in self.word_mapping.items():
+            words[i] = word
+
+        # A 'pad_token' word of the embedding file is shadowed by the padding token, its row is kept as is
+        return [item if item is not None else "pad_token" for item in words]
+
+    def allocate_matrix(self, nb_words, dimension):
+        """
+        Preallocate a float32 matrix for the padding vector (row 0), the word vectors (rows 1 to nb_words) and the
+        unknown token vector (last row). Padding and unknown token vectors are drawn at random, word vectors are
+        filled in by the loader through 'embedding_matrix'.
+        :param nb_words: number of words in the embedding file
+        :param dimension: embedding dimension
+        :return: nothing
+        """
+
+        self.matrix_storage = np.empty((nb_words + 2, dimension), dtype=np.float32)
+
+        logging.debug("-> Creating padding vector (index=0)")
+        self.matrix_storage[0] = np.random.rand(dimension)
+
+        logging.debug("-> Creating unknown token vector (index={})".format(nb_words + 1))
+        self.matrix_storage[-1] = np.random.rand(dimension)
+
+        self.embedding_matrix = self.matrix_storage[:-1]
+
+    def _is_unknown_row_reserved(self):
+
+        return self.matrix_storage is not None and \
+            self.matrix_storage.shape[0] == self.embedding_matrix.shape[0] + 1
+
+    def _reserve_unknown_row(self):
+        """
+        Copy the embedding matrix to a preallocated matrix (embedding classes which do not call 'allocate_matrix')
+        :return: nothing
+        """
+
+        embedding_matrix = self.embedding_matrix
+
+        self.allocate_matrix(embedding_matrix.shape[0] - 1, embedding_matrix.shape[1])
+        self.embedding_matrix[:] = embedding_matrix
+
     def build_unknown_token(self):
         """
-        Insert an 'unknown' token vector
+        Expose the 'unknown' token vector reserved at the end of the embedding matrix
         :return: nothing
         """
 
         if self.embedding_oov_map_token_id:
             raise Exception("The unknown token already exists")
 
-        logging.debug("-> Creating random vector")
-        unknown_vector = np.random.rand(1, self.embedding_matrix.shape[1])
+        if not self._is_unknown_row_reserved():
+            logging.debug("-> Copying the matrix to reserve the unknown vector row")
+            self._reserve_unknown_row()
 
-        # Appending the unknown token vector to the embedding matrix
+        # The unknown token vector is the last row of the preallocated matrix, no copy is made
         logging.debug("-> Appending the unknown vector to the matrix")
-        self.embedding_matrix = np.append(self.embedding_matrix,
-                                          unknown_vector,
-                                          axis=0)
+        self.embedding_matrix = self.matrix_storage
 
         # Creating a mapping for the unknown token vector
         logging.debug("-> Creating a mapping for the unknown token")
@@ -1,7 +1,6 @@
 import logging
 
 import gensim
-import numpy as np
 
 from .embeddings import Embeddings
 
@@ -21,21 +20,18 @@ class GensimEmbeddings(Embeddings):
         logging.debug("-> Loading gensim file")
         gensim_obj = gensim.models.Word2Vec.load(self.embedding_file_path)
 
-        # Copying gensim object embedding matrix
+        # Copying gensim object embedding matrix to the preallocated matrix (padding and unknown token rows)
         logging.debug("-> Fetching embedding matrix from gensim model")
-        self.embedding_matrix = gensim_obj.wv.syn0
+        vectors = gensim_obj.wv.syn0
+
+        self.allocate_matrix(vectors.shape[0], vectors.shape[1])
+        self.embedding_matrix[1:] = vectors
 
         logging.debug("-> Matrix dimension: {}".format(self.embedding_matrix.shape))
 
         # Creating token-id mapping
         logging.debug("-> Creating word-id mapping")
-        for i, item in enumerate(gensim_obj.wv.index2word, start=1):
-            self.word_mapping[item] = i
-
-        logging.debug("-> Creating padding vector (index=0)")
-        pad_vector = np.random.rand(1, self.embedding_matrix.shape[1])
-        self.embedding_matrix = np.insert(self.embedding_matrix, 0, pad_vector, axis=0)
-        self.word_mapping["pad_token"] = 0
+        self._build_word_mapping(gensim_obj.wv.index2word)
 
         # Deleting gensim object (memory friendly behaviour)
         del gensim_obj
@@ -0,0 +1,151 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+# Increment when the content of the embedding cache changes
+EMBED_CACHE_VERSION = 2
+
+EMBED_CACHE_DIRNAME = "yaset-embed-cache"
+EMBED_MATRIX_FILENAME = "matrix.npy"
+EMBED_VOCAB_FILENAME = "vocab.json"
+
+
+def get_embedding_file_stats(embedding_file_path, block_size=64 * 1024):
+    """
+    List the embedding files with their sizes, modification times and a digest of their first and last blocks.
+    Gensim may store large arrays next to the model file (e.g. 'model.pkl.wv.syn0.npy'), they are listed after the
+    model file. The digest catches files rewritten in place with the same size within the modification time
+    resolution, without reading whole files.
+    :param embedding_file_path: embedding model file path
+    :param block_size: size of the first and last blocks (bytes)
+    :return: list of [path, size, modification time (ns), digest]
+    """
+
+    embedding_file_path = os.path.abspath(embedding_file_path)
+    embedding_files = [embedding_file_path] + sorted(glob.glob("{}.*".format(glob.escape(embedding_file_path))))
+
+    file_stats = list()
+
+    for item in embedding_files:
+        stat = os.stat(item)
+        digest = hashlib.sha1()
+
+        with open(item, "rb") as input_file:
+            digest.update(input_file.read(block_size))
+
+            if stat.st_size > block_size:
+                input_file.seek(max(block_size, stat.st_size - block_size))
+                digest.update(input_file.read(block_size))
+
+        file_stats.append([item, stat.st_size, stat.st_mtime_ns, digest.hexdigest()])
+
+    return file_stats
+
+
+def compute_embedding_key(embedding_file_path, embedding_model_type, vocabulary_words=None, vocabulary_top_k=None):
+    """
+    Compute the embedding cache key from the embedding file paths, sizes, modification times and first and last
+    blocks, and from the vocabulary restriction. Whole file contents are not hashed: the cache is meant to avoid
+    reading large embedding files, a file modified in its middle only without any size or time change is not
+    detected.
+    :param embedding_file_path: embedding model file path
+    :param embedding_model_type: embedding model type (e.g. 'gensim', 'word2vec')
+    :param vocabulary_words: words kept when the vocabulary is restricted
+    :param vocabulary_top_k: number of first words kept when the vocabulary is restricted
+    :return: cache key
+    """
+
+    payload = {
+        "version": EMBED_CACHE_VERSION,
+        "model_type": embedding_model_type,
+        "files": get_embedding_file_stats(embedding_file_path),
+        "vocabulary_words": None,
+        "vocabulary_top_k": vocabulary_top_k
+    }
+
+    if vocabulary_words is not None:
+        payload["vocabulary_words"] = hashlib.sha1("\n".join(sorted(vocabulary_words)).encode("UTF-8")).hexdigest()
+
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def get_embedding_cache_dir(working_dir, key):
+    """
+    Compute the cache directory path for a given key
+    :param working_dir: top working directory
+    :param key: cache key
+    :return: directory path
+    """
+
+    return os.path.join(os.path.abspath(working_dir), EMBED_CACHE_DIRNAME, key)
+
+
+def is_embedding_cached(cache_dir):
+    """
+    Check if a complete embedding cache entry exists
+    :param cache_dir: cache directory
+    :return: boolean
+    """
+
+    return os.path.isfile(os.path.join(cache_dir, EMBED_VOCAB_FILENAME))
+
+
+def write_embedding_cache(cache_dir, words, embedding_matrix):
+    """
+    Write an embedding cache entry: the embedding matrix as a raw .npy file and the vocabulary as a JSON list
+    (word of each matrix row, padding row included)
+    :param cache_dir: cache directory
+    :param words: list of words, in matrix row order
+    :param embedding_matrix: embedding matrix, unknown token vector included (last row, no word)
+    :return: nothing
+    """
+
+    if len(words) + 1 != embedding_matrix.shape[0]:
+        raise Exception("The vocabulary size does not match the embedding matrix: {} != {}".format(
+            len(words) + 1, embedding_matrix.shape[0]))
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    np.save(os.path.join(cache_dir, EMBED_MATRIX_FILENAME), embedding_matrix)
+
+    # The vocabulary is written last, it marks the entry as complete
+    json.dump(words, open(os.path.join(cache_dir, EMBED_VOCAB_FILENAME), "w", encoding="UTF-8"),
+              ensure_ascii=False)
+
+
+def load_embedding_cache(cache_dir):
+    """
+    Load an embedding cache entry. The matrix is memory-mapped (read-only), its pages are shared by all processes
+    using the same entry.
+    :param cache_dir: cache directory
+    :return: list of words in matrix row order, embedding matrix (unknown token vector included)
+    """
+
+    words = json.load(open(os.path.join(cache_dir, EMBED_VOCAB_FILENAME), "r", encoding="UTF-8"))
+    embedding_matrix = np.load(os.path.join(cache_dir, EMBED_MATRIX_FILENAME), mmap_mode="r")
+
+    return words, embedding_matrix
+
+
+def commit_embedding_cache(temp_dir, cache_dir):
+    """
+    Move a freshly written cache entry to its final location. If a concurrent run already created the
+    entry, the temporary one is discarded.
+    :param temp_dir: temporary cache directory
+    :param cache_dir: final cache directory
+    :return: nothing
+    """
+
+    try:
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        if not is_embedding_cached(cache_dir):
+            raise
+
+        logging.info("Embedding cache entry created by another run, discarding this one")
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -1,41 +1,216 @@
+import bz2
+import gzip
 import logging
+import os
 
-import gensim
 import numpy as np
 
 from .embeddings import Embeddings
 
 
+class Word2VecReader:
+    """
+    Streaming reader for word2vec files. The format (text or binary) is detected from the first record after the
+    header. Vectors are read one at a time and vectors of words which are not needed are skipped without being
+    parsed. Files compressed with gzip or bzip2 ('.gz' and '.bz2' extensions) are decompressed on the fly.
+    """
+
+    def __init__(self, file_path):
+
+        self.file_path = os.path.abspath(file_path)
+
+        with self._open() as input_file:
+            header = input_file.readline().decode("UTF-8").split()
+
+            if len(header) != 2:
+                raise Exception("The word2vec header is malformed: {}".format(" ".join(header)))
+
+            self.nb_words, self.dimension = int(header[0]), int(header[1])
+
+            # Byte offset of the first record
+            self.data_offset = input_file.tell()
+
+            self.binary = not self._is_text_record(input_file.readline((self.dimension + 1) * 64))
+
+    def _open(self):
+        """
+        Open the embedding file in binary mode, the opener is chosen from the file extension
+        :return: binary file object
+        """
+
+        if self.file_path.endswith(".gz"):
+            return gzip.open(self.file_path, "rb")
+
+        elif self.file_path.endswith(".bz2"):
+            return bz2.open(self.file_path, "rb")
+
+        return open(self.file_path, "rb")
+
+    def _is_text_record(self, line):
+        """
+        Check if a record is a text record: a word followed by 'dimension' numbers separated by spaces
+        :param line: first line after the header (bytes)
+        :return: boolean
+        """
+
+        if not line.endswith(b"\n") and len(line) == (self.dimension + 1) * 64:
+            return False
+
+        try:
+            parts = line.decode("UTF-8").rstrip().split(" ")
+
+            if len(parts) != self.dimension + 1:
+                return False
+
+            [float(item) for item in parts[1:]]
+
+        except (UnicodeDecodeError, ValueError):
+            return False
+
+        return True
+
+    def iter_vectors(self, keep=None):
+        """
+        Iterate over the vectors of the file
+        :param keep: function (word, rank) -> boolean, vectors of words for which it returns False are skipped
+        (rank starts at 1, in file order)
+        :return: (rank, word, vector) tuples, vector is a float32 array or None if it is skipped
+        """
+
+        with self._open() as input_file:
+            input_file.seek(self.data_offset)
+
+            for rank in range(1, self.nb_words + 1):
+                if self.binary:
+                    word = self._read_binary_word(input_file)
+
+                    if keep is None or keep(word, rank):
+                        vector = np.frombuffer(input_file.read(self.dimension * 4), dtype=np.float32)
+
+                        if vector.shape[0] != self.dimension:
+                            raise Exception("Unexpected end of word2vec file: {}".format(self.file_path))
+                    else:
+                        vector = None
+                        input_file.seek(self.dimension * 4, os.SEEK_CUR)
+
+                else:
+                    line = input_file.readline()
+
+                    if line == b"":
+                        raise Exception("Unexpected end of word2vec file: {}".format(self.file_path))
+
+                    word, _, values = line.decode("UTF-8").rstrip().partition(" ")
+
+                    if keep is None or keep(word, rank):
+                        vector = np.array(values.split(" "), dtype=np.float32)
+
+                        if vector.shape[0] != self.dimension:
+                            raise Exception("Invalid vector size in word2vec file (line {}): {}".format(
+                                rank + 1, self.file_path))
+                    else:
+                        vector = None
+
+                yield rank, word, vector
+
+    def _read_binary_word(self, input_file):
+        """
+        Read a word from a binary word2vec file: bytes up to the next space, line breaks being ignored
+        :param input_file: binary file object positioned at the beginning of a record
+        :return: word
+        """
+
+        word = b""
+
+        while True:
+            buffer = input_file.peek(1)
+
+            if buffer == b"":
+                raise Exception("Unexpected end of word2vec file: {}".format(self.file_path))
+
+            position = buffer.find(b" ")
+
+            if position >= 0:
+                word += input_file.read(position + 1)[:-1]
+                break
+
+            word += input_file.read(len(buffer))
+
+        return word.replace(b"\n", b"").decode("UTF-8")
+
+
 class Word2VecEmbeddings(Embeddings):
 
     def load_embedding(self):
         """
-        Load embedding matrix and word count from gensim object
+        Load embedding matrix and word-id mapping from a word2vec file (text or binary format). If the vocabulary is
+        restricted, only the vectors of the selected words are read.
         :return: nothing
         """
 
-        # Loading gensim object
         logging.debug("-> Loading word2vec file")
-        try:
-            gensim_obj = gensim.models.KeyedVectors.load_word2vec_format(self.embedding_file_path)
-        except UnicodeDecodeError:
-            gensim_obj = gensim.models.KeyedVectors.load_word2vec_format(self.embedding_file_path, binary=True)
+        reader = Word2VecReader(self.embedding_file_path)
+
+        logging.debug("-> Format: {}, {:,} words, dimension={}".format("binary" if reader.binary else "text",
+                                                                       reader.nb_words, reader.dimension))
+
+        words = list()
+        seen_words = set()
 
-        # Copying gensim object embedding matrix
-        logging.debug("-> Fetching embedding matrix from model")
-        self.embedding_matrix = gensim_obj.wv.syn0
+        if self.vocabulary_words is None and self.vocabulary_top_k is None:
+            # Vectors are copied to the preallocated matrix as they are read
+            self.allocate_matrix(reader.nb_words, reader.dimension)
+
+            for _, word, vector in reader.iter_vectors():
+                if word in seen_words:
+                    logging.debug("-> Duplicate word, ignoring all but first: {}".format(word))
+                    continue
+
+                seen_words.add(word)
+                words.append(word)
+
+                self.embedding_matrix[len(words)] = vector
+
+            if len(words) < reader.nb_words:
+                self._truncate_matrix(len(words))
+
+        else:
+            vectors = list()
+
+            for _, word, vector in reader.iter_vectors(keep=self._keep_word):
+                if vector is None or word in seen_words:
+                    continue
+
+                seen_words.add(word)
+                words.append(word)
+                vectors.append(vector)
+
+            self.allocate_matrix(len(words), reader.dimension)
+
+            if len(vectors) > 0:
+                self.embedding_matrix[1:] = vectors
+
+            logging.info("* vectors read: {:,} out of {:,}".format(len(words), reader.nb_words))
 
         logging.debug("-> Matrix dimension: {}".format(self.embedding_matrix.shape))
 
         # Creating token-id mapping
         logging.debug("-> Creating word-id mapping")
-        for i, item in enumerate(gensim_obj.wv.index2word, start=1):
-            self.word_mapping[item] = i
+        self._build_word_mapping(words)
+
+    def _keep_word(self, word, rank):
+
+        if self.vocabulary_top_k is not None and rank <= self.vocabulary_top_k:
+            return True
 
-        logging.debug("-> Creating padding vector (index=0)")
-        pad_vector = np.random.rand(1, self.embedding_matrix.shape[1])
-        self.embedding_matrix = np.insert(self.embedding_matrix, 0, pad_vector, axis=0)
-        self.word_mapping["pad_token"] = 0
+        return self.vocabulary_words is not None and word in self.vocabulary_words
+
+    def _truncate_matrix(self, nb_words):
+        """
+        Shrink the preallocated matrix when the file holds fewer distinct words than its header announces
+        :param nb_words: number of distinct words read
+        :return: nothing
+        """
 
-        # Deleting gensim object
-        del gensim_obj
+        self.matrix_storage[nb_words + 1] = self.matrix_storage[-1]
+        self.matrix_storage = self.matrix_storage[:nb_words + 2]
+        self.embedding_matrix = self.matrix_storage[:-1]
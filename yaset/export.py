@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from .apply import load_model_params
+from .data.index import CorpusIndex
+from .data.normalize import TokenNormalizer
+from .nn.frozen import EXPORT_DESC_FILENAME, EXPORT_GRAPH_FILENAME, FrozenTagger, build_inference_graph
+from .nn.helpers import get_best_model
+from .tools import ensure_dir, log_message
+
+# Graph transforms applied to the frozen graph
+EXPORT_TRANSFORMS = [
+    "remove_nodes(op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "sort_by_execution_order"
+]
+
+
+def select_vocabulary(data_char, corpus_files=None, top_k=None, allow_list_file=None):
+    """
+    Select the words kept in an exported model. The padding and unknown tokens are always kept.
+    :param data_char: data characteristics of the model (data_char.json)
+    :param corpus_files: keep the words of these tabulated files (e.g. train and dev files)
+    :param top_k: keep the K first words of the embedding file (word2vec files are sorted by decreasing frequency),
+    word IDs must follow the embedding file order
+    :param allow_list_file: keep the words listed in this file (one word per line)
+    :return: sorted array of kept word IDs
+    """
+
+    word_mapping = data_char["word_mapping"]
+
+    normalizer = TokenNormalizer(lower_input=data_char["lower_input"], replace_digits=data_char["replace_digits"])
+
+    kept_ids = {0}
+
+    if data_char["embedding_unknown_token_id"] in word_mapping:
+        kept_ids.add(word_mapping[data_char["embedding_unknown_token_id"]])
+
+    if corpus_files:
+        for corpus_file in corpus_files:
+            counts = CorpusIndex(corpus_file, labelled=False).build().counts
+            words = counts.get_normalized_token_counts(normalizer)
+
+            nb_ids = len(kept_ids)
+            kept_ids.update([word_mapping[word] for word in words if word in word_mapping])
+
+            logging.info("* words from {}: {:,} ({:,} new)".format(corpus_file, len(words), len(kept_ids) - nb_ids))
+
+    if top_k is not None:
+        nb_ids = len(kept_ids)
+        kept_ids.update(range(1, min(top_k, len(word_mapping) - 1) + 1))
+
+        logging.info("* top-{:,} words: {:,} new".format(top_k, len(kept_ids) - nb_ids))
+
+    if allow_list_file is not None:
+        with open(os.path.abspath(allow_list_file), "r", encoding="UTF-8") as input_file:
+            words = set([normalizer.normalize(line.rstrip("\n")) for line in input_file if line.strip() != ""])
+
+        nb_ids = len(kept_ids)
+        kept_ids.update([word_mapping[word] for word in words if word in word_mapping])
+
+        logging.info("* allow-list words: {:,} ({:,} new)".format(len(words), len(kept_ids) - nb_ids))
+
+    return np.array(sorted(kept_ids), dtype=np.int64)
+
+
+def prune_data_char(data_char, kept_ids):
+    """
+    Re-index the word mapping of a model on a subset of words
+    :param data_char: data characteristics of the model (data_char.json)
+    :param kept_ids: sorted array of kept word IDs (ID 0 included)
+    :return: new data characteristics (shallow copy)
+    """
+
+    new_ids = {int(old_id): new_id for new_id, old_id in enumerate(kept_ids)}
+
+    pruned_data_char = dict(data_char)
+    pruned_data_char["word_mapping"] = {word: new_ids[old_id] for word, old_id in data_char["word_mapping"].items()
+                                        if old_id in new_ids}
+    pruned_data_char["embedding_matrix_shape"] = [len(kept_ids), data_char["embedding_matrix_shape"][1]]
+
+    return pruned_data_char
+
+
+def export_model(model_path, target_dir, keep_train_words=False, corpus_files=None, top_k=None,
+                 allow_list_file=None):
+    """
+    Export a model as a single frozen inference graph: variables are converted to constants (transition matrix
+    included), vocabulary and label lookup tables are part of the graph and the Viterbi decoding is done in the
+    graph. Training Ops and optimizer variables are not exported. The vocabulary can be pruned, the word embedding
+    matrix being re-indexed accordingly (words that are not kept are mapped to the unknown token).
+    :param model_path: yaset model path
+    :param target_dir: directory where the exported model will be written
+    :param keep_train_words: keep the words of the train (and dev) files listed in the model configuration
+    :param corpus_files: keep the words of these tabulated files
+    :param top_k: keep the K first words of the embedding file
+    :param allow_list_file: keep the words listed in this file
+    :return: nothing
+    """
+
+    log_message("BEGIN - BUILDING INFERENCE GRAPH")
+
+    data_char_file = os.path.join(model_path, "data_char.json")
+
+    start = time.time()
+    data_char = json.load(open(data_char_file, "r", encoding="UTF-8"))
+    data_char_load_time = time.time() - start
+
+    data_params, training_params, model_params = load_model_params(model_path)
+
+    # Word IDs only follow the embedding file order when the whole embedding file was loaded
+    if top_k is not None and data_params.get("embedding_corpus_vocabulary"):
+        raise Exception("The K first words of the embedding file cannot be selected, the model was trained with "
+                        "a restricted embedding vocabulary (embedding_corpus_vocabulary)")
+
+    corpus_files = list(corpus_files) if corpus_files else list()
+
+    if keep_train_words:
+        corpus_files.append(data_params["train_file_path"])
+
+        if data_params.get("dev_file_use"):
+            corpus_files.append(data_params["dev_file_path"])
+
+    for corpus_file in corpus_files:
+        if not os.path.isfile(os.path.abspath(corpus_file)):
+            raise FileNotFoundError("The corpus file you specified does not exist: {}".format(
+                os.path.abspath(corpus_file)))
+
+    prune = len(corpus_files) > 0 or top_k is not None or allow_list_file is not None
+
+    if prune:
+        logging.info("Selecting vocabulary")
+
+        kept_ids = select_vocabulary(data_char, corpus_files=corpus_files, top_k=top_k,
+                                     allow_list_file=allow_list_file)
+
+        export_data_char = prune_data_char(data_char, kept_ids)
+
+        logging.info("* vocabulary: {:,} -> {:,} words".format(len(data_char["word_mapping"]),
+                                                               len(export_data_char["word_mapping"])))
+    else:
+        kept_ids = None
+        export_data_char = data_char
+
+    tf.reset_default_graph()
+
+    model, inputs, outputs, init_tables = build_inference_graph(export_data_char, training_params, model_params)
+
+    log_message("END - BUILDING INFERENCE GRAPH")
+
+    log_message("BEGIN - FREEZING MODEL")
+
+    # Retrieving model filename based on training statistics
+    best_filename = os.path.join(model_path, "tfmodels",
+                                 get_best_model(os.path.join(model_path, "train_stats.json")))
+
+    logging.info("* checkpoint: {}".format(best_filename))
+
+    # The word embedding matrix (and its scales if quantized) is restored separately when the vocabulary is pruned
+    word_variables = [item for item in [model.W, model.W_scales] if item is not None]
+
+    if prune:
+        saver = tf.train.Saver([item for item in tf.global_variables() if item not in word_variables])
+    else:
+        saver = tf.train.Saver(tf.global_variables())
+
+    with tf.Session() as sess:
+        start = time.time()
+        saver.restore(sess, best_filename)
+
+        if prune:
+            for variable in word_variables:
+                values = tf.train.load_variable(best_filename, variable.op.name)
+                variable.load(values[kept_ids], sess)
+
+                logging.info("* {}: {:,} -> {:,} bytes".format(variable.op.name, values.nbytes,
+                                                               values[kept_ids].nbytes))
+
+                del values
+
+        checkpoint_load_time = time.time() - start
+
+        output_node_names = [tensor.op.name for tensor in outputs.values()] + [init_tables.name]
+
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_node_names)
+
+    # Inputs that are not used by the model (e.g. characters) are not part of the frozen graph
+    node_names = set([node.name for node in graph_def.node])
+    inputs = {k: v for k, v in inputs.items() if v.op.name in node_names}
+
+    nb_nodes = len(graph_def.node)
+
+    graph_def = _transform_graph(graph_def, [tensor.op.name for tensor in inputs.values()], output_node_names)
+
+    logging.info("* nb. graph nodes: {:,} (before transforms: {:,})".format(len(graph_def.node), nb_nodes))
+
+    log_message("END - FREEZING MODEL")
+
+    ensure_dir(target_dir)
+
+    tf.train.write_graph(graph_def, target_dir, EXPORT_GRAPH_FILENAME, as_text=False)
+
+    payload = {
+        "graph_file": EXPORT_GRAPH_FILENAME,
+        "model_type": training_params["model_type"],
+        "lower_input": data_char["lower_input"],
+        "replace_digits": data_char["replace_digits"],
+        "labels": sorted(data_char["label_mapping"], key=data_char["label_mapping"].get),
+        "inputs": {k: v.name for k, v in inputs.items()},
+        "outputs": {k: v.name for k, v in outputs.items()},
+        "init_op": init_tables.name
+    }
+
+    json.dump(payload, open(os.path.join(target_dir, EXPORT_DESC_FILENAME), "w", encoding="UTF-8"), indent=2)
+
+    # Comparing sizes and loading times with the original model
+    checkpoint_size = sum([os.path.getsize(item) for item in tf.gfile.Glob("{}.*".format(best_filename))])
+    export_size = os.path.getsize(os.path.join(target_dir, EXPORT_GRAPH_FILENAME))
+
+    start = time.time()
+    FrozenTagger(target_dir).close()
+    export_load_time = time.time() - start
+
+    logging.info("* exported model: {}".format(os.path.abspath(target_dir)))
+    logging.info("* size: {:,} bytes (checkpoint and data_char.json: {:,} bytes)".format(
+        export_size, checkpoint_size + os.path.getsize(data_char_file)))
+    logging.info("* loading time: {:.2f}s (checkpoint restore and data_char.json: {:.2f}s)".format(
+        export_load_time, checkpoint_load_time + data_char_load_time))
+
+
+def _transform_graph(graph_def, input_names, output_names):
+    """
+    Fold constants and remove debug Ops from a frozen graph
+    :param graph_def: frozen GraphDef
+    :param input_names: input node names
+    :param output_names: output node names
+    :return: transformed GraphDef
+    """
+
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    return TransformGraph(graph_def, input_names, output_names, EXPORT_TRANSFORMS)
@@ -12,6 +12,11 @@ def extract_params(config_section, param_desc_file):
 
     param_desc = json.load(open(os.path.abspath(param_desc_file), "r", encoding="UTF-8"))
 
+    # Parameters added after a configuration file was written (e.g. the one stored with a model) take their default
+    # value when missing
+    if param_desc.get("default_values"):
+        config_section = {**param_desc["default_values"], **dict(config_section.items())}
+
     parameters = _params_recur(config_section, param_desc)
 
     return parameters
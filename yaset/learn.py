@@ -1,17 +1,22 @@
 import importlib
 import logging
 import os
+import shutil
 import time
 
 import pkg_resources
 
+from .data.cache import PREPROC_CACHE_FILENAME, commit_preprocessing_cache, compute_preprocessing_key, \
+    get_preprocessing_cache_dir, get_vocabulary_files, is_preprocessing_cached, is_preprocessing_reproducible
 from .data.reader import TrainData
+from .embed.store import compute_embedding_key, get_embedding_cache_dir
 from .helpers.config import extract_params
+from .nn.models.lstm import WORD_EMBEDDING_DTYPES
 from .nn.train import train_model
 from .tools import ensure_dir, log_message
 
 
-def learn_model(parsed_configuration):
+def learn_model(parsed_configuration, use_preproc_cache=True, use_embed_cache=True):
 
     # ---------------------------------------------------------------
     # PARAMETER LOADING
@@ -31,6 +36,15 @@ def learn_model(parsed_configuration):
     else:
         raise Exception("The model type you specified does not exist: {}".format(training_params["model_type"]))
 
+    # Half-precision and quantized word embedding tables can not be fine-tuned
+    if training_params["word_embedding_storage"] not in WORD_EMBEDDING_DTYPES:
+        raise Exception("The word embedding storage you specified does not exist: {}".format(
+            training_params["word_embedding_storage"]))
+
+    if training_params["word_embedding_storage"] != "float32" and training_params["trainable_word_embeddings"]:
+        raise Exception("Word embeddings stored as {} can not be fine-tuned, set 'trainable_word_embeddings' to "
+                        "false".format(training_params["word_embedding_storage"]))
+
     # Checking if the working directory specified in the configuration exists
     if not os.path.isdir(os.path.abspath(data_params.get("working_dir"))):
         raise NotADirectoryError("The working directory you specified does not exist: {}".format(
@@ -86,90 +100,197 @@ def learn_model(parsed_configuration):
     #     feature_columns = parse_feature_columns(parsed_configuration["data"]["feature_columns"])
 
     # -----------------------------------------------------------
-    # LOADING AND CHECKING DATA FILES
+    # PREPROCESSING CACHE
 
-    log_message("BEGIN - LOADING AND CHECKING DATA FILES")
+    # TFRecords files and mappings only depend on the data files, the embedding model and the 'data' parameters.
+    # They are stored in a content-addressed cache shared by all runs using the same top working directory.
+    preproc_cache_dir = None
+    preproc_temp_dir = None
+    preproc_cache_hit = False
+    tfrecords_dir_path = None
 
-    # Creating data object
-    data = TrainData(working_dir=current_working_directory, data_params=data_params)
+    if use_preproc_cache and not is_preprocessing_reproducible(data_params):
+        logging.info("No random seed set for the dev split or singleton replacement, preprocessing cache disabled")
+        use_preproc_cache = False
 
-    # Checking file format
-    data.check_input_files()
+    if use_preproc_cache:
 
-    log_message("END - LOADING AND CHECKING DATA FILES")
+        log_message("BEGIN - CHECKING PREPROCESSING CACHE")
 
-    # -----------------------------------------------------------
-    # EMBEDDING LOADING AND PROCESSING
+        preproc_key = compute_preprocessing_key(data_params, training_params["cpu_cores"])
+        preproc_cache_dir = get_preprocessing_cache_dir(data_params.get("working_dir"), preproc_key)
+        preproc_cache_hit = is_preprocessing_cached(preproc_cache_dir)
+
+        logging.info("Cache key: {}".format(preproc_key))
+        logging.info("Cache {}: {}".format("hit" if preproc_cache_hit else "miss", preproc_cache_dir))
+
+        if not preproc_cache_hit:
+            # Writing to a temporary directory first, concurrent runs may compute the same entry
+            preproc_temp_dir = "{}.tmp-{}".format(preproc_cache_dir, os.getpid())
+            tfrecords_dir_path = os.path.join(preproc_temp_dir, "tfrecords")
+
+        log_message("END - CHECKING PREPROCESSING CACHE")
+
+    # The temporary cache entry is removed if preprocessing fails (it is moved to its final location otherwise)
+    try:
+        # -----------------------------------------------------------
+        # LOADING AND CHECKING DATA FILES
+
+        log_message("BEGIN - LOADING AND CHECKING DATA FILES")
+
+        # Creating data object
+        data = TrainData(working_dir=current_working_directory, data_params=data_params,
+                         tfrecords_dir_path=tfrecords_dir_path)
+
+        # Checking additional files used to restrict the embedding vocabulary
+        for vocabulary_file in get_vocabulary_files(data_params):
+            if not os.path.isfile(vocabulary_file):
+                raise FileNotFoundError("The vocabulary file you specified does not exist: {}".format(vocabulary_file))
+
+        # Checking file format
+        if preproc_cache_hit:
+            logging.info("Data files have already been checked and preprocessed, skipping")
+        else:
+            data.check_input_files()
+
+        log_message("END - LOADING AND CHECKING DATA FILES")
+
+        # -----------------------------------------------------------
+        # EMBEDDING LOADING AND PROCESSING
+
+        log_message("BEGIN - EMBEDDING LOADING AND PREPROCESSING")
+
+        embedding_model_type = data_params.get("embedding_model_type")
+
+        if embedding_model_type is not "random":
+            # Case where the model type is not random
+
+            logging.info("Model type: {}".format(embedding_model_type))
+
+            # Checking if the embedding model path does exist
+            embedding_file_path = os.path.abspath(data_params.get("embedding_model_path"))
 
-    log_message("BEGIN - EMBEDDING LOADING AND PREPROCESSING")
+            if not os.path.isfile(embedding_file_path):
+                raise FileNotFoundError("The embedding file you specified doesn't exist: {}".format(
+                    embedding_file_path
+                ))
 
-    embedding_model_type = data_params.get("embedding_model_type")
+            logging.info("File path: {}".format(embedding_file_path))
 
-    if embedding_model_type is not "random":
-        # Case where the model type is not random
+            embedding_oov_strategy = data_params.get("embedding_oov_strategy")
+            embedding_oov_map_token_id = None
+            embedding_oov_replace_rate = None
 
-        logging.info("Model type: {}".format(embedding_model_type))
+            if embedding_oov_strategy == "map":
+                embedding_oov_map_token_id = data_params.get("embedding_oov_map_token_id")
 
-        # Checking if the embedding model path does exist
-        embedding_file_path = os.path.abspath(data_params.get("embedding_model_path"))
+            elif embedding_oov_strategy == "replace":
+                embedding_oov_replace_rate = data_params.get("embedding_oov_replace_rate")
 
-        if not os.path.isfile(embedding_file_path):
-            raise FileNotFoundError("The embedding file you specified doesn't exist: {}".format(
-                embedding_file_path
-            ))
+            elif embedding_oov_strategy == "none":
+                pass
 
-        logging.info("File path: {}".format(embedding_file_path))
+            else:
+                raise Exception("The OOV strategy you specified is not recognized: {}".format(embedding_oov_strategy))
 
-        embedding_oov_strategy = data_params.get("embedding_oov_strategy")
-        embedding_oov_map_token_id = None
-        embedding_oov_replace_rate = None
+            # Dynamic loading of embedding module. Allow to write custom modules for specific model formats.
+            logging.debug("Creating embedding object")
+            embedding_module = importlib.import_module("yaset.embed.{}".format(embedding_model_type))
+            embedding_class = getattr(embedding_module, "{}Embeddings".format(embedding_model_type.title()))
+            embedding_object = embedding_class(embedding_file_path, embedding_oov_strategy, embedding_oov_map_token_id)
 
-        if embedding_oov_strategy == "map":
-            embedding_oov_map_token_id = data_params.get("embedding_oov_map_token_id")
+            if data_params.get("embedding_corpus_vocabulary"):
+                # Only the vectors of the corpus tokens (and of the K first words if requested) are loaded
+                logging.info("Computing corpus vocabulary")
+                vocabulary_words = data.get_corpus_vocabulary(extra_files=get_vocabulary_files(data_params))
 
-        elif embedding_oov_strategy == "replace":
-            embedding_oov_replace_rate = data_params.get("embedding_oov_replace_rate")
+                if embedding_oov_map_token_id:
+                    vocabulary_words.add(embedding_oov_map_token_id)
 
-        elif embedding_oov_strategy == "none":
-            pass
+                vocabulary_top_k = data_params.get("embedding_vocabulary_top_k")
+                vocabulary_top_k = vocabulary_top_k if vocabulary_top_k > 0 else None
+
+                logging.info("* corpus vocabulary: {:,} words (top-K words: {})".format(
+                    len(vocabulary_words), vocabulary_top_k))
+
+                embedding_object.restrict_vocabulary(words=vocabulary_words, top_k=vocabulary_top_k)
+
+            # Loading embedding matrix into embedding object
+            logging.info("Loading matrix")
+
+            if use_embed_cache:
+                # The matrix is stored in a memory-mapped format shared by all runs using the same top working directory
+                embed_cache_key = compute_embedding_key(embedding_file_path, embedding_model_type,
+                                                        vocabulary_words=embedding_object.vocabulary_words,
+                                                        vocabulary_top_k=embedding_object.vocabulary_top_k)
+                embed_cache_dir = get_embedding_cache_dir(data_params.get("working_dir"), embed_cache_key)
+
+                logging.info("Embedding cache: {}".format(embed_cache_dir))
+                embedding_object.load_cached_embedding(embed_cache_dir)
+            else:
+                embedding_object.load_embedding()
+
+            logging.info("Matrix dimension: {}".format(embedding_object.embedding_matrix.shape))
+
+            if embedding_oov_strategy == "replace":
+                logging.info("Building unknown token vector")
+                _ = embedding_object.build_unknown_token()
+
+            elif embedding_oov_strategy == "map":
+                logging.info("Unknown token vector already exists, skipping building new one (id={})".format(
+                    embedding_oov_map_token_id
+                ))
+
+            elif embedding_oov_strategy == "none":
+                logging.info("No unknown token vector is build")
 
         else:
-            raise Exception("The OOV strategy you specified is not recognized: {}".format(embedding_oov_strategy))
+            # Random embedding will be supported in a later release
+            raise Exception("Random embeddings are not supported yet")
 
-        # Dynamic loading of embedding module. Allow to write custom modules for specific model formats.
-        logging.debug("Creating embedding object")
-        embedding_module = importlib.import_module("yaset.embed.{}".format(embedding_model_type))
-        embedding_class = getattr(embedding_module, "{}Embeddings".format(embedding_model_type.title()))
-        embedding_object = embedding_class(embedding_file_path, embedding_oov_strategy, embedding_oov_map_token_id)
+        log_message("END - EMBEDDING LOADING AND PREPROCESSING")
 
-        # Loading embedding matrix into embedding object
-        logging.info("Loading matrix")
-        embedding_object.load_embedding()
+        unknown_token_files = [data.unknown_tokens_train_file, data.unknown_tokens_dev_file]
 
-        if embedding_oov_strategy == "replace":
-            logging.info("Building unknown token vector")
-            _ = embedding_object.build_unknown_token()
+        if preproc_cache_hit:
 
-        elif embedding_oov_strategy == "map":
-            logging.info("Unknown token vector already exists, skipping building new one (id={})".format(
-                embedding_oov_map_token_id
-            ))
+            log_message("BEGIN - LOADING TFRECORDS FILES FROM CACHE")
 
-        elif embedding_oov_strategy == "none":
-            logging.info("No unknown token vector is build")
+            data.load_preprocessing(os.path.join(preproc_cache_dir, PREPROC_CACHE_FILENAME))
 
-    else:
-        # Random embedding will be supported in a later release
-        raise Exception("Random embeddings are not supported yet")
+            for unknown_token_file in unknown_token_files:
+                shutil.copy(os.path.join(preproc_cache_dir, os.path.basename(unknown_token_file)), unknown_token_file)
+
+            logging.info("* nb. train shards: {}".format(len(data.tfrecords_train_files)))
+            logging.info("* nb. dev shards: {}".format(len(data.tfrecords_dev_files)))
+
+            log_message("END - LOADING TFRECORDS FILES FROM CACHE")
+
+        else:
+
+            log_message("BEGIN - CREATING TFRECORDS FILES")
+
+            data.create_tfrecords_files(embedding_object, oov_strategy=embedding_oov_strategy,
+                                        unk_token_rate=embedding_oov_replace_rate,
+                                        nb_processes=training_params["cpu_cores"])
+
+            if use_preproc_cache:
+                logging.info("Storing TFRecords files in preprocessing cache")
+
+                for unknown_token_file in unknown_token_files:
+                    shutil.copy(unknown_token_file, preproc_temp_dir)
 
-    log_message("END - EMBEDDING LOADING AND PREPROCESSING")
+                data.dump_preprocessing(os.path.join(preproc_temp_dir, PREPROC_CACHE_FILENAME))
+                commit_preprocessing_cache(preproc_temp_dir, preproc_cache_dir)
 
-    log_message("BEGIN - CREATING TFRECORDS FILES")
+                # Pointing to the final cache location
+                data.load_preprocessing(os.path.join(preproc_cache_dir, PREPROC_CACHE_FILENAME))
 
-    data.create_tfrecords_files(embedding_object, oov_strategy=embedding_oov_strategy,
-                                unk_token_rate=embedding_oov_replace_rate)
+            log_message("END - CREATING TFRECORDS FILES")
 
-    log_message("END - CREATING TFRECORDS FILES")
+    finally:
+        if preproc_temp_dir is not None:
+            shutil.rmtree(preproc_temp_dir, ignore_errors=True)
 
     log_message("BEGIN - LEARNING MODEL")
 
@@ -0,0 +1,119 @@
+import logging
+import time
+
+import numpy as np
+
+
+def viterbi_decode_batch(unary_scores, sequence_lengths, transition_params):
+    """
+    Decode a padded batch of sequences with the Viterbi algorithm. START (id=nb_classes) and END
+    (id=nb_classes+1) states are added around each sequence as done during training.
+    :param unary_scores: unary scores [batch_size, seq_len, nb_classes]
+    :param sequence_lengths: sequence lengths [batch_size]
+    :param transition_params: transition matrix [nb_classes + 2, nb_classes + 2]
+    :return: label IDs [batch_size, seq_len] (values beyond sequence lengths are meaningless) and
+    Viterbi scores [batch_size]
+    """
+
+    unary_scores = np.asarray(unary_scores)
+    sequence_lengths = np.asarray(sequence_lengths, dtype=np.int64)
+    transition_params = np.asarray(transition_params, dtype=np.float64)
+
+    batch_size, max_len, nb_classes = unary_scores.shape
+    nb_states = nb_classes + 2
+
+    batch_range = np.arange(batch_size)
+
+    # Tiling and adding START and END tokens [batch_size, seq_len + 2, nb_states]
+    scores = np.full((batch_size, max_len + 2, nb_states), -1000.0, dtype=np.float64)
+    scores[:, 0, nb_classes] = 0.0
+    scores[:, 1:max_len + 1, :nb_classes] = unary_scores
+
+    end_positions = sequence_lengths + 1
+    scores[batch_range, end_positions, :] = -1000.0
+    scores[batch_range, end_positions, nb_classes + 1] = 0.0
+
+    # Past the END state, scores are kept and backpointers point to the same state
+    identity = np.arange(nb_states)
+
+    trellis = scores[:, 0, :]
+    backpointers = np.empty((max_len + 2, batch_size, nb_states), dtype=np.int64)
+
+    for t in range(1, max_len + 2):
+        v = trellis[:, :, np.newaxis] + transition_params[np.newaxis, :, :]
+
+        best_previous = np.argmax(v, axis=1)
+        new_trellis = scores[:, t, :] + np.max(v, axis=1)
+
+        active = (t <= end_positions)[:, np.newaxis]
+
+        trellis = np.where(active, new_trellis, trellis)
+        backpointers[t] = np.where(active, best_previous, identity)
+
+    # Backtracking
+    labels = np.empty((batch_size, max_len + 2), dtype=np.int64)
+
+    current = np.argmax(trellis, axis=1)
+    viterbi_scores = trellis[batch_range, current]
+
+    labels[:, max_len + 1] = current
+
+    for t in range(max_len + 1, 0, -1):
+        current = backpointers[t][batch_range, current]
+        labels[:, t - 1] = current
+
+    return labels[:, 1:max_len + 1], viterbi_scores
+
+
+class ViterbiDecoder:
+    """
+    Viterbi decoder owning the CRF transition matrix, fetched once per dev pass or APPLY run. Decoding time
+    is accumulated to report the per-sentence decoding cost.
+    """
+
+    def __init__(self, transition_params):
+
+        self.transition_params = np.asarray(transition_params, dtype=np.float64)
+
+        self.nb_sequences = 0
+        self.decode_time = 0.0
+
+    @classmethod
+    def from_session(cls, sess, model):
+        """
+        Create a decoder from the transition matrix of a model
+        :param sess: TensorFlow session
+        :param model: model object (BiLSTMCRF)
+        :return: ViterbiDecoder object
+        """
+
+        return cls(sess.run(model.transition_params))
+
+    def decode(self, unary_scores, sequence_lengths):
+        """
+        Decode a padded batch of sequences
+        :param unary_scores: unary scores [batch_size, seq_len, nb_classes]
+        :param sequence_lengths: sequence lengths [batch_size]
+        :return: list of label ID arrays (one per sequence, trimmed to its length)
+        """
+
+        start = time.time()
+
+        labels, _ = viterbi_decode_batch(unary_scores, sequence_lengths, self.transition_params)
+        sequences = [labels_[:seq_len_] for labels_, seq_len_ in zip(labels, sequence_lengths)]
+
+        self.decode_time += time.time() - start
+        self.nb_sequences += len(sequences)
+
+        return sequences
+
+    def log_stats(self):
+
+        if self.nb_sequences == 0:
+            return
+
+        logging.info("* decoding: {:,} sequences in {:.3f}s ({:.3f} ms/sequence)".format(
+            self.nb_sequences,
+            self.decode_time,
+            (self.decode_time / self.nb_sequences) * 1000
+        ))
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from .models.lstm import BiLSTMCRF, add_start_end_states
+from ..data.normalize import TokenNormalizer
+
+EXPORT_GRAPH_FILENAME = "model.pb"
+EXPORT_DESC_FILENAME = "export.json"
+
+
+def build_lookup_inputs(data_char, tokens, lengths, chars):
+    """
+    Convert string inputs to the ID tensors expected by the model, with the same conventions as
+    TestData.encode_sequence and pad_sequences: unknown words are mapped to the unknown token, unknown characters
+    are skipped and tokens without any known character get one padding character
+    :param data_char: data characteristics of the model (data_char.json)
+    :param tokens: normalized tokens [batch_size, seq_len] (string)
+    :param lengths: sequence lengths [batch_size] (int32)
+    :param chars: token characters after digit replacement [batch_size, seq_len, token_len] (string, padding: "")
+    :return: token IDs [batch_size, seq_len], character IDs [batch_size, seq_len, token_len], token lengths in
+    characters [batch_size, seq_len]
+    """
+
+    # Models trained without unknown token map unknown words to the padding token
+    unknown_id = data_char["word_mapping"].get(data_char["embedding_unknown_token_id"], 0)
+
+    # ID 0 is the padding token, which is also replaced by the unknown token at test time
+    word_items = [(k, v) for k, v in data_char["word_mapping"].items() if v != 0]
+    word_table = tf.contrib.lookup.HashTable(
+        tf.contrib.lookup.KeyValueTensorInitializer([k for k, _ in word_items], [v for _, v in word_items],
+                                                    key_dtype=tf.string, value_dtype=tf.int64),
+        default_value=unknown_id, name="word_table")
+
+    char_items = list(data_char["char_mapping"].items())
+    char_table = tf.contrib.lookup.HashTable(
+        tf.contrib.lookup.KeyValueTensorInitializer([k for k, _ in char_items], [v for _, v in char_items],
+                                                    key_dtype=tf.string, value_dtype=tf.int64),
+        default_value=-1, name="char_table")
+
+    token_mask = tf.sequence_mask(lengths, tf.shape(tokens)[1])
+
+    x_tokens = tf.cast(word_table.lookup(tokens), tf.int32)
+    x_tokens = tf.where(token_mask, x_tokens, tf.zeros_like(x_tokens))
+
+    char_ids = tf.cast(char_table.lookup(chars), tf.int32)
+    token_len = tf.shape(chars)[2]
+
+    # Moving known characters first, in their original order
+    known = tf.cast(char_ids >= 0, tf.float32)
+    positions = tf.cast(tf.range(token_len), tf.float32)
+    _, order = tf.nn.top_k(-(positions + (1.0 - known) * tf.cast(token_len, tf.float32)), k=token_len)
+
+    x_chars = tf.reduce_sum(tf.one_hot(order, token_len, dtype=tf.int32) * tf.expand_dims(char_ids, 2), 3)
+
+    nb_known = tf.cast(tf.reduce_sum(known, 2), tf.int32)
+    x_chars = tf.where(tf.sequence_mask(nb_known, token_len), x_chars, tf.zeros_like(x_chars))
+
+    x_chars_len = tf.where(token_mask, tf.maximum(nb_known, 1), tf.zeros_like(nb_known))
+
+    return x_tokens, x_chars, x_chars_len
+
+
+def build_inference_graph(data_char, train_params, model_params):
+    """
+    Build a self-contained inference graph: string inputs, vocabulary lookups, BiLSTM-CRF model and Viterbi
+    decoding. Dropout is disabled with a constant so that it can be folded.
+    :param data_char: data characteristics of the model (data_char.json)
+    :param train_params: training parameters
+    :param model_params: model parameters
+    :return: model object, input tensor dict, output tensor dict, table initialization Op
+    """
+
+    tokens = tf.placeholder(tf.string, shape=[None, None], name="tokens")
+    lengths = tf.placeholder(tf.int32, shape=[None], name="lengths")
+    chars = tf.placeholder(tf.string, shape=[None, None, None], name="chars")
+
+    x_tokens, x_chars, x_chars_len = build_lookup_inputs(data_char, tokens, lengths, chars)
+
+    # Same layout as the test pipelines, the example ID is not used by the model
+    batch = [None, lengths, x_tokens, x_chars, x_chars_len]
+
+    model_args = {
+
+        **train_params,
+        **model_params,
+
+        "word_embedding_matrix_shape": data_char.get("embedding_matrix_shape"),
+        "char_count": len(data_char["char_mapping"]),
+
+        "pl_dropout": tf.constant(0.0),
+
+        "char_lstm_num_hidden": train_params.get("char_hidden_layer_size"),
+
+        "output_size": len(data_char["label_mapping"])
+    }
+
+    with tf.name_scope('train'):
+        if train_params["model_type"] == "bilstm-char-crf":
+            model = BiLSTMCRF(batch, reuse=False, test=True, **model_args)
+        else:
+            raise Exception("The model type ou specified does not exist: {}".format(train_params["model_type"]))
+
+    nb_classes = len(data_char["label_mapping"])
+
+    # Viterbi decoding with START and END states, as done by the batched NumPy decoder
+    unary_scores, _ = add_start_end_states(model.prediction, tf.zeros_like(x_tokens), lengths, nb_classes)
+    decoded, _ = tf.contrib.crf.crf_decode(unary_scores, model.transition_params, lengths + 2)
+
+    label_ids = tf.identity(decoded[:, 1:tf.shape(tokens)[1] + 1], name="label_ids")
+
+    inv_label_mapping = {v: k for k, v in data_char["label_mapping"].items()}
+    label_table = tf.contrib.lookup.index_to_string_table_from_tensor(
+        [inv_label_mapping[i] for i in range(nb_classes)], name="label_table")
+
+    labels = tf.identity(label_table.lookup(tf.cast(label_ids, tf.int64)), name="labels")
+
+    init_tables = tf.tables_initializer(name="init_tables")
+
+    inputs = {"tokens": tokens, "lengths": lengths, "chars": chars}
+    outputs = {"labels": labels, "label_ids": label_ids}
+
+    return model, inputs, outputs, init_tables
+
+
+class FrozenTagger:
+    """
+    Tagger loading a model exported with 'yaset EXPORT'. Only token normalization (lowercasing and digit
+    replacement) is done in Python, vocabulary lookups and decoding are part of the graph.
+    """
+
+    def __init__(self, export_dir, intra_op_threads=1, inter_op_threads=1):
+
+        export_dir = os.path.abspath(export_dir)
+
+        self.desc = json.load(open(os.path.join(export_dir, EXPORT_DESC_FILENAME), "r", encoding="UTF-8"))
+
+        self.normalizer = TokenNormalizer(lower_input=self.desc["lower_input"],
+                                          replace_digits=self.desc["replace_digits"])
+
+        graph_def = tf.GraphDef()
+
+        with open(os.path.join(export_dir, self.desc["graph_file"]), "rb") as input_file:
+            graph_def.ParseFromString(input_file.read())
+
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        self.inputs = {k: self.graph.get_tensor_by_name(v) for k, v in self.desc["inputs"].items()}
+        self.outputs = {k: self.graph.get_tensor_by_name(v) for k, v in self.desc["outputs"].items()}
+
+        config_tf = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
+        config_tf.intra_op_parallelism_threads = intra_op_threads
+        config_tf.inter_op_parallelism_threads = inter_op_threads
+
+        self.sess = tf.Session(graph=self.graph, config=config_tf)
+        self.sess.run(self.graph.get_operation_by_name(self.desc["init_op"]))
+
+        logging.debug("Exported model loaded: {}".format(export_dir))
+
+    def tag(self, sequences, batch_size=64):
+        """
+        Tag sequences of raw tokens
+        :param sequences: list of token lists
+        :param batch_size: mini-batch size
+        :return: list of label lists, in input order
+        """
+
+        order = np.argsort([len(sequence) for sequence in sequences], kind="mergesort")
+
+        predictions = [None] * len(sequences)
+
+        for start in range(0, len(sequences), batch_size):
+            batch_ids = order[start:start + batch_size]
+
+            feed_dict, lengths = self._get_feed_dict([sequences[i] for i in batch_ids])
+            labels = self.sess.run(self.outputs["labels"], feed_dict=feed_dict)
+
+            for i, labels_, seq_len_ in zip(batch_ids, labels, lengths):
+                predictions[i] = [item.decode("UTF-8") for item in labels_[:seq_len_]]
+
+        return predictions
+
+    def _get_feed_dict(self, sequences):
+        """
+        Build padded string arrays for one mini-batch
+        :param sequences: list of token lists
+        :return: feed dict, sequence lengths
+        """
+
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int32)
+
+        x_tokens = np.full((len(sequences), np.max(lengths)), "", dtype=object)
+
+        for i, sequence in enumerate(sequences):
+            x_tokens[i, :len(sequence)] = [self.normalizer.normalize(token) for token in sequence]
+
+        feed_dict = {
+            self.inputs["tokens"]: x_tokens,
+            self.inputs["lengths"]: lengths
+        }
+
+        # Characters are not part of the exported graph when the model does not use them
+        if "chars" in self.inputs:
+            chars = [[self.normalizer.normalize_chars(token) for token in sequence] for sequence in sequences]
+            token_len = max([len(token) for sequence in chars for token in sequence] + [1])
+
+            x_chars = np.full((len(sequences), np.max(lengths), token_len), "", dtype=object)
+
+            for i, sequence in enumerate(chars):
+                for j, token in enumerate(sequence):
+                    x_chars[i, j, :len(token)] = list(token)
+
+            feed_dict[self.inputs["chars"]] = x_chars
+
+        return feed_dict, lengths
+
+    def close(self):
+
+        self.sess.close()
@@ -4,6 +4,13 @@ import logging
 import numpy as np
 import tensorflow as tf
 
+# Storage types of the word embedding table ('int8' rows come with a float32 scale)
+WORD_EMBEDDING_DTYPES = {
+    "float32": tf.float32,
+    "float16": tf.float16,
+    "int8": tf.int8
+}
+
 
 def lazy_property(func):
     """
@@ -24,6 +31,73 @@ def lazy_property(func):
     return wrapper
 
 
+def quantize_embedding_rows(matrix, storage):
+    """
+    Convert embedding rows to the storage type of the word embedding table. 'int8' rows are quantized
+    symmetrically with one scale per row (largest absolute value / 127).
+    :param matrix: embedding rows [nb_rows, dimension]
+    :param storage: storage type ('float32', 'float16' or 'int8')
+    :return: converted rows, scales [nb_rows, 1] ('int8' storage, None otherwise)
+    """
+
+    matrix = np.asarray(matrix, dtype=np.float32)
+
+    if storage == "float32":
+        return matrix, None
+
+    elif storage == "float16":
+        return matrix.astype(np.float16), None
+
+    elif storage == "int8":
+        scales = np.max(np.abs(matrix), axis=1, keepdims=True) / 127.0
+        scales[scales == 0.0] = 1.0
+
+        return np.clip(np.round(matrix / scales), -127, 127).astype(np.int8), scales.astype(np.float32)
+
+    else:
+        raise Exception("The word embedding storage you specified does not exist: {}".format(storage))
+
+
+def add_start_end_states(unary_scores, labels, sequence_lengths, nb_classes):
+    """
+    Add START (id=nb_classes) and END (id=nb_classes+1) states to a padded batch. START is prepended to every
+    sequence and END is placed right after its last token.
+    :param unary_scores: unary scores [batch_size, seq_len, nb_classes]
+    :param labels: labels [batch_size, seq_len]
+    :param sequence_lengths: sequence lengths [batch_size]
+    :param nb_classes: number of labels
+    :return: unary scores [batch_size, seq_len + 2, nb_classes + 2] and labels [batch_size, seq_len + 2]
+    """
+
+    batch_size = tf.shape(unary_scores)[0]
+    max_len = tf.shape(unary_scores)[1]
+
+    # Tokens can not be START or END
+    tiled_scores = tf.concat([unary_scores, tf.fill([batch_size, max_len, 2], -1000.0)], 2)
+
+    start_scores = tf.tile(tf.constant([[[-1000.0] * nb_classes + [0.0, -1000.0]]]), [batch_size, 1, 1])
+    end_scores = tf.constant([[[-1000.0] * nb_classes + [-1000.0, 0.0]]])
+
+    # One extra position at the end of the batch for the END state of the longest sequences
+    padded_scores = tf.concat([start_scores, tiled_scores, tf.fill([batch_size, 1, nb_classes + 2], -1000.0)], 1)
+    padded_labels = tf.concat([tf.fill([batch_size, 1], nb_classes), labels,
+                               tf.zeros([batch_size, 1], dtype=labels.dtype)], 1)
+
+    # Mask of END positions [batch_size, seq_len + 2]
+    end_mask = tf.one_hot(sequence_lengths + 1, max_len + 2, dtype=tf.int32)
+
+    end_mask_scores = tf.expand_dims(tf.cast(end_mask, tf.float32), 2)
+    padded_scores = padded_scores * (1.0 - end_mask_scores) + end_scores * end_mask_scores
+
+    end_mask_labels = tf.cast(end_mask, labels.dtype)
+    padded_labels = padded_labels * (1 - end_mask_labels) + (nb_classes + 1) * end_mask_labels
+
+    # The CRF layer needs a static number of tags
+    padded_scores.set_shape([None, None, nb_classes + 2])
+
+    return padded_scores, padded_labels
+
+
 class BiLSTMCRF:
     """
     Neural Network model based on Lample et al. (2016)
@@ -48,9 +122,14 @@ class BiLSTMCRF:
 
         self.pl_dropout = self.train_config["pl_dropout"]
 
+        # Models trained before the storage option was introduced use float32
+        self.word_embedding_storage = self.train_config.get("word_embedding_storage", "float32")
+
         # If not in dev not test phase
         if not self.reuse and not self.test:
             self.pl_emb = self.train_config["pl_emb"]
+            self.pl_emb_offset = self.train_config["pl_emb_offset"]
+            self.pl_emb_scales = self.train_config["pl_emb_scales"]
 
         self.x_tokens = batch[2]
         self.x_tokens_len = batch[1]
@@ -74,13 +153,28 @@ class BiLSTMCRF:
         with tf.device(device_str):
             with tf.variable_scope('matrices', reuse=self.reuse):
 
+                if self.word_embedding_storage == "float32":
+                    word_initializer = tf.random_uniform_initializer(-1.0, 1.0)
+                else:
+                    word_initializer = tf.zeros_initializer()
+
                 self.W = tf.get_variable('embedding_matrix_words',
-                                         dtype=tf.float32,
+                                         dtype=WORD_EMBEDDING_DTYPES[self.word_embedding_storage],
                                          shape=[self.train_config["word_embedding_matrix_shape"][0],
                                                 self.train_config["word_embedding_matrix_shape"][1]],
-                                         initializer=tf.random_uniform_initializer(-1.0, 1.0),
+                                         initializer=word_initializer,
                                          trainable=self.train_config["trainable_word_embeddings"])
 
+                # Per-row scales of the quantized word embedding table
+                self.W_scales = None
+
+                if self.word_embedding_storage == "int8":
+                    self.W_scales = tf.get_variable('embedding_matrix_words_scales',
+                                                    dtype=tf.float32,
+                                                    shape=[self.train_config["word_embedding_matrix_shape"][0], 1],
+                                                    initializer=tf.ones_initializer(),
+                                                    trainable=False)
+
                 self.transition_params = tf.get_variable('transition_params',
                                                          dtype=tf.float32,
                                                          shape=[self.train_config["output_size"] + 2,
@@ -97,7 +191,14 @@ class BiLSTMCRF:
                                              trainable=True)
 
             if not self.reuse and not self.test:
-                self.embedding_tokens_init = self.W.assign(self.pl_emb)
+                # Word embeddings are loaded by blocks of rows, starting at row 'pl_emb_offset'
+                emb_indices = tf.range(self.pl_emb_offset, self.pl_emb_offset + tf.shape(self.pl_emb)[0])
+                init_ops = [tf.scatter_update(self.W, emb_indices, self.pl_emb)]
+
+                if self.W_scales is not None:
+                    init_ops.append(tf.scatter_update(self.W_scales, emb_indices, self.pl_emb_scales))
+
+                self.embedding_tokens_init = tf.group(*init_ops)
 
         with tf.device(device_str):
 
@@ -133,6 +234,14 @@ class BiLSTMCRF:
 
         embed_words = tf.nn.embedding_lookup(self.W, self.x_tokens, name='lookup_tokens')
 
+        # Half-precision and quantized vectors are converted back to float32 after the lookup
+        if self.word_embedding_storage == "float16":
+            embed_words = tf.cast(embed_words, tf.float32)
+
+        elif self.word_embedding_storage == "int8":
+            embed_scales = tf.nn.embedding_lookup(self.W_scales, self.x_tokens, name='lookup_token_scales')
+            embed_words = tf.cast(embed_words, tf.float32) * embed_scales
+
         return embed_words
 
     @lazy_property
@@ -255,102 +364,23 @@ class BiLSTMCRF:
     @lazy_property
     def loss_crf(self):
         """
-        CRF based loss.
+        CRF based loss, computed for the whole mini-batch at once
         :return: loss
         """
 
-        # Reshaping seq_len tensor [seq_len, 1]
-        seq_length_reshaped = tf.reshape(self.x_tokens_len, [tf.shape(self.x_tokens_len)[0], -1])
+        # Adding START and END states to unary scores and labels [batch_size, seq_len + 2, ...]
+        unary_scores, labels = add_start_end_states(self.prediction, self.y, self.x_tokens_len, self.output_size)
 
-        # Computing loss by scanning mini-batch tensor
-        out = tf.scan(self.loss_crf_scan, [self.prediction,
-                                           seq_length_reshaped,
-                                           self.y], back_prop=True, infer_shape=True, initializer=0.0)
+        # Sequence lengths are the original ones, as in the former per-sequence implementation: the likelihood
+        # covers the START state followed by the first 'length - 1' tokens of each sequence
+        log_likelihood, _ = tf.contrib.crf.crf_log_likelihood(unary_scores, labels, self.x_tokens_len,
+                                                              transition_params=self.transition_params)
 
         # Division by batch_size
-        loss_crf = tf.divide(tf.reduce_sum(out), tf.cast(tf.shape(self.x_tokens)[0], dtype=tf.float32))
+        loss_crf = tf.divide(tf.reduce_sum(log_likelihood), tf.cast(tf.shape(self.x_tokens)[0], dtype=tf.float32))
 
         return loss_crf
 
-    def loss_crf_scan(self, _, current_input):
-        """
-        Scan function for log likelihood computation
-        :param _: previous output
-        :param current_input: current tensor line
-        :return: sequence log likelihood
-        """
-
-        # TILING
-
-        # Create tiling for "start" and "end" scores
-        tile = tf.tile(tf.constant(-1000.0, shape=[1, 2], dtype=tf.float32), [tf.shape(current_input[0])[0], 1])
-
-        # Add two scores for each token in each sequence
-        tiled_tensor = tf.concat([current_input[0], tile], 1)
-
-        # -----------------------------------------------------------
-        # ADDING START TOKEN
-
-        cur_nb_class = current_input[0].get_shape().as_list()[1]
-
-        # Create start and end token unary scores
-        start_unary_scores = [[-1000.0] * cur_nb_class + [0.0, -1000.0]]
-        end_unary_tensor = [[-1000.0] * cur_nb_class + [-1000.0, 0.0]]
-
-        # Concatenate start unary scores to the tiled vector
-        tensor_start = tf.concat([start_unary_scores, tiled_tensor], 0)
-
-        # -----------------------------------------------------------
-        # ADDING END TOKEN
-
-        # Creating mask to fetch elements of the sequence
-        mask = tf.sequence_mask(
-            (tf.cast(tf.reshape(current_input[1], [-1]), dtype=tf.int32) + 1) * tf.shape(tensor_start)[1],
-            tf.shape(tensor_start)[1] * tf.shape(tensor_start)[0],
-            dtype=tf.int32)
-
-        # Flattening unary scores and partitioning
-        unary_scores_reshaped = tf.reshape(tensor_start, [1, -1])
-        slices = tf.dynamic_partition(unary_scores_reshaped, mask, 2)
-
-        # Reshaping slice one
-        slice_1 = tf.reshape(slices[1], [-1, tf.shape(tensor_start)[1]])
-
-        # Concatenating and reshaping
-        tensor_start_end = tf.concat([slice_1, end_unary_tensor], 0)
-        tensor_start_end_reshaped = tf.reshape(tensor_start_end,
-                                               [1, tf.shape(tensor_start_end)[0], tf.shape(tensor_start_end)[1]])
-
-        # Setting shape to tensor
-        tensor_start_end_reshaped.set_shape([1, None, cur_nb_class + 2])
-
-        # -----------------------------------------------------------
-        # ADDING START AND END LABELS
-
-        # Creating mask for target
-        mask_y = tf.sequence_mask(
-            (tf.cast(tf.reshape(current_input[1], [-1]), dtype=tf.int32)),
-            tf.shape(current_input[0])[0],
-            dtype=tf.int32
-        )
-
-        # Flattening label tensor and partitioning
-        y_reshaped = tf.reshape(current_input[2], [1, -1])
-        slices_y = tf.dynamic_partition(y_reshaped, mask_y, 2)
-
-        # Concatenating and reshaping
-        new_y = tf.concat([[cur_nb_class], slices_y[1], [cur_nb_class+1]], axis=0)
-        new_y_reshaped = tf.reshape(new_y, [1, -1])
-
-        # -----------------------------------------------------------
-        # COMPUTING LOG LIKELIHOOD
-
-        log_likelihood, _ = tf.contrib.crf.crf_log_likelihood(tensor_start_end_reshaped, new_y_reshaped,
-                                                              current_input[1],
-                                                              transition_params=self.transition_params)
-
-        return tf.reduce_sum(log_likelihood)
-
     @lazy_property
     def optimize(self):
         """
@@ -0,0 +1,158 @@
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from .crf import ViterbiDecoder
+from .helpers import get_best_model
+from .models.lstm import BiLSTMCRF
+from ..data.reader import TestData, pad_sequences
+
+
+def build_feed_pipeline(feature_columns):
+    """
+    Build placeholders with the mini-batch layout of the test pipeline, fed with padded NumPy arrays
+    :param feature_columns: list of feature columns
+    :return: list of placeholders
+    """
+
+    batch = [
+        tf.placeholder(tf.string, shape=[None]),
+        tf.placeholder(tf.int32, shape=[None]),
+        tf.placeholder(tf.int32, shape=[None, None]),
+        tf.placeholder(tf.int32, shape=[None, None, None]),
+        tf.placeholder(tf.int32, shape=[None, None])
+    ]
+
+    for _ in feature_columns:
+        batch.append(tf.placeholder(tf.int32, shape=[None, None]))
+
+    return batch
+
+
+def get_length_order(encoded_sequences):
+    """
+    Compute the order of encoded sequences by increasing number of tokens, then by increasing longest token size
+    (ties are kept in input order)
+    :param encoded_sequences: list of (token IDs, character ID tuples, feature value IDs) tuples
+    :return: array of sequence indexes
+    """
+
+    lengths = [len(token_ids) for token_ids, _, _ in encoded_sequences]
+    char_lengths = [max([len(item) for item in char_ids]) for _, char_ids, _ in encoded_sequences]
+
+    return np.lexsort((np.arange(len(encoded_sequences)), char_lengths, lengths))
+
+
+class Tagger:
+    """
+    Model restored once and kept in memory. Sequences are fed as padded NumPy mini-batches.
+    """
+
+    def __init__(self, model_dir, data_object: TestData, train_params, model_params, intra_op_threads=1,
+                 inter_op_threads=1):
+
+        self.data_object = data_object
+
+        # Setting some TensorFlow session parameters
+        config_tf = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
+        config_tf.intra_op_parallelism_threads = intra_op_threads
+        config_tf.inter_op_parallelism_threads = inter_op_threads
+
+        logging.info("Building computation graph")
+
+        # Clearing TensorFlow computation graph
+        logging.debug("-> Resetting TensorFlow graph")
+        tf.reset_default_graph()
+
+        logging.debug("-> Building input placeholders")
+        self.batch = build_feed_pipeline(data_object.feature_columns)
+
+        model_args = {
+
+            **train_params,
+            **model_params,
+
+            "word_embedding_matrix_shape": data_object.data_char.get("embedding_matrix_shape"),
+            "char_count": len(data_object.char_mapping),
+
+            "pl_dropout": tf.placeholder(tf.float32),
+
+            "char_lstm_num_hidden": train_params.get("char_hidden_layer_size"),
+
+            "output_size": len(data_object.label_mapping)
+        }
+
+        # Creating main computation sub-graph
+        logging.debug("-> Instantiating NN model")
+        with tf.name_scope('train'):
+            if train_params["model_type"] == "bilstm-char-crf":
+                self.model = BiLSTMCRF(self.batch, reuse=False, test=True, **model_args)
+            else:
+                raise Exception("The model type ou specified does not exist: {}".format(train_params["model_type"]))
+
+        # Initialization Op
+        with tf.device('/cpu:0'):
+            init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+        # Retrieving model filename based on training statistics
+        tf_model_saver_path = os.path.join(model_dir, "tfmodels")
+        train_stats_file = os.path.join(model_dir, "train_stats.json")
+        best_filename = os.path.join(tf_model_saver_path, get_best_model(train_stats_file))
+
+        saver = tf.train.Saver()
+
+        # Creating TensorFlow Session object
+        logging.debug("-> Creating TensorFlow session and initializing graph")
+        self.sess = tf.Session(config=config_tf)
+
+        self.sess.run(init)
+
+        # Restoring model
+        logging.info("Loading saved model into TensorFlow session")
+        saver.restore(self.sess, best_filename)
+
+        self.params = {
+            model_args["pl_dropout"]: 0.0
+        }
+
+        # Transition parameters are fetched once for the whole session
+        self.decoder = ViterbiDecoder.from_session(self.sess, self.model)
+
+    def tag(self, encoded_sequences, batch_size=64, sort_by_length=True):
+        """
+        Predict the labels of encoded sequences
+        :param encoded_sequences: list of (token IDs, character ID tuples, feature value IDs) tuples
+        (see TestData.encode_sequence)
+        :param batch_size: mini-batch size
+        :param sort_by_length: batch sequences by increasing length
+        :return: list of label ID arrays, in input order
+        """
+
+        if sort_by_length:
+            order = get_length_order(encoded_sequences)
+        else:
+            order = np.arange(len(encoded_sequences))
+
+        predictions = [None] * len(encoded_sequences)
+
+        for start in range(0, len(encoded_sequences), batch_size):
+            batch_ids = order[start:start + batch_size]
+            arrays = pad_sequences([encoded_sequences[i] for i in batch_ids], self.data_object.feature_columns)
+
+            feed_dict = dict(self.params)
+            feed_dict.update(zip(self.batch[1:], arrays))
+
+            y_pred = self.sess.run(self.model.prediction, feed_dict=feed_dict)
+
+            # Decoding the whole mini-batch at once
+            for i, y_decoded_ in zip(batch_ids, self.decoder.decode(y_pred, arrays[0])):
+                predictions[i] = y_decoded_
+
+        return predictions
+
+    def close(self):
+
+        self.decoder.log_stats()
+        self.sess.close()
@@ -1,85 +1,117 @@
 import json
 import logging
 import math
+import multiprocessing
 import os
+import shutil
+import time
 
 import numpy as np
 import tensorflow as tf
 
+from .crf import ViterbiDecoder
 from .helpers import get_best_model
 from .models.lstm import BiLSTMCRF
-from ..data.reader import TestData
+from .tagger import Tagger, get_length_order
+from ..data.reader import StatsCorpus, TestData, compute_batch_padding, log_batch_padding
 
 
-def read_and_decode_test(filename_queue, feature_columns):
+def decode_example_test(serialized_example, feature_columns):
     """
-    Read and decode one example from a TFRecords file
+    Decode one serialized example read from a TFRecords file
+    :param serialized_example: serialized SequenceExample
     :param feature_columns: list of feature columns
-    :param filename_queue: filename queue containing the TFRecords filenames
-    :return: list of tensors representing one example
+    :return: tuple of tensors representing one example
     """
 
-    with tf.device('/cpu:0'):
-
-        # New TFRecord file
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
-
-        # Contextual TFRecords features
-        context_features = {
-            "x_length": tf.FixedLenFeature([], dtype=tf.int64),
-            "x_id": tf.FixedLenFeature([], dtype=tf.string)
-        }
+    # Contextual TFRecords features
+    context_features = {
+        "x_length": tf.FixedLenFeature([], dtype=tf.int64),
+        "x_id": tf.FixedLenFeature([], dtype=tf.string)
+    }
 
-        # Sequential TFRecords features
-        sequence_features = {
-            "x_tokens": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-            "x_chars": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-            "x_chars_len": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-        }
+    # Sequential TFRecords features
+    sequence_features = {
+        "x_tokens": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        "x_chars": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        "x_chars_len": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+    }
 
-        for col in feature_columns:
-            sequence_features["x_att_{}".format(col)] = tf.FixedLenSequenceFeature([], dtype=tf.int64)
+    for col in feature_columns:
+        sequence_features["x_att_{}".format(col)] = tf.FixedLenSequenceFeature([], dtype=tf.int64)
 
-        # Parsing contextual and sequential features
-        context_parsed, sequence_parsed = tf.parse_single_sequence_example(
-            serialized=serialized_example,
-            context_features=context_features,
-            sequence_features=sequence_features
-        )
+    # Parsing contextual and sequential features
+    context_parsed, sequence_parsed = tf.parse_single_sequence_example(
+        serialized=serialized_example,
+        context_features=context_features,
+        sequence_features=sequence_features
+    )
 
-        sequence_length = tf.cast(context_parsed["x_length"], tf.int32)
-        chars = tf.reshape(sequence_parsed["x_chars"], tf.stack([sequence_length, -1]))
+    sequence_length = tf.cast(context_parsed["x_length"], tf.int32)
+    chars = tf.reshape(sequence_parsed["x_chars"], tf.stack([sequence_length, -1]))
 
-        # Preparing tensor list, casting values to 32 bits when necessary
-        tensor_list = [
-            context_parsed["x_id"],
-            tf.cast(context_parsed["x_length"], tf.int32),
-            tf.cast(sequence_parsed["x_tokens"], dtype=tf.int32),
-            tf.cast(chars, dtype=tf.int32),
-            tf.cast(sequence_parsed["x_chars_len"], dtype=tf.int32),
-        ]
+    # Preparing tensor list, casting values to 32 bits when necessary
+    tensor_list = [
+        context_parsed["x_id"],
+        tf.cast(context_parsed["x_length"], tf.int32),
+        tf.cast(sequence_parsed["x_tokens"], dtype=tf.int32),
+        tf.cast(chars, dtype=tf.int32),
+        tf.cast(sequence_parsed["x_chars_len"], dtype=tf.int32),
+    ]
 
-        for col in feature_columns:
-            tensor_list.append(tf.cast(sequence_parsed["x_att_{}".format(col)], dtype=tf.int32))
+    for col in feature_columns:
+        tensor_list.append(tf.cast(sequence_parsed["x_att_{}".format(col)], dtype=tf.int32))
 
-        return tensor_list
+    return tuple(tensor_list)
 
 
-def test_model(working_dir, model_dir, data_object: TestData, data_params, train_params, model_params, n_jobs=1):
+def test_model(working_dir, model_dir, data_object: TestData, data_params, train_params, model_params,
+               batch_size=64, intra_op_threads=1, inter_op_threads=1, pipeline_threads=1, in_memory=False,
+               sort_by_length=False, window_batches=16, nb_workers=1):
     """
     Apply model on test data
     :param working_dir: current working directory
     :param model_dir: yaset model path
     :param data_object: TestData object
-    :param n_jobs: number of cores to use
+    :param batch_size: inference mini-batch size
+    :param intra_op_threads: number of threads used within TensorFlow operations
+    :param inter_op_threads: number of TensorFlow operations run in parallel
+    :param pipeline_threads: number of parallel example decoding calls in the input pipeline
+    :param in_memory: read the test file once and feed padded NumPy batches instead of reading TFRecords files
+    :param sort_by_length: in memory mode, sort sequences by length within each window of sequences
+    :param window_batches: in memory mode, number of mini-batches per window
+    :param nb_workers: number of worker processes, each one tagging a shard of the test file in memory mode with
+    its own session (thread counts are per worker)
     :return: nothing
     """
 
+    target_output_file = os.path.join(working_dir, "output.conll")
+
+    if nb_workers > 1:
+        logging.info("Processing data !")
+        _process_parallel(working_dir, model_dir, data_object, train_params, model_params, target_output_file,
+                          nb_workers, batch_size=batch_size, intra_op_threads=intra_op_threads,
+                          inter_op_threads=inter_op_threads, sort_by_length=sort_by_length,
+                          window_batches=window_batches)
+
+        return
+
+    if in_memory:
+        tagger = Tagger(model_dir, data_object, train_params, model_params, intra_op_threads=intra_op_threads,
+                        inter_op_threads=inter_op_threads)
+
+        logging.info("Processing data !")
+        _process_in_memory(tagger, data_object, target_output_file, batch_size=batch_size,
+                           sort_by_length=sort_by_length, window_batches=window_batches)
+
+        tagger.close()
+
+        return
+
     # Setting some TensorFlow session parameters
     config_tf = tf.ConfigProto(log_device_placement=False, allow_soft_placement=True)
-    config_tf.intra_op_parallelism_threads = n_jobs
-    config_tf.inter_op_parallelism_threads = n_jobs
+    config_tf.intra_op_parallelism_threads = intra_op_threads
+    config_tf.inter_op_parallelism_threads = inter_op_threads
 
     # Load data characteristics from log file
     train_data_char = json.load(open(os.path.join(model_dir, "data_char.json")))
@@ -90,21 +122,12 @@ def test_model(working_dir, model_dir, data_object: TestData, data_params, train
     logging.debug("-> Resetting TensorFlow graph")
     tf.reset_default_graph()
 
-    # Creating TensorFlow thread coordinator
-    logging.debug("-> Creating coordinator")
-    coord = tf.train.Coordinator()
-
-    nb_examples = data_object.test_stats.nb_instances
-
-    tfrecords_file_path = os.path.join(os.path.abspath(working_dir), "data.tfrecords")
-
-    # Building 'dev' input pipeline sub-graph
+    # Building input pipeline sub-graph
     logging.debug("-> Building input pipeline")
-    queue_runner_list, queue_list, \
-        batch = _build_test_pipeline(tfrecords_file_path,
-                                     data_object.feature_columns,
-                                     batch_size=64,
-                                     nb_instances=nb_examples)
+    batch = _build_test_pipeline(data_object.tfrecords_files,
+                                 data_object.feature_columns,
+                                 batch_size=batch_size,
+                                 nb_threads=pipeline_threads)
 
     # Network parameters for **kwargs usage
     model_args = {
@@ -155,61 +178,65 @@ def test_model(working_dir, model_dir, data_object: TestData, data_params, train
     logging.info("Loading saved model into TensorFlow session")
     saver.restore(sess, best_filename)
 
-    # Launching threads and starting TensorFlow queue runners
-    logging.debug("-> Launching threads")
-    threads = [item.create_threads(sess, coord=coord, start=True) for item in queue_runner_list]
-
-    _ = tf.train.start_queue_runners(sess=sess, coord=coord)
-
     logging.info("Processing data !")
 
-    counter = 0
-
     params = {
         model_args["pl_dropout"]: 0.0
     }
 
-    display_every_n = math.ceil((nb_examples // 32) * 0.05) * 32
+    # Transition parameters are fetched once for the whole run
+    decoder = ViterbiDecoder.from_session(sess, model)
 
-    if display_every_n == 0:
-        display_every_n = 32
+    _process_tfrecords(sess, model, batch, params, decoder, data_object, target_output_file, batch_size=batch_size)
 
-    pred_sequences = dict()
-    done = set()
+    decoder.log_stats()
 
-    while counter < nb_examples:
+    sess.close()
 
-        x_id, x_len, y_pred = sess.run([batch[0], batch[1], model.prediction], feed_dict=params)
 
-        counter += 64
-        cur_percentage = (float(counter) / nb_examples) * 100
+def _process_tfrecords(sess, model, batch, params, decoder, data_object, target_output_file, batch_size=64):
+    """
+    Process the test instances read from TFRecords files and write predictions to file
+    :param sess: TensorFlow session
+    :param model: model object
+    :param batch: symbolic link to mini-batch
+    :param params: feed dict
+    :param decoder: ViterbiDecoder object
+    :param data_object: TestData object
+    :param target_output_file: prediction file
+    :param batch_size: mini-batch size
+    :return: nothing
+    """
 
-        for seq_id_, seq_len_, unary_scores_ in zip(x_id, x_len, y_pred):
+    data_object.log_padding_stats(batch_size)
 
-            seq_id_str = seq_id_.decode("UTF-8")
+    nb_examples = data_object.test_stats.nb_instances
 
-            if seq_id_str in done:
-                continue
-            else:
-                done.add(seq_id_str)
+    counter = 0
 
-            unary_scores_ = unary_scores_[:seq_len_]
+    display_every_n = math.ceil((nb_examples // batch_size) * 0.05) * batch_size
 
-            # Tiling and adding START and END tokens
-            start_unary_scores = [[-1000.0] * unary_scores_.shape[1] + [0.0, -1000.0]]
-            end_unary_tensor = [[-1000.0] * unary_scores_.shape[1] + [-1000.0, 0.0]]
+    if display_every_n == 0:
+        display_every_n = batch_size
 
-            tile = np.tile(np.array([-1000.0, -1000.0], dtype=np.float32), [unary_scores_.shape[0], 1])
+    pred_sequences = dict()
 
-            tiled_tensor = np.concatenate([unary_scores_, tile], 1)
+    # One pass over the test instances, each sequence is processed exactly once
+    while True:
 
-            tensor_start_end = np.concatenate([start_unary_scores, tiled_tensor, end_unary_tensor], 0)
+        try:
+            x_id, x_len, y_pred = sess.run([batch[0], batch[1], model.prediction], feed_dict=params)
+        except tf.errors.OutOfRangeError:
+            break
 
-            viterbi_sequence, \
-                viterbi_score = tf.contrib.crf.viterbi_decode(tensor_start_end,
-                                                              sess.run(model.transition_params))
+        counter += len(x_id)
+        cur_percentage = (float(counter) / nb_examples) * 100
+
+        # Decoding the whole mini-batch at once
+        y_decoded = decoder.decode(y_pred, x_len)
 
-            pred_sequences[seq_id_str] = viterbi_sequence[1:-1]
+        for seq_id_, y_decoded_ in zip(x_id, y_decoded):
+            pred_sequences[seq_id_.decode("UTF-8")] = y_decoded_
 
         # Logging progress
         if counter % display_every_n == 0 or cur_percentage >= 100:
@@ -218,61 +245,381 @@ def test_model(working_dir, model_dir, data_object: TestData, data_params, train
                 round(cur_percentage, 2),
             ))
 
-    target_output_file = os.path.join(working_dir, "output.conll")
+    logging.info("Writing prediction to file")
     data_object.write_predictions_to_file(target_output_file, pred_sequences)
+
+
+def _process_in_memory(tagger, data_object, target_output_file, batch_size=64, sort_by_length=False,
+                       window_batches=16):
+    """
+    Read the test file once, tag sequences with a resident model and write predictions while reading. Sequences
+    are processed by windows of 'window_batches' mini-batches and can be sorted by length within each window.
+    :param tagger: Tagger object
+    :param data_object: TestData object
+    :param target_output_file: prediction file
+    :param batch_size: mini-batch size
+    :param sort_by_length: sort sequences by length within each window
+    :param window_batches: number of mini-batches per window
+    :return: nothing
+    """
+
+    window_size = batch_size * window_batches if sort_by_length else batch_size
+
+    display_every_n = window_size * max(1, 1000 // window_batches)
+
+    # Padding cells (tokens, chars) for the batching order and for file order
+    padding = np.zeros(4, dtype=np.int64)
+
+    counter = 0
+
+    with open(os.path.abspath(target_output_file), "w", encoding="UTF-8") as output_file:
+
+        items = data_object.iter_input_file(data_object.test_data_file)
+
+        for tagged_window in iter_tagged_windows(tagger, data_object, items, data_object.test_stats, padding=padding,
+                                                 batch_size=batch_size, sort_by_length=sort_by_length,
+                                                 window_batches=window_batches):
+
+            counter += write_tagged_window(data_object, output_file, tagged_window)
+
+            if counter % display_every_n == 0:
+                logging.info("* processed={}".format(counter))
+
+    logging.info("* processed={}".format(counter))
+
+    data_object.test_stats.nb_instances = counter
+    data_object.test_stats.log_stats()
+
+    if sort_by_length:
+        log_batch_padding(int(padding[2]), int(padding[3]), int(padding[0]), int(padding[1]))
+    else:
+        log_batch_padding(int(padding[2]), int(padding[3]))
+
+
+# Objects shared with APPLY worker processes, inherited when the pool is forked
+_PARALLEL_APPLY_CONTEXT = dict()
+
+
+def get_shard_byte_ranges(data_index, nb_shards):
+    """
+    Split a test file into contiguous shards holding about the same number of tokens. Shards start at the
+    beginning of a sequence, blank lines being kept with the preceding shard.
+    :param data_index: CorpusIndex object of the test file
+    :param nb_shards: number of shards
+    :return: list of (start, end) byte offsets (end is None for the last shard)
+    """
+
+    nb_shards = max(1, min(nb_shards, len(data_index)))
+
+    # First sequence of each shard, based on cumulative token counts
+    cumulative_lengths = np.cumsum(data_index.lengths)
+    targets = cumulative_lengths[-1] * np.arange(1, nb_shards) / nb_shards if len(data_index) else []
+    first_sequences = np.unique(np.searchsorted(cumulative_lengths, targets, side="right"))
+    first_sequences = first_sequences[(first_sequences > 0) & (first_sequences < len(data_index))]
+
+    starts = [0] + [int(data_index.offsets[i]) for i in first_sequences]
+    ends = starts[1:] + [None]
+
+    return list(zip(starts, ends))
+
+
+def iter_byte_range_lines(data_file, start, end):
+    """
+    Read the lines of a file between two byte offsets
+    :param data_file: file path
+    :param start: start offset
+    :param end: end offset (None for the end of the file)
+    :return: generator of lines, without line endings (LF or CRLF)
+    """
+
+    with open(data_file, "rb") as input_file:
+        input_file.seek(start)
+
+        position = start
+
+        for line in input_file:
+            if end is not None and position >= end:
+                break
+
+            position += len(line)
+
+            yield line.rstrip(b"\r\n").decode("UTF-8")
+
+
+def _process_parallel(working_dir, model_dir, data_object, train_params, model_params, target_output_file,
+                      nb_workers, batch_size=64, intra_op_threads=1, inter_op_threads=1, sort_by_length=False,
+                      window_batches=16):
+    """
+    Split the test file into shards tagged by worker processes, each one with its own session, then merge
+    shard predictions in file order
+    :param working_dir: current working directory
+    :param model_dir: yaset model path
+    :param data_object: TestData object (the test file must have been checked)
+    :param target_output_file: prediction file
+    :param nb_workers: number of worker processes
+    :param batch_size: mini-batch size
+    :param intra_op_threads: number of threads used within TensorFlow operations, per worker
+    :param inter_op_threads: number of TensorFlow operations run in parallel, per worker
+    :param sort_by_length: sort sequences by length within each window
+    :param window_batches: number of mini-batches per window
+    :return: nothing
+    """
+
+    byte_ranges = get_shard_byte_ranges(data_object.test_index, nb_workers)
+    nb_shards = len(byte_ranges)
+
+    # Pinning each worker to its own cores when there are enough of them
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list()
+
+    if nb_shards > 1 and len(cores) >= nb_shards * intra_op_threads:
+        core_sets = [[int(core) for core in item] for item in np.array_split(cores, nb_shards)]
+    else:
+        core_sets = [None] * nb_shards
+
+    logging.info("* nb. shards: {} ({} thread(s) per worker, cores pinned: {})".format(
+        nb_shards, intra_op_threads, "yes" if core_sets[0] is not None else "no"))
+
+    _PARALLEL_APPLY_CONTEXT.clear()
+    _PARALLEL_APPLY_CONTEXT.update({
+        "model_dir": model_dir,
+        "data_object": data_object,
+        "train_params": train_params,
+        "model_params": model_params,
+        "byte_ranges": byte_ranges,
+        "core_sets": core_sets,
+        "file_paths": [os.path.join(working_dir, "output-{:05d}-of-{:05d}.conll".format(i, nb_shards))
+                       for i in range(nb_shards)],
+        "batch_size": batch_size,
+        "intra_op_threads": intra_op_threads,
+        "inter_op_threads": inter_op_threads,
+        "sort_by_length": sort_by_length,
+        "window_batches": window_batches
+    })
+
+    start = time.time()
+
+    try:
+        if nb_shards == 1:
+            shard_results = [_tag_shard(0)]
+        else:
+            with multiprocessing.get_context("fork").Pool(nb_shards) as pool:
+                shard_results = pool.map(_tag_shard, range(nb_shards))
+    finally:
+        file_paths = _PARALLEL_APPLY_CONTEXT["file_paths"]
+        _PARALLEL_APPLY_CONTEXT.clear()
+
+    elapsed = time.time() - start
+
+    # Merging shard predictions in file order
     logging.info("Writing prediction to file")
 
-    # Stopping everything gracefully
-    logging.info("Stopping everything gracefully (or at least trying to)")
+    with open(os.path.abspath(target_output_file), "wb") as output_file:
+        for file_path in file_paths:
+            with open(file_path, "rb") as input_file:
+                shutil.copyfileobj(input_file, output_file)
 
-    logging.debug("* Requesting stop")
-    coord.request_stop()
+            os.remove(file_path)
 
-    logging.debug("* Closing pipeline queues")
-    for item in queue_list:
-        item.close(cancel_pending_enqueues=True)
+    padding = np.zeros(4, dtype=np.int64)
+    nb_words = 0
 
-    logging.debug("* Closing pipeline threads")
-    for item in threads:
-        coord.join(item)
+    for shard_id, (stats, shard_padding, load_time, tag_time) in enumerate(shard_results):
+        logging.info("* shard #{}: sequences={:,} tokens={:,} load={:.1f}s tagging={:.1f}s "
+                     "({:,.0f} tokens/s)".format(shard_id, len(stats.sequence_lengths), stats.nb_words, load_time,
+                                                 tag_time, stats.nb_words / tag_time if tag_time > 0 else 0.0))
 
-    sess.close()
+        data_object.test_stats.merge(stats)
+        padding += shard_padding
+        nb_words += stats.nb_words
+
+    logging.info("* total: {:,} tokens in {:.1f}s ({:,.0f} tokens/s, model loading included)".format(
+        nb_words, elapsed, nb_words / elapsed if elapsed > 0 else 0.0))
+
+    data_object.test_stats.nb_instances = len(data_object.test_stats.sequence_lengths)
+    data_object.test_stats.log_stats()
 
+    if sort_by_length:
+        log_batch_padding(int(padding[2]), int(padding[3]), int(padding[0]), int(padding[1]))
+    else:
+        log_batch_padding(int(padding[2]), int(padding[3]))
 
-def _build_test_pipeline(tfrecords_file_path, feature_columns, batch_size=None, nb_instances=None):
+
+def _tag_shard(shard_id):
     """
-    Build the test pipeline
-    :param tfrecords_file_path: test TFRecords file path
-    :return: queue runner list, queues, symbolic link to mini-batch
+    Tag one shard of the test file with a dedicated session
+    :param shard_id: shard number
+    :return: StatsCorpus object, padding counters, model loading time, tagging time
     """
 
-    with tf.device('/cpu:0'):
+    context = _PARALLEL_APPLY_CONTEXT
 
-        # Creating a list with tfrecords
-        tfrecords_list = [tfrecords_file_path]
+    if context["core_sets"][shard_id] is not None:
+        os.sched_setaffinity(0, context["core_sets"][shard_id])
 
-        # Will contains queue runners for thread creation
-        queue_runner_list = list()
+    data_object = context["data_object"]
 
-        # Filename queue, contains only on filename (train TFRecords file)
-        filename_queue = tf.train.string_input_producer(tfrecords_list)
+    start = time.time()
 
-        # Decode one example
-        tensor_list = read_and_decode_test(filename_queue, feature_columns)
+    tagger = Tagger(context["model_dir"], data_object, context["train_params"], context["model_params"],
+                    intra_op_threads=context["intra_op_threads"], inter_op_threads=context["inter_op_threads"])
 
-        dtypes = [tf.string, tf.int32, tf.int32, tf.int32, tf.int32]
-        shapes = [[], [], [None], [None, None], [None]]
+    load_time = time.time() - start
+
+    stats = StatsCorpus(name="TEST")
+    padding = np.zeros(4, dtype=np.int64)
+
+    start_byte, end_byte = context["byte_ranges"][shard_id]
+    lines = iter_byte_range_lines(data_object.test_index.data_file, start_byte, end_byte)
+    items = TestData.iter_input_lines(lines, source=data_object.test_index.data_file)
+
+    start = time.time()
+
+    with open(context["file_paths"][shard_id], "w", encoding="UTF-8") as output_file:
+        for tagged_window in iter_tagged_windows(tagger, data_object, items, stats, padding=padding,
+                                                 batch_size=context["batch_size"],
+                                                 sort_by_length=context["sort_by_length"],
+                                                 window_batches=context["window_batches"]):
+            write_tagged_window(data_object, output_file, tagged_window)
+
+    tag_time = time.time() - start
+
+    tagger.close()
+
+    return stats, padding, load_time, tag_time
+
+
+def iter_tagged_windows(tagger, data_object, items, stats, padding=None, batch_size=64, sort_by_length=False,
+                        window_batches=16):
+    """
+    Tag sequences by windows of 'window_batches' mini-batches (one mini-batch if sequences are not sorted). Only
+    one window is kept in memory at a time.
+    :param tagger: Tagger object
+    :param data_object: TestData object
+    :param items: iterable of sequences (token part lists) and blank lines (None), see TestData.iter_input_lines
+    :param stats: StatsCorpus object to update
+    :param padding: padding cell counters to update (tokens and chars for the batching order, then for input order)
+    :param batch_size: mini-batch size
+    :param sort_by_length: sort sequences by length within each window
+    :param window_batches: number of mini-batches per window
+    :return: generator of windows, lists of (token part list, predicted label IDs) tuples in input order, blank
+    lines being (None, None)
+    """
+
+    window_size = batch_size * window_batches if sort_by_length else batch_size
+
+    window = list()
+    nb_window_sequences = 0
+
+    for item in items:
+
+        window.append(item)
+
+        if item is not None:
+            nb_window_sequences += 1
+
+        if nb_window_sequences == window_size:
+            yield _tag_window(tagger, data_object, window, stats, padding, batch_size=batch_size,
+                              sort_by_length=sort_by_length)
 
+            window = list()
+            nb_window_sequences = 0
+
+    if len(window) > 0:
+        yield _tag_window(tagger, data_object, window, stats, padding, batch_size=batch_size,
+                          sort_by_length=sort_by_length)
+
+
+def write_tagged_window(data_object, output_file, tagged_window):
+    """
+    Write one tagged window in input order, blank lines included
+    :param data_object: TestData object
+    :param output_file: opened prediction file
+    :param tagged_window: list of (token part list, predicted label IDs) tuples
+    :return: number of written sequences
+    """
+
+    counter = 0
+
+    for tokens, predictions in tagged_window:
+        if tokens is None:
+            output_file.write("\n")
+        else:
+            data_object.write_sequence_predictions(output_file, tokens, predictions)
+            counter += 1
+
+    return counter
+
+
+def _tag_window(tagger, data_object, window, stats, padding=None, batch_size=64, sort_by_length=False):
+    """
+    Tag one window of sequences
+    :param tagger: Tagger object
+    :param data_object: TestData object
+    :param window: sequences (token part lists) and blank lines (None) in input order
+    :param stats: StatsCorpus object to update
+    :param padding: padding cell counters to update
+    :param batch_size: mini-batch size
+    :param sort_by_length: sort sequences by length within the window
+    :return: list of (token part list, predicted label IDs) tuples
+    """
+
+    # Empty sequences (e.g. from the Python API) get empty predictions without being fed to the model
+    sequences = [item for item in window if item is not None and len(item) > 0]
+    predictions = iter(list())
+
+    if len(sequences) > 0:
+        encoded_sequences = [data_object.encode_sequence(item, stats) for item in sequences]
+
+        if padding is not None:
+            lengths = np.array([len(token_ids) for token_ids, _, _ in encoded_sequences], dtype=np.int64)
+            char_lengths = np.array([max([len(item) for item in char_ids]) for _, char_ids, _ in encoded_sequences],
+                                    dtype=np.int64)
+
+            if sort_by_length:
+                order = get_length_order(encoded_sequences)
+                padding[:2] += compute_batch_padding(lengths[order], char_lengths[order], batch_size)
+
+            padding[2:] += compute_batch_padding(lengths, char_lengths, batch_size)
+
+        predictions = iter(tagger.tag(encoded_sequences, batch_size=batch_size, sort_by_length=sort_by_length))
+
+    tagged_window = list()
+
+    for item in window:
+        if item is None:
+            tagged_window.append((None, None))
+        elif len(item) == 0:
+            tagged_window.append((item, np.zeros(0, dtype=np.int32)))
+        else:
+            tagged_window.append((item, next(predictions)))
+
+    return tagged_window
+
+
+def _build_test_pipeline(tfrecords_file_paths, feature_columns, batch_size=None, nb_threads=1):
+    """
+    Build the test pipeline
+    :param tfrecords_file_paths: test TFRecords shard paths
+    :param feature_columns: list of feature columns
+    :param batch_size: mini-batch size
+    :param nb_threads: number of parallel example decoding calls
+    :return: symbolic link to mini-batch
+    """
+
+    with tf.device('/cpu:0'):
+
+        shapes = [[], [], [None], [None, None], [None]]
         for _ in feature_columns:
-            dtypes.append(tf.int32)
             shapes.append([None])
 
-        # Main queue
-        padding_queue = tf.PaddingFIFOQueue(nb_instances, dtypes=dtypes, shapes=shapes)
+        # Decoding examples in parallel from all test TFRecords shards (read in order)
+        dataset = tf.data.TFRecordDataset(tfrecords_file_paths)
+        dataset = dataset.map(lambda x: decode_example_test(x, feature_columns), num_parallel_calls=nb_threads)
+
+        # One pass over the test instances, the last mini-batch may be smaller
+        dataset = dataset.padded_batch(batch_size, tuple(shapes))
+        dataset = dataset.prefetch(nb_threads)
 
-        # Enqueue and dequeue Ops + queue runner creation
-        enqueue_op = padding_queue.enqueue(tensor_list)
-        batch = padding_queue.dequeue_many(batch_size)
-        queue_runner_list.append(tf.train.QueueRunner(padding_queue, [enqueue_op] * 1))
+        batch = dataset.make_one_shot_iterator().get_next()
 
-        return queue_runner_list, [filename_queue, padding_queue], batch
\ No newline at end of file
+        return list(batch)
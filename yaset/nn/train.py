@@ -5,173 +5,155 @@ import re
 import time
 from datetime import timedelta
 
-import numpy as np
 import tensorflow as tf
 from sklearn.metrics import accuracy_score
 
+from .crf import ViterbiDecoder
 from .helpers import TrainLogger, compute_bucket_boundaries
-from .models.lstm import BiLSTMCRF
+from .models.lstm import BiLSTMCRF, WORD_EMBEDDING_DTYPES, quantize_embedding_rows
 from ..conll import evaluate, calculate_metrics, build_report
 from ..data.reader import TrainData
 from ..tools import ensure_dir, log_message
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
+# Size of the blocks of word embedding rows fed to the session at initialization (bytes, float32 rows)
+EMBEDDING_INIT_BLOCK_SIZE = 64 * 1024 * 1024
 
-def read_and_decode(filename_queue, feature_columns):
+
+def decode_example(serialized_example, feature_columns):
     """
-    Read and decode one example from a TFRecords file
+    Decode one serialized example read from a TFRecords file
+    :param serialized_example: serialized SequenceExample
     :param feature_columns: list of feature columns
-    :param filename_queue: filename queue containing the TFRecords filenames
-    :return: list of tensors representing one example
+    :return: tuple of tensors representing one example
     """
 
-    with tf.device('/cpu:0'):
+    # Contextual TFRecords features
+    context_features = {
+        "x_length": tf.FixedLenFeature([], dtype=tf.int64),
+        "x_id": tf.FixedLenFeature([], dtype=tf.string)
+    }
 
-        # New TFRecord file
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
+    # Sequential TFRecords features
+    sequence_features = {
+        "x_tokens": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        "x_chars": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        "x_chars_len": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+        "y": tf.FixedLenSequenceFeature([], dtype=tf.int64),
+    }
 
-        # Contextual TFRecords features
-        context_features = {
-            "x_length": tf.FixedLenFeature([], dtype=tf.int64),
-            "x_id": tf.FixedLenFeature([], dtype=tf.string)
-        }
+    for col in feature_columns:
+        sequence_features["x_att_{}".format(col)] = tf.FixedLenSequenceFeature([], dtype=tf.int64)
 
-        # Sequential TFRecords features
-        sequence_features = {
-            "x_tokens": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-            "x_chars": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-            "x_chars_len": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-            "y": tf.FixedLenSequenceFeature([], dtype=tf.int64),
-        }
+    # Parsing contextual and sequential features
+    context_parsed, sequence_parsed = tf.parse_single_sequence_example(
+        serialized=serialized_example,
+        context_features=context_features,
+        sequence_features=sequence_features
+    )
 
-        for col in feature_columns:
-            sequence_features["x_att_{}".format(col)] = tf.FixedLenSequenceFeature([], dtype=tf.int64)
+    sequence_length = tf.cast(context_parsed["x_length"], tf.int32)
+    chars = tf.reshape(sequence_parsed["x_chars"], tf.stack([sequence_length, -1]))
 
-        # Parsing contextual and sequential features
-        context_parsed, sequence_parsed = tf.parse_single_sequence_example(
-            serialized=serialized_example,
-            context_features=context_features,
-            sequence_features=sequence_features
-        )
+    # Preparing tensor list, casting values to 32 bits when necessary
+    tensor_list = [
+        context_parsed["x_id"],
+        tf.cast(context_parsed["x_length"], tf.int32),
+        tf.cast(sequence_parsed["x_tokens"], dtype=tf.int32),
+        tf.cast(chars, dtype=tf.int32),
+        tf.cast(sequence_parsed["x_chars_len"], dtype=tf.int32),
+        tf.cast(sequence_parsed["y"], dtype=tf.int32)
+    ]
 
-        sequence_length = tf.cast(context_parsed["x_length"], tf.int32)
-        chars = tf.reshape(sequence_parsed["x_chars"], tf.stack([sequence_length, -1]))
+    for col in feature_columns:
+        tensor_list.append(tf.cast(sequence_parsed["x_att_{}".format(col)], dtype=tf.int32))
 
-        # Preparing tensor list, casting values to 32 bits when necessary
-        tensor_list = [
-            context_parsed["x_id"],
-            tf.cast(context_parsed["x_length"], tf.int32),
-            tf.cast(sequence_parsed["x_tokens"], dtype=tf.int32),
-            tf.cast(chars, dtype=tf.int32),
-            tf.cast(sequence_parsed["x_chars_len"], dtype=tf.int32),
-            tf.cast(sequence_parsed["y"], dtype=tf.int32)
-        ]
+    return tuple(tensor_list)
 
-        for col in feature_columns:
-            tensor_list.append(tf.cast(sequence_parsed["x_att_{}".format(col)], dtype=tf.int32))
 
-        return tensor_list
+def _get_padded_shapes(feature_columns):
+    """
+    Compute the padded shapes of one example
+    :param feature_columns: list of feature columns
+    :return: tuple of shapes
+    """
+
+    shapes = [[], [], [None], [None, None], [None], [None]]
+    for _ in feature_columns:
+        shapes.append([None])
 
+    return tuple(shapes)
 
-def _build_train_pipeline(tfrecords_file_path, feature_columns, buckets=None, batch_size=None,
-                          nb_instances=None):
+
+def _build_train_pipeline(tfrecords_file_paths, feature_columns, buckets=None, batch_size=None,
+                          nb_instances=None, nb_threads=1):
     """
     Build the train pipeline. Sequences are grouped into buckets for faster training.
-    :param tfrecords_file_path: train TFRecords file path
+    :param tfrecords_file_paths: train TFRecords shard paths
     :param buckets: train buckets
     :param batch_size: mini-batch size
-    :return: queue runner list, queues, symbolic link to mini-batch
+    :param nb_instances: number of train instances
+    :param nb_threads: number of parallel example decoding calls
+    :return: symbolic link to mini-batch
     """
 
     with tf.device('/cpu:0'):
 
-        # Creating a list with tfrecords
-        tfrecords_list = [tfrecords_file_path]
-
-        # Will contains queue runners for thread creation
-        queue_runner_list = list()
-
-        # Filename queue, contains only on filename (train TFRecords file)
-        filename_queue = tf.train.string_input_producer(tfrecords_list)
-
-        # Decode one example
-        tensor_list = read_and_decode(filename_queue, feature_columns)
-
-        dtypes = [tf.string, tf.int32, tf.int32, tf.int32, tf.int32, tf.int32]
-        for _ in feature_columns:
-            dtypes.append(tf.int32)
+        padded_shapes = _get_padded_shapes(feature_columns)
 
-        # Random shuffle queue, allow for randomization of training instances (maximum size: 50% of nb. instances)
-        shuffle_queue = tf.RandomShuffleQueue(nb_instances, nb_instances//2, dtypes=dtypes)
+        # Decoding examples in parallel from all train TFRecords shards
+        dataset = tf.data.TFRecordDataset(tfrecords_file_paths)
+        dataset = dataset.map(lambda x: decode_example(x, feature_columns), num_parallel_calls=nb_threads)
 
-        # Enqueue and dequeue Ops + queue runner creation
-        enqueue_op_shuffle_queue = shuffle_queue.enqueue(tensor_list)
-        inputs = shuffle_queue.dequeue()
-
-        queue_runner_list.append(tf.train.QueueRunner(shuffle_queue, [enqueue_op_shuffle_queue] * 4))
-
-        shapes = [[], [], [None], [None, None], [None], [None]]
-        for _ in feature_columns:
-            shapes.append([None])
+        # Randomization of training instances (buffer size: 50% of nb. instances), looping over epochs
+        dataset = dataset.shuffle(max(nb_instances // 2, 1))
+        dataset = dataset.repeat()
 
         if buckets:
             # Bucketing according to bucket boundaries passed as arguments
-            length, batch = tf.contrib.training.bucket_by_sequence_length(inputs[1], inputs, batch_size,
-                                                                          sorted(buckets),
-                                                                          num_threads=4,
-                                                                          capacity=32,
-                                                                          shapes=shapes,
-                                                                          dynamic_pad=True)
+            boundaries = tf.constant(sorted(buckets), dtype=tf.int32)
+
+            def bucket_id(*example):
+                return tf.reduce_sum(tf.cast(tf.greater_equal(example[1], boundaries), dtype=tf.int64))
+
+            dataset = dataset.apply(tf.contrib.data.group_by_window(
+                key_func=bucket_id,
+                reduce_func=lambda _, window: window.padded_batch(batch_size, padded_shapes),
+                window_size=batch_size
+            ))
         else:
+            dataset = dataset.padded_batch(batch_size, padded_shapes)
 
-            padding_queue = tf.PaddingFIFOQueue(nb_instances, dtypes=dtypes, shapes=shapes)
-            enqueue_op_padding_queue = padding_queue.enqueue(inputs)
-            batch = padding_queue.dequeue_many(batch_size)
+        dataset = dataset.prefetch(nb_threads)
 
-            queue_runner_list.append(tf.train.QueueRunner(padding_queue, [enqueue_op_padding_queue] * 4))
+        batch = dataset.make_one_shot_iterator().get_next()
 
-        return queue_runner_list, [filename_queue, shuffle_queue], batch
+        return list(batch)
 
 
-def _build_dev_pipeline(tfrecords_file_path, feature_columns, batch_size=None, nb_instances=None):
+def _build_dev_pipeline(tfrecords_file_paths, feature_columns, batch_size=None, nb_threads=1):
     """
     Build the dev pipeline
-    :param tfrecords_file_path: dev TFRecords file path
-    :return: queue runner list, queues, symbolic link to mini-batch
+    :param tfrecords_file_paths: dev TFRecords shard paths
+    :param batch_size: mini-batch size
+    :param nb_threads: number of parallel example decoding calls
+    :return: iterator initialization Op (run before each dev pass), symbolic link to mini-batch
     """
 
     with tf.device('/cpu:0'):
 
-        # Creating a list with tfrecords
-        tfrecords_list = [tfrecords_file_path]
-
-        # Will contains queue runners for thread creation
-        queue_runner_list = list()
-
-        # Filename queue, contains only on filename (train TFRecords file)
-        filename_queue = tf.train.string_input_producer(tfrecords_list)
-
-        # Decode one example
-        tensor_list = read_and_decode(filename_queue, feature_columns)
+        # Decoding examples in parallel from all dev TFRecords shards (read in order)
+        dataset = tf.data.TFRecordDataset(tfrecords_file_paths)
+        dataset = dataset.map(lambda x: decode_example(x, feature_columns), num_parallel_calls=nb_threads)
 
-        dtypes = [tf.string, tf.int32, tf.int32, tf.int32, tf.int32, tf.int32]
-        shapes = [[], [], [None], [None, None], [None], [None]]
+        # One pass over the dev instances, the last mini-batch may be smaller
+        dataset = dataset.padded_batch(batch_size, _get_padded_shapes(feature_columns))
+        dataset = dataset.prefetch(nb_threads)
 
-        for _ in feature_columns:
-            dtypes.append(tf.int32)
-            shapes.append([None])
+        iterator = dataset.make_initializable_iterator()
 
-        # Main queue
-        padding_queue = tf.PaddingFIFOQueue(nb_instances, dtypes=dtypes, shapes=shapes)
-
-        # Enqueue and dequeue Ops + queue runner creation
-        enqueue_op = padding_queue.enqueue(tensor_list)
-        batch = padding_queue.dequeue_many(batch_size)
-        queue_runner_list.append(tf.train.QueueRunner(padding_queue, [enqueue_op] * 1))
-
-        return queue_runner_list, [filename_queue, padding_queue], batch
+        return iterator.initializer, list(iterator.get_next())
 
 
 def train_model(working_dir, embedding_object, data_object: TrainData, train_params, model_params):
@@ -187,10 +169,6 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
     logging.debug("* Resetting TensorFlow graph")
     tf.reset_default_graph()
 
-    # Creating TensorFlow thread coordinator
-    logging.debug("* Creating coordinator")
-    coord = tf.train.Coordinator()
-
     train_bucket_boundaries = None
 
     if train_params["bucket_use"]:
@@ -204,26 +182,21 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
     train_nb_examples = data_object.train_stats.nb_instances
     dev_nb_examples = data_object.dev_stats.nb_instances
 
-    # Computing TFRecords file paths
-    tfrecords_train_file_path = os.path.join(os.path.abspath(working_dir), "tfrecords", "train.tfrecords")
-    tfrecords_dev_file_path = os.path.join(os.path.abspath(working_dir), "tfrecords", "dev.tfrecords")
-
     # Building 'train' input pipeline sub-graph
     logging.debug("* Building 'train' input pipeline")
-    queue_runner_list_train, queue_list_train,\
-        batch_train = _build_train_pipeline(tfrecords_train_file_path,
-                                            data_object.feature_columns,
-                                            buckets=train_bucket_boundaries,
-                                            batch_size=train_params["batch_size"],
-                                            nb_instances=train_nb_examples)
+    batch_train = _build_train_pipeline(data_object.tfrecords_train_files,
+                                        data_object.feature_columns,
+                                        buckets=train_bucket_boundaries,
+                                        batch_size=train_params["batch_size"],
+                                        nb_instances=train_nb_examples,
+                                        nb_threads=train_params["cpu_cores"])
 
     # Building 'dev' input pipeline sub-graph
     logging.debug("* Building 'dev' input pipeline")
-    queue_runner_list_dev, queue_list_dev,\
-        batch_dev = _build_dev_pipeline(tfrecords_dev_file_path,
-                                        data_object.feature_columns,
-                                        batch_size=train_params["batch_size"],
-                                        nb_instances=dev_nb_examples)
+    dev_init_op, batch_dev = _build_dev_pipeline(data_object.tfrecords_dev_files,
+                                                 data_object.feature_columns,
+                                                 batch_size=train_params["batch_size"],
+                                                 nb_threads=train_params["cpu_cores"])
 
     # Network parameters for **kwargs usage
     model_args = {
@@ -233,14 +206,16 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
         **model_params,
 
         # Embedding shapes
-        "word_embedding_matrix_shape": embedding_object.embedding_matrix.shape,
+        "word_embedding_matrix_shape": embedding_object.get_matrix_shape(),
         "char_count": len(data_object.char_mapping),
         # "char_embedding_matrix_shape": [len(data_object.char_mapping), model_params["char_embedding_size"]],
 
         # Misc
         "pl_dropout": tf.placeholder(tf.float32),
-        "pl_emb": tf.placeholder(tf.float32, [embedding_object.embedding_matrix.shape[0],
-                                              embedding_object.embedding_matrix.shape[1]]),
+        "pl_emb": tf.placeholder(WORD_EMBEDDING_DTYPES[train_params["word_embedding_storage"]],
+                                 [None, embedding_object.get_matrix_shape()[1]]),
+        "pl_emb_offset": tf.placeholder(tf.int32, []),
+        "pl_emb_scales": tf.placeholder(tf.float32, [None, 1]),
         "output_size": len(data_object.label_mapping),
 
         "train_nb_instances": train_nb_examples,
@@ -283,14 +258,11 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
 
     # Initializing variables and embedding matrix
     sess.run(init)
-    sess.run(model_train.embedding_tokens_init, {model_args["pl_emb"]: embedding_object.embedding_matrix})
-
-    # Launching threads and starting TensorFlow queue runners
-    logging.debug("* Launching threads and TensorFlow queue runners")
-    threads_train = [item.create_threads(sess, coord=coord, start=True) for item in queue_runner_list_train]
-    threads_dev = [item.create_threads(sess, coord=coord, start=True) for item in queue_runner_list_dev]
+    _init_word_embeddings(sess, model_train, model_args, embedding_object.embedding_matrix,
+                          train_params["word_embedding_storage"])
 
-    _ = tf.train.start_queue_runners(sess=sess, coord=coord)
+    # The matrix now lives in the model variable, the NumPy copy (or memory-mapped cache file) is not needed anymore
+    logging.info("Releasing word embedding matrix ({:,} bytes)".format(embedding_object.release_matrix()))
 
     logging.info("Zajiganié !")
 
@@ -318,9 +290,9 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
         log_message("START - Evaluation on dev instances ", "-")
 
         start_time = time.time()
-        do_break = _evaluate_on_dev(model_args, dev_nb_examples, sess, batch_dev, model_dev, train_params,
-                                    data_object, saver, tf_model_saving_name, iteration_number, train_logger,
-                                    tf_model_saver_path)
+        do_break = _evaluate_on_dev(model_args, dev_nb_examples, sess, dev_init_op, batch_dev, model_dev,
+                                    train_params, data_object, saver, tf_model_saving_name, iteration_number,
+                                    train_logger, tf_model_saver_path)
         end_time = time.time()
 
         log_message("END - Evaluation on dev instances (Time elapsed: {})".format(
@@ -343,29 +315,40 @@ def train_model(working_dir, embedding_object, data_object: TrainData, train_par
     target_data_characteristics_file = os.path.join(working_dir, 'data_char.json')
     data_object.dump_data_characteristics(target_data_characteristics_file, embedding_object)
 
-    # Stopping everything gracefully
-    logging.info("Stopping everything gracefully (or at least trying to)")
+    sess.close()
 
-    logging.debug("* Requesting stop")
-    coord.request_stop()
 
-    logging.debug("* Closing 'train' pipeline queues")
-    for item in queue_list_train:
-        item.close(cancel_pending_enqueues=True)
+def _init_word_embeddings(sess, model, model_args, embedding_matrix, storage):
+    """
+    Load the word embedding matrix into the model variable by blocks of rows converted to the storage type. Only
+    one block is fed at a time, the full matrix is never copied to the session feed.
+    :param sess: TensorFlow session
+    :param model: 'train' model object
+    :param model_args: model arguments (placeholders)
+    :param embedding_matrix: word embedding matrix (float32)
+    :param storage: word embedding storage type ('float32', 'float16' or 'int8')
+    :return: nothing
+    """
 
-    logging.debug("* Closing 'dev' pipeline queues")
-    for item in queue_list_dev:
-        item.close(cancel_pending_enqueues=True)
+    nb_rows = max(1, EMBEDDING_INIT_BLOCK_SIZE // (embedding_matrix.shape[1] * 4))
+    nb_bytes = 0
 
-    logging.debug("* Closing 'train' pipeline threads")
-    for item in threads_train:
-        coord.join(item)
+    for start in range(0, embedding_matrix.shape[0], nb_rows):
+        block, scales = quantize_embedding_rows(embedding_matrix[start:start + nb_rows], storage)
 
-    logging.debug("* Closing 'dev' pipeline threads")
-    for item in threads_dev:
-        coord.join(item)
+        feed_dict = {
+            model_args["pl_emb"]: block,
+            model_args["pl_emb_offset"]: start
+        }
 
-    sess.close()
+        if scales is not None:
+            feed_dict[model_args["pl_emb_scales"]] = scales
+            nb_bytes += scales.nbytes
+
+        sess.run(model.embedding_tokens_init, feed_dict=feed_dict)
+        nb_bytes += block.nbytes
+
+    logging.info("Word embedding table: {} ({:,} bytes)".format(storage, nb_bytes))
 
 
 def _do_one_iteration(train_nb_examples, train_params, model_params, model_args,
@@ -421,8 +404,8 @@ def _do_one_iteration(train_nb_examples, train_params, model_params, model_args,
     return train_counter
 
 
-def _evaluate_on_dev(model_args, dev_nb_examples, sess, batch_dev, model_dev, train_params, data_object,
-                     saver, tf_model_saving_name, iteration_number, train_logger, tf_model_saver_path):
+def _evaluate_on_dev(model_args, dev_nb_examples, sess, dev_init_op, batch_dev, model_dev, train_params,
+                     data_object, saver, tf_model_saving_name, iteration_number, train_logger, tf_model_saver_path):
 
     display_every_n_dev = math.ceil((dev_nb_examples //
                                      train_params["batch_size"]) * 0.10) * train_params["batch_size"]
@@ -434,47 +417,35 @@ def _evaluate_on_dev(model_args, dev_nb_examples, sess, batch_dev, model_dev, tr
         model_args["pl_dropout"]: 0.0
     }
 
+    # Transition parameters are fetched once for the whole dev pass
+    decoder = ViterbiDecoder.from_session(sess, model_dev)
+
     dev_counter = 0
-    done = set()
     metric_payload = list()
 
-    while dev_counter < dev_nb_examples:
-
-        x_id, x_len, y_pred, y_target = sess.run([batch_dev[0], batch_dev[1], model_dev.prediction,
-                                                  batch_dev[5]], feed_dict=params)
-
-        dev_counter += train_params["batch_size"]
-        cur_percentage = (float(dev_counter) / dev_nb_examples) * 100
-
-        for seq_id_, seq_len_, unary_scores_, y_target_ in zip(x_id, x_len, y_pred, y_target):
+    # Rewinding the dev pipeline, each dev instance is processed exactly once
+    sess.run(dev_init_op)
 
-            curr_seq_metric_payload = list()
-
-            seq_id_str = seq_id_.decode("UTF-8")
-
-            if seq_id_str in done:
-                continue
-            else:
-                done.add(seq_id_str)
+    while True:
 
-            unary_scores_ = unary_scores_[:seq_len_]
-
-            # Tiling and adding START and END tokens
-            start_unary_scores = [[-1000.0] * unary_scores_.shape[1] + [0.0, -1000.0]]
-            end_unary_tensor = [[-1000.0] * unary_scores_.shape[1] + [-1000.0, 0.0]]
+        try:
+            x_len, y_pred, y_target = sess.run([batch_dev[1], model_dev.prediction, batch_dev[5]],
+                                               feed_dict=params)
+        except tf.errors.OutOfRangeError:
+            break
 
-            tile = np.tile(np.array([-1000.0, -1000.0], dtype=np.float32), [unary_scores_.shape[0], 1])
+        dev_counter += len(x_len)
+        cur_percentage = (float(dev_counter) / dev_nb_examples) * 100
 
-            tiled_tensor = np.concatenate([unary_scores_, tile], 1)
+        # Decoding the whole mini-batch at once
+        y_decoded = decoder.decode(y_pred, x_len)
 
-            tensor_start_end = np.concatenate([start_unary_scores, tiled_tensor, end_unary_tensor], 0)
+        for y_decoded_, y_target_ in zip(y_decoded, y_target):
 
-            viterbi_sequence, \
-            viterbi_score = tf.contrib.crf.viterbi_decode(tensor_start_end,
-                                                          sess.run(model_dev.transition_params))
+            curr_seq_metric_payload = list()
 
             # Counting incorrect and correct predictions
-            for label_pred, label_gs in zip(viterbi_sequence[1:-1], y_target_):
+            for label_pred, label_gs in zip(y_decoded_, y_target_):
                 curr_seq_metric_payload.append({
                     "gs": data_object.inv_label_mapping[label_gs],
                     "pred": data_object.inv_label_mapping[label_pred]
@@ -483,19 +454,15 @@ def _evaluate_on_dev(model_args, dev_nb_examples, sess, batch_dev, model_dev, tr
             metric_payload.append(curr_seq_metric_payload)
 
         # Logging progress
-        if dev_counter % display_every_n_dev == 0 or cur_percentage >= 100:
-            if cur_percentage >= 100:
-                logging.info("* processed={} ({:5.2f}%)".format(
-                    dev_nb_examples,
-                    round(100.0, 2),
-                ))
-            else:
-                logging.info("* processed={} ({:5.2f}%)".format(
-                    dev_counter,
-                    round(cur_percentage, 2),
-                ))
+        if dev_counter % display_every_n_dev == 0 or dev_counter >= dev_nb_examples:
+            logging.info("* processed={} ({:5.2f}%)".format(
+                dev_counter,
+                round(cur_percentage, 2),
+            ))
+
+    decoder.log_stats()
 
-                # Computing token accuracy
+    # Computing token accuracy
     pred_labels = list()
     gs_labels = list()
 
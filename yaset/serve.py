@@ -0,0 +1,450 @@
+import collections
+import io
+import json
+import logging
+import os
+import queue
+import socketserver
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from .apply import load_tagger
+from .data.reader import StatsCorpus, TestData
+from .error import FeatureDoesNotExist
+from .tools import log_message
+
+
+class TaggingRequest:
+    """
+    Sequences of one client request waiting to be tagged
+    """
+
+    def __init__(self, encoded_sequences):
+
+        self.encoded_sequences = encoded_sequences
+        self.nb_tokens = sum([len(token_ids) for token_ids, _, _ in encoded_sequences])
+
+        self.predictions = None
+        self.error = None
+
+        self.created = time.time()
+        self.done = threading.Event()
+
+
+class LatencyStats:
+    """
+    Request latencies (queueing + tagging) and batch sizes. Percentiles are computed over the most recent requests.
+    """
+
+    def __init__(self, window=10000):
+
+        self.lock = threading.Lock()
+
+        self.latencies = collections.deque(maxlen=window)
+
+        self.nb_requests = 0
+        self.nb_batches = 0
+        self.nb_sequences = 0
+        self.nb_tokens = 0
+
+    def add_request(self, latency):
+
+        with self.lock:
+            self.latencies.append(latency)
+            self.nb_requests += 1
+
+    def add_batch(self, nb_sequences, nb_tokens):
+
+        with self.lock:
+            self.nb_batches += 1
+            self.nb_sequences += nb_sequences
+            self.nb_tokens += nb_tokens
+
+    def get_payload(self):
+
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+
+            payload = {
+                "requests": self.nb_requests,
+                "batches": self.nb_batches,
+                "sequences": self.nb_sequences,
+                "tokens": self.nb_tokens,
+                "sequences_per_batch": self.nb_sequences / self.nb_batches if self.nb_batches else 0.0,
+                "latency_ms": {
+                    "p50": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                    "p99": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                    "max": float(np.max(latencies)) if len(latencies) else 0.0
+                }
+            }
+
+        return payload
+
+    def log_stats(self):
+
+        payload = self.get_payload()
+
+        if payload["requests"] == 0:
+            return
+
+        logging.info("* requests: {:,} in {:,} batches ({:.1f} sequences/batch)".format(
+            payload["requests"], payload["batches"], payload["sequences_per_batch"]))
+        logging.info("* latency: p50={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(
+            payload["latency_ms"]["p50"], payload["latency_ms"]["p99"], payload["latency_ms"]["max"]))
+
+
+class MicroBatcher:
+    """
+    Worker thread owning the tagger. After the first pending request is picked, other requests are collected for up
+    to 'max_latency' milliseconds, or until the sequence or token budget is reached, and tagged together in one
+    padded forward pass. A single request larger than the sequence budget is split into budget-sized passes.
+    """
+
+    def __init__(self, tagger, batch_size=64, max_batch_sequences=None, max_batch_tokens=None, max_latency=5.0):
+
+        self.tagger = tagger
+
+        if max_batch_sequences is None:
+            max_batch_sequences = batch_size
+
+        self.max_batch_sequences = max_batch_sequences
+        self.max_batch_tokens = max_batch_tokens
+        self.max_latency = max_latency / 1000
+
+        self.stats = LatencyStats()
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="yaset-micro-batcher", daemon=True)
+
+        # Request that did not fit in the previous batch
+        self.carry = None
+        self.stopping = False
+
+    def start(self):
+
+        self.thread.start()
+
+    def stop(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+        self.stats.log_stats()
+
+    def submit(self, encoded_sequences):
+        """
+        Tag sequences, blocking until predictions are available
+        :param encoded_sequences: list of encoded sequences (see TestData.encode_sequence)
+        :return: list of label ID arrays
+        """
+
+        if len(encoded_sequences) == 0:
+            return list()
+
+        request = TaggingRequest(encoded_sequences)
+        self.queue.put(request)
+        request.done.wait()
+
+        self.stats.add_request(time.time() - request.created)
+
+        if request.error is not None:
+            raise request.error
+
+        return request.predictions
+
+    def _run(self):
+
+        while True:
+
+            if self.carry is not None:
+                request, self.carry = self.carry, None
+            elif self.stopping:
+                break
+            else:
+                request = self.queue.get()
+
+                if request is None:
+                    break
+
+            self._process(self._collect(request))
+
+    def _collect(self, request):
+        """
+        Collect pending requests to tag along with a first one
+        :param request: first request
+        :return: list of requests
+        """
+
+        requests = [request]
+
+        nb_sequences = len(request.encoded_sequences)
+        nb_tokens = request.nb_tokens
+
+        deadline = request.created + self.max_latency
+
+        while not self.stopping and nb_sequences < self.max_batch_sequences and \
+                (self.max_batch_tokens is None or nb_tokens < self.max_batch_tokens):
+
+            remaining = deadline - time.time()
+
+            try:
+                if remaining > 0:
+                    request = self.queue.get(timeout=remaining)
+                else:
+                    request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is None:
+                self.stopping = True
+                break
+
+            # Keeping requests exceeding the budget for the next batch
+            if nb_sequences + len(request.encoded_sequences) > self.max_batch_sequences or \
+                    (self.max_batch_tokens is not None and nb_tokens + request.nb_tokens > self.max_batch_tokens):
+                self.carry = request
+                break
+
+            requests.append(request)
+
+            nb_sequences += len(request.encoded_sequences)
+            nb_tokens += request.nb_tokens
+
+        return requests
+
+    def _process(self, requests):
+
+        encoded_sequences = [item for request in requests for item in request.encoded_sequences]
+        nb_tokens = sum([request.nb_tokens for request in requests])
+
+        logging.debug("* tagging {} request(s), {} sequence(s), {} token(s)".format(
+            len(requests), len(encoded_sequences), nb_tokens))
+
+        self.stats.add_batch(len(encoded_sequences), nb_tokens)
+
+        try:
+            # Collected requests fit in the sequence budget and are tagged in one forward pass
+            predictions = self.tagger.tag(encoded_sequences, batch_size=self.max_batch_sequences)
+        except Exception as e:
+            for request in requests:
+                request.error = e
+                request.done.set()
+
+            return
+
+        start = 0
+
+        for request in requests:
+            end = start + len(request.encoded_sequences)
+            request.predictions = predictions[start:end]
+            request.done.set()
+
+            start = end
+
+
+class TaggingRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler:
+    - GET /health: server status
+    - GET /stats: request, batch and latency counters
+    - POST /tag: tag sequences sent as JSON ({"sequences": [[token, ...], ...]}, a token being a string or a list
+      of column values) or as tabulated data (one token per line, sequences separated by blank lines)
+    """
+
+    def do_GET(self):
+
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, self.server.batcher.stats.get_payload())
+        else:
+            self._send_json(404, {"error": "Unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+
+        if self.path != "/tag":
+            self._send_json(404, {"error": "Unknown path: {}".format(self.path)})
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("UTF-8")
+
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                self._tag_json(body)
+            else:
+                self._tag_tabulated(body)
+
+        except (ValueError, FeatureDoesNotExist) as e:
+            self._send_json(400, {"error": getattr(e, "message", str(e))})
+
+        except Exception as e:
+            logging.exception("Error while processing request")
+            self._send_json(500, {"error": str(e)})
+
+    def _tag_json(self, body):
+
+        payload = json.loads(body)
+
+        if not isinstance(payload, dict) or not isinstance(payload.get("sequences"), list):
+            raise ValueError("The request must contain a 'sequences' list")
+
+        sequences = list()
+
+        for sequence in payload["sequences"]:
+            if not isinstance(sequence, list) or len(sequence) == 0:
+                raise ValueError("Each sequence must be a non-empty list of tokens")
+
+            tokens = list()
+
+            for item in sequence:
+                if isinstance(item, str):
+                    tokens.append([item])
+                elif isinstance(item, list) and len(item) > 0:
+                    tokens.append([str(value) for value in item])
+                else:
+                    raise ValueError("Each token must be a string or a non-empty list of column values")
+
+            sequences.append(tokens)
+
+        predictions = self._tag(sequences)
+
+        self._send_json(200, {
+            "labels": [[self.server.data_object.inv_label_mapping[label] for label in labels]
+                       for labels in predictions]
+        })
+
+    def _tag_tabulated(self, body):
+
+        try:
+            items = list(TestData.iter_input_lines(body.splitlines(), source="request"))
+        except Exception as e:
+            raise ValueError(str(e))
+
+        predictions = iter(self._tag([item for item in items if item is not None]))
+
+        output = io.StringIO()
+
+        for item in items:
+            if item is None:
+                output.write("\n")
+            else:
+                self.server.data_object.write_sequence_predictions(output, item, next(predictions))
+
+        self._send(200, output.getvalue().encode("UTF-8"), "text/tab-separated-values; charset=utf-8")
+
+    def _tag(self, sequences):
+
+        data_object = self.server.data_object
+        min_columns = max(data_object.feature_columns) + 1 if data_object.feature_columns else 1
+
+        for sequence in sequences:
+            for parts in sequence:
+                if len(parts) < min_columns:
+                    raise ValueError("Each token must have at least {} column(s)".format(min_columns))
+
+        # Encoding is done in the request thread, only model calls are serialized
+        stats = StatsCorpus(name="SERVE")
+        encoded_sequences = [data_object.encode_sequence(sequence, stats) for sequence in sequences]
+
+        return self.server.batcher.submit(encoded_sequences)
+
+    def _send_json(self, code, payload):
+
+        self._send(code, json.dumps(payload).encode("UTF-8"), "application/json")
+
+    def _send(self, code, content, content_type):
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+
+        return "unix"
+
+    def log_message(self, format, *args):
+
+        logging.debug("* {} {}".format(self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def serve_model(model_path, host="127.0.0.1", port=8080, socket_path=None, batch_size=64, intra_op_threads=None,
+                inter_op_threads=None, max_batch_sequences=None, max_batch_tokens=None, max_latency=5.0):
+    """
+    Load a model once and tag sequences sent over HTTP (TCP or Unix socket) until interrupted
+    :param model_path: yaset model path
+    :param host: TCP host
+    :param port: TCP port
+    :param socket_path: Unix socket path (used instead of host and port if set)
+    :param batch_size: inference mini-batch size, default maximum number of sequences tagged together
+    :param intra_op_threads: threads used within TensorFlow operations (int, 'auto' or None for cpu_cores)
+    :param inter_op_threads: TensorFlow operations run in parallel (int, 'auto' or None for cpu_cores)
+    :param max_batch_sequences: maximum number of sequences tagged together when merging requests
+    :param max_batch_tokens: maximum number of tokens tagged together when merging requests (None for no limit)
+    :param max_latency: time (ms) spent collecting requests to tag together
+    :return: nothing
+    """
+
+    log_message("BEGIN - LOADING MODEL")
+
+    logging.info("* batch size: {}".format(batch_size))
+    logging.info("* micro-batching: max latency={}ms, max sequences={}, max tokens={}".format(
+        max_latency, max_batch_sequences or batch_size, max_batch_tokens or "unlimited"))
+
+    data, tagger = load_tagger(model_path, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    log_message("END - LOADING MODEL")
+
+    batcher = MicroBatcher(tagger, batch_size=batch_size, max_batch_sequences=max_batch_sequences,
+                           max_batch_tokens=max_batch_tokens, max_latency=max_latency)
+    batcher.start()
+
+    if socket_path:
+        socket_path = os.path.abspath(socket_path)
+
+        # Removing a socket left by a previous run
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise Exception("The socket path you specified is not a socket: {}".format(socket_path))
+
+            os.remove(socket_path)
+
+        server = ThreadingUnixHTTPServer(socket_path, TaggingRequestHandler)
+        logging.info("Listening on unix socket: {}".format(socket_path))
+    else:
+        server = ThreadingHTTPServer((host, port), TaggingRequestHandler)
+        logging.info("Listening on http://{}:{}".format(host, port))
+
+    server.data_object = data
+    server.batcher = batcher
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping server")
+    finally:
+        server.server_close()
+        batcher.stop()
+        tagger.close()
+
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)